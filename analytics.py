@@ -0,0 +1,271 @@
+"""
+Stock analytics: movement velocity, days of cover and reorder points.
+
+Outflow over the analysis window is read from the daily movement rollup
+(see rollups.py) rather than the ledger: the database sums each cell's
+daily outflow, its squares and its most recent 7 and 28 days in one
+grouped scan, and the result comes back in columnar form, one NumPy array
+per column, straight from the database cursor. A window ending mid-day
+takes that last, partial day from the movements themselves. Combining the
+two and everything derived from them is done over whole arrays, so the
+cost is one pass over the rollup rows in the window and none in Python per
+movement. Archived movements keep their rollup buckets and still count.
+
+The window is ``window_days`` calendar days (UTC) ending with the day
+that contains ``end``.
+
+For every (product, location) with stock or outbound movements in the
+window:
+
+- ``velocity`` is the average quantity leaving the location per day over
+  the window (OUT movements and transfers out), with ``velocity_7d`` and
+  ``velocity_28d`` over the most recent 7 and 28 days.
+- ``daily_std`` is the standard deviation of the daily outflow, counting
+  days without movements as zero.
+- ``days_of_cover`` is the on-hand balance divided by ``velocity``.
+- ``reorder_point`` is expected demand over the lead time plus safety
+  stock, ``velocity * lead + z * daily_std * sqrt(lead)``, and
+  ``reorder_qty`` tops a cell at or below it up to ``target_cover_days``
+  of demand past the reorder point.
+
+On-hand balances come from the materialized ``stock_balance`` table, or
+as of ``end`` from the nearest snapshot when the window ends in the past.
+"""
+
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import case, func, select
+from models import db, DailyMovementRollup, Product, Location, ProductMovement
+from balances import as_of_balance_query, stored_balance_query
+from ledger import parse_as_of
+from rollups import ALL, bucket_start
+
+
+ROLLING_WINDOWS = (7, 28)
+
+ANALYTICS_COLUMNS = ('product_id', 'location_id', 'on_hand', 'velocity_7d', 'velocity_28d', 'velocity',
+                     'daily_std', 'days_of_cover', 'reorder_point', 'reorder_qty')
+SORT_KEYS = ('days_of_cover', 'velocity', 'reorder_qty', 'on_hand', 'product_id')
+
+OUTFLOW_DTYPE = np.dtype([('product', 'i8'), ('location', 'i8'), ('total', 'i8'), ('squares', 'i8')]
+                          + [(f'last_{days}', 'i8') for days in ROLLING_WINDOWS])
+BALANCE_DTYPE = np.dtype([('product', 'i8'), ('location', 'i8'), ('qty', 'i8')])
+
+# Cells are packed into one int64 as product << 32 | location
+CELL_SHIFT = 32
+
+
+def _fetch(statement, dtype):
+    """Run a select and read its rows into a structured array via the DBAPI cursor."""
+    result = db.session.connection().execute(statement)
+    return np.fromiter(result.cursor, dtype=dtype)
+
+
+def load_outflow_columns(start, end, window_end, product_id=None, location_id=None):
+    """Per-cell outflow over the whole days ``start <= day < end``, from the daily rollup.
+
+    Fields are ``product``, ``location``, ``total`` (the sum of the daily
+    outflow), ``squares`` (the sum of its squares) and ``last_7`` and
+    ``last_28``, the outflow of those days within 7 and 28 days of
+    ``window_end``. Outflow is OUT movements plus transfers out of the
+    location.
+    """
+    rollup = DailyMovementRollup
+    outflow = rollup.out_qty + rollup.transfer_out_qty
+    query = select(
+        rollup.product_id,
+        rollup.location_id,
+        func.sum(outflow),
+        func.sum(outflow * outflow),
+        *(func.sum(case((rollup.bucket >= window_end - timedelta(days=days), outflow), else_=0))
+          for days in ROLLING_WINDOWS),
+    ).where(rollup.bucket >= start, rollup.bucket < end, outflow > 0)
+    # Ids are positive, so ``> ALL`` leaves out the total rows and is a
+    # range over the primary key rather than a filter on every row
+    if location_id is None:
+        query = query.where(rollup.location_id > ALL)
+    else:
+        query = query.where(rollup.location_id == location_id)
+    if product_id is None:
+        query = query.where(rollup.product_id > ALL)
+    else:
+        query = query.where(rollup.product_id == product_id)
+    return _fetch(query.group_by(rollup.location_id, rollup.product_id), OUTFLOW_DTYPE)
+
+
+def load_partial_day_outflow(start, end, product_id=None, location_id=None):
+    """Per-cell outflow of movements with ``start <= timestamp < end``.
+
+    Used for the day the window ends in, which the daily rollup only holds
+    whole. Returns a structured array of product, location, qty.
+    """
+    query = select(
+        ProductMovement.product_id,
+        ProductMovement.from_location,
+        func.sum(ProductMovement.qty),
+    ).where(ProductMovement.timestamp >= start, ProductMovement.timestamp < end,
+            ProductMovement.from_location.is_not(None))
+    if product_id is not None:
+        query = query.where(ProductMovement.product_id == product_id)
+    if location_id is not None:
+        query = query.where(ProductMovement.from_location == location_id)
+    query = query.group_by(ProductMovement.product_id, ProductMovement.from_location)
+    return _fetch(query, BALANCE_DTYPE)
+
+
+def load_balance_columns(product_id=None, location_id=None, as_of=None):
+    """Non-zero balances as a structured array of product, location, qty.
+
+    Current balances are read from ``stock_balance``; with ``as_of`` they
+    are replayed from the nearest snapshot.
+    """
+    if as_of is None:
+        query = stored_balance_query(product_id, location_id)
+    else:
+        query = as_of_balance_query(as_of, product_id, location_id)
+    return _fetch(query, BALANCE_DTYPE)
+
+
+def _spread(cells, all_cells, values):
+    """Place per-cell ``values`` at their positions in the sorted ``all_cells``."""
+    out = np.zeros(len(all_cells), dtype=np.float64)
+    out[np.searchsorted(all_cells, cells)] = values
+    return out
+
+
+class StockAnalytics:
+    """Per-cell analytics as parallel arrays, one entry per (product, location)."""
+
+    def __init__(self, end, window_days, columns):
+        self.end = end
+        self.window_days = window_days
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['product_id'])
+
+    def rows(self, sort='days_of_cover', descending=False, limit=None):
+        """Rows as dicts, ordered by ``sort``; cells without demand sort last on cover."""
+        if sort not in SORT_KEYS:
+            raise ValueError(f'Cannot sort by {sort!r}, expected one of {", ".join(SORT_KEYS)}')
+
+        values = self.columns[sort]
+        if descending:
+            values = -values
+        # Ties broken by product and location
+        order = np.lexsort((self.columns['location_id'], self.columns['product_id'], values))
+        if limit is not None:
+            order = order[:limit]
+
+        selected = {}
+        for name in ANALYTICS_COLUMNS:
+            column = self.columns[name][order]
+            if column.dtype.kind == 'f':
+                column = np.round(column, 2)
+            selected[name] = column.tolist()
+
+        # Cells without demand have unlimited cover
+        selected['days_of_cover'] = [None if value == float('inf') else value
+                                     for value in selected['days_of_cover']]
+        return [dict(zip(ANALYTICS_COLUMNS, row)) for row in zip(*selected.values())]
+
+
+def stock_analytics(end=None, window_days=90, lead_time_days=7, service_z=1.65,
+                    target_cover_days=30, product_id=None, location_id=None):
+    """Compute velocity, cover and reorder suggestions for the window ending at ``end``.
+
+    Without ``end`` the window ends now and on-hand is the current balance.
+    """
+    as_of = end
+    end = end or datetime.utcnow()
+    # Whole days come from the rollup; the day containing ``end`` is
+    # partial unless ``end`` is midnight, and is read from the movements
+    today = bucket_start(end, 'day')
+    last = today if today == end else today + timedelta(days=1)
+    start = last - timedelta(days=window_days)
+
+    outflow = load_outflow_columns(start, today, last, product_id, location_id)
+    outflow_cells = (outflow['product'] << CELL_SHIFT) | outflow['location']
+    if today < end:
+        partial = load_partial_day_outflow(today, end, product_id, location_id)
+    else:
+        partial = np.zeros(0, dtype=BALANCE_DTYPE)
+    partial_cells = (partial['product'] << CELL_SHIFT) | partial['location']
+
+    # The partial day is a day of its own in the window and always among
+    # the most recent ones, so it adds to every sum once
+    demand_cells = np.union1d(outflow_cells, partial_cells)
+    partial_qty = _spread(partial_cells, demand_cells, partial['qty'])
+    total = _spread(outflow_cells, demand_cells, outflow['total']) + partial_qty
+    squares = _spread(outflow_cells, demand_cells, outflow['squares']) + partial_qty * partial_qty
+    rolling = {}
+    for days in ROLLING_WINDOWS:
+        recent = _spread(outflow_cells, demand_cells, outflow[f'last_{days}']) + partial_qty
+        rolling[days] = recent / min(days, window_days)
+
+    balances = load_balance_columns(product_id, location_id, as_of)
+    balance_cells = (balances['product'] << CELL_SHIFT) | balances['location']
+
+    cells = np.union1d(demand_cells, balance_cells)
+    velocity = _spread(demand_cells, cells, total / window_days)
+    mean_square = _spread(demand_cells, cells, squares / window_days)
+    daily_std = np.sqrt(np.maximum(mean_square - velocity * velocity, 0))
+    on_hand = _spread(balance_cells, cells, balances['qty'])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_cover = np.where(velocity > 0, on_hand / velocity, np.inf)
+    reorder_point = velocity * lead_time_days + service_z * daily_std * np.sqrt(lead_time_days)
+    reorder_qty = np.where(
+        (velocity > 0) & (on_hand <= reorder_point),
+        np.ceil(reorder_point + velocity * target_cover_days - on_hand),
+        0,
+    )
+
+    return StockAnalytics(end, window_days, {
+        'product_id': cells >> CELL_SHIFT,
+        'location_id': cells & ((1 << CELL_SHIFT) - 1),
+        'on_hand': on_hand.astype(np.int64),
+        'velocity_7d': _spread(demand_cells, cells, rolling[7]),
+        'velocity_28d': _spread(demand_cells, cells, rolling[28]),
+        'velocity': velocity,
+        'daily_std': daily_std,
+        'days_of_cover': days_of_cover,
+        'reorder_point': reorder_point,
+        'reorder_qty': np.maximum(reorder_qty, 0).astype(np.int64),
+    })
+
+
+def parse_analytics_args(args, config):
+    """stock_analytics() keyword arguments from request args, defaulting to config.
+
+    Recognises ``as_of`` (end of the window), ``window``, ``lead_time``,
+    ``product_id`` and ``location_id``; malformed values fall back to the
+    defaults.
+    """
+    def number(name, default, minimum, maximum):
+        value = args.get(name, type=int)
+        return default if value is None else max(minimum, min(value, maximum))
+
+    return {
+        'end': parse_as_of(args.get('as_of')),
+        'window_days': number('window', config['ANALYTICS_WINDOW_DAYS'], 1, 3660),
+        'lead_time_days': number('lead_time', config['ANALYTICS_LEAD_TIME_DAYS'], 0, 365),
+        'service_z': config['ANALYTICS_SERVICE_Z'],
+        'target_cover_days': config['ANALYTICS_TARGET_COVER_DAYS'],
+        'product_id': args.get('product_id', type=int),
+        'location_id': args.get('location_id', type=int),
+    }
+
+
+def attach_names(rows):
+    """Add ``product`` and ``location`` names to analytics rows, two queries in all."""
+    product_ids = {row['product_id'] for row in rows}
+    location_ids = {row['location_id'] for row in rows}
+    products = dict(db.session.execute(
+        select(Product.product_id, Product.name).where(Product.product_id.in_(product_ids))).all())
+    locations = dict(db.session.execute(
+        select(Location.location_id, Location.name).where(Location.location_id.in_(location_ids))).all())
+    for row in rows:
+        row['product'] = products.get(row['product_id'])
+        row['location'] = locations.get(row['location_id'])
+    return rows
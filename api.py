@@ -0,0 +1,566 @@
+"""
+JSON API, mounted at /api/v1.
+
+Read-only collections for products, locations, movements and balances,
+for scanners and dashboards that would otherwise scrape the HTML pages,
+and a ``/search`` endpoint for typeahead lookups:
+
+- ``fields=a,b`` selects a sparse fieldset; only those columns are queried.
+- ``limit`` and ``cursor`` page through a collection by keyset, so deep
+  pages cost the same as the first. Each page carries the ``next_cursor``.
+- ``format=rows`` returns ``{"fields": [...], "rows": [[...], ...]}``
+  instead of one object per row, which avoids repeating the keys.
+
+``/rollups`` serves movement chart series from the hourly and daily
+rollups (see rollups.py).
+
+``/jobs`` submits and follows background jobs (see jobs.py): poll the job,
+or stream its progress as server-sent events, then download its artifact.
+
+``/changes`` serves the change feed (see changefeed.py): the balance deltas
+of every ledger write after ``since``, pulled a page at a time or streamed
+as server-sent events. ``/balances`` carries the feed position it was read
+at in ``seq``.
+
+Rows are built directly from the column tuples the query returns, never
+from ORM objects. Responses are compressed with brotli when the optional
+``brotli`` package is installed and the client accepts it, else gzip.
+"""
+
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+from flask import Blueprint, Response, current_app, request, send_file, stream_with_context, url_for
+from sqlalchemy import DateTime, and_, case, select, tuple_
+from models import db, Job, Product, Location, ProductMovement
+from balances import as_of_balance_query, stored_balance_query
+from cache import cache
+from changefeed import latest_seq, read_events
+from jobs import (FINISHED, JOB_COLUMNS, SUCCEEDED, JobError, JobQueueFull, job_as_dict,
+                  job_status, jobs)
+from ledger import filter_movements, parse_as_of, parse_movement_filters, record_movement_batch
+from rollups import GRANULARITIES, rollup_series
+from search import INDEXES, search
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+class ApiError(Exception):
+    """An error reported to the client as ``{"error": ...}`` with ``status``."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return _json({'error': str(error)}, error.status)
+
+
+def _json(payload, status=200):
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+    return Response(body, status=status, mimetype='application/json')
+
+
+@api.after_request
+def compress(response):
+    """Compress JSON bodies above API_COMPRESS_MIN_SIZE bytes."""
+    if (response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.content_length is None
+            or response.content_length < current_app.config['API_COMPRESS_MIN_SIZE']):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings['br']:
+        response.set_data(brotli.compress(response.get_data(), quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+# Sparse fieldsets and keyset pages
+
+def _selected_fields(fields):
+    requested = request.args.get('fields')
+    if not requested:
+        return list(fields)
+
+    names = list(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    unknown = [name for name in names if name not in fields]
+    if unknown or not names:
+        raise ApiError(f'Unknown field(s): {", ".join(unknown) or requested}. '
+                       f'Available: {", ".join(fields)}')
+    return names
+
+
+def _page_size():
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def _encode_cursor(values):
+    return '_'.join(value.isoformat() if isinstance(value, datetime) else str(value)
+                    for value in values)
+
+
+def _decode_cursor(cursor, keys):
+    """Decode a cursor into one value per key column; None when absent."""
+    if not cursor:
+        return None
+
+    parts = cursor.split('_')
+    try:
+        if len(parts) != len(keys):
+            raise ValueError
+        return [datetime.fromisoformat(part) if isinstance(key.type, DateTime) else int(part)
+                for part, key in zip(parts, keys)]
+    except ValueError:
+        raise ApiError(f'Malformed cursor {cursor!r}.')
+
+
+def _collection(fields, keys, query, descending=False, extra=None):
+    """Respond with one page of ``query`` restricted to the requested fields.
+
+    ``fields`` maps field names to column expressions, and ``keys`` are the
+    unique sort columns the cursor is built from. ``query`` is a callable
+    taking the columns to select and returning the filtered select.
+    ``extra`` is added to the payload.
+    """
+    names = _selected_fields(fields)
+    limit = _page_size()
+    columns = [fields[name] for name in names]
+    count = len(columns)
+
+    statement = query([*columns, *keys])
+    position = _decode_cursor(request.args.get('cursor'), keys)
+    if position is not None:
+        after = tuple_(*keys) < tuple_(*position) if descending else tuple_(*keys) > tuple_(*position)
+        statement = statement.where(after)
+    order = [key.desc() for key in keys] if descending else keys
+    rows = db.session.execute(statement.order_by(*order).limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1][count:])
+
+    dates = [index for index, column in enumerate(columns) if isinstance(column.type, DateTime)]
+    if dates:
+        values = []
+        for row in rows:
+            row = list(row[:count])
+            for index in dates:
+                if row[index] is not None:
+                    row[index] = row[index].isoformat()
+            values.append(row)
+    else:
+        values = [row[:count] for row in rows]
+
+    if request.args.get('format') == 'rows':
+        payload = {'fields': names, 'rows': [list(row) for row in values]}
+    else:
+        payload = {'data': [dict(zip(names, row)) for row in values]}
+    payload['next_cursor'] = next_cursor
+    payload.update(extra or {})
+    return _json(payload)
+
+
+def _item(fields, key, value, name):
+    names = _selected_fields(fields)
+    columns = [fields[field] for field in names]
+    row = db.session.execute(select(*columns).where(key == value)).first()
+    if row is None:
+        raise ApiError(f'{name} {value} not found.', 404)
+    return _json({'data': {
+        field: item.isoformat() if isinstance(item, datetime) else item
+        for field, item in zip(names, row)
+    }})
+
+
+# Collections
+
+PRODUCT_FIELDS = {
+    'product_id': Product.product_id,
+    'name': Product.name,
+    'description': Product.description,
+}
+
+LOCATION_FIELDS = {
+    'location_id': Location.location_id,
+    'name': Location.name,
+    'address': Location.address,
+}
+
+MOVEMENT_FIELDS = {
+    'movement_id': ProductMovement.movement_id,
+    'timestamp': ProductMovement.timestamp,
+    'product_id': ProductMovement.product_id,
+    'from_location': ProductMovement.from_location,
+    'to_location': ProductMovement.to_location,
+    'qty': ProductMovement.qty,
+    # Same rules as models.movement_type()
+    'type': case(
+        (and_(ProductMovement.from_location.is_(None), ProductMovement.to_location.isnot(None)), 'IN'),
+        (and_(ProductMovement.from_location.isnot(None), ProductMovement.to_location.is_(None)), 'OUT'),
+        else_='TRANSFER',
+    ),
+}
+
+
+@api.route('/products')
+def list_products():
+    return _collection(PRODUCT_FIELDS, [Product.product_id], lambda columns: select(*columns))
+
+
+@api.route('/products/<int:product_id>')
+def get_product(product_id):
+    return _item(PRODUCT_FIELDS, Product.product_id, product_id, 'Product')
+
+
+@api.route('/locations')
+def list_locations():
+    return _collection(LOCATION_FIELDS, [Location.location_id], lambda columns: select(*columns))
+
+
+@api.route('/locations/<int:location_id>')
+def get_location(location_id):
+    return _item(LOCATION_FIELDS, Location.location_id, location_id, 'Location')
+
+
+@api.route('/movements')
+def list_movements():
+    """The ledger, newest first, with the same filters as /movements."""
+    filters = parse_movement_filters(request.args)
+    return _collection(
+        MOVEMENT_FIELDS, [ProductMovement.timestamp, ProductMovement.movement_id],
+        lambda columns: filter_movements(select(*columns), filters),
+        descending=True,
+    )
+
+
+@api.route('/movements/<int:movement_id>')
+def get_movement(movement_id):
+    return _item(MOVEMENT_FIELDS, ProductMovement.movement_id, movement_id, 'Movement')
+
+
+@api.route('/balances')
+def list_balances():
+    """Non-zero balances, from stock_balance or as of ``as_of``.
+
+    Filters on ``product_id`` and ``location_id``. The ``product`` and
+    ``location`` name fields join their tables only when selected. Current
+    balances carry ``seq``, the change feed position they were read at.
+    """
+    filters = parse_movement_filters(request.args)
+    as_of = parse_as_of(request.args.get('as_of'))
+    if request.args.get('as_of') and as_of is None:
+        raise ApiError(f'Malformed as_of {request.args["as_of"]!r}.')
+
+    if as_of is None:
+        balances = stored_balance_query(filters['product_id'], filters['location_id'])
+    else:
+        balances = as_of_balance_query(as_of, filters['product_id'], filters['location_id'])
+    balances = balances.order_by(None).subquery('balances')
+
+    fields = {
+        'product_id': balances.c.product_id,
+        'product': Product.name,
+        'location_id': balances.c.location_id,
+        'location': Location.name,
+        'qty': balances.c.qty,
+    }
+
+    def query(columns):
+        statement = select(*columns).select_from(balances)
+        if any(column is Product.name for column in columns):
+            statement = statement.join(Product, Product.product_id == balances.c.product_id)
+        if any(column is Location.name for column in columns):
+            statement = statement.join(Location, Location.location_id == balances.c.location_id)
+        return statement
+
+    # Read in the same transaction as the page, so the two agree
+    extra = {'seq': latest_seq()} if as_of is None else None
+    return _collection(fields, [balances.c.product_id, balances.c.location_id], query, extra=extra)
+
+
+@api.route('/search')
+def search_entries():
+    """Ranked prefix search over products or locations (``type``), for typeahead."""
+    kind = request.args.get('type', 'products')
+    if kind not in INDEXES:
+        raise ApiError(f'Unknown search type {kind!r}. Available: {", ".join(INDEXES)}')
+
+    rows = search(kind, request.args.get('q', ''), _page_size())
+    return _json({'data': [{'id': id_, 'name': name} for id_, name in rows]})
+
+
+@api.route('/analytics/stock')
+def stock_analytics_report():
+    """Velocity, days of cover and reorder suggestions per product and location.
+
+    Takes the parse_analytics_args() parameters plus ``sort`` (a column of
+    SORT_KEYS, ``-`` prefixed for descending; default lowest cover first),
+    ``limit`` and ``names=1`` to include product and location names.
+    """
+    # Imported here so processes that never serve analytics skip loading NumPy
+    from analytics import SORT_KEYS, attach_names, parse_analytics_args, stock_analytics
+
+    sort = request.args.get('sort', 'days_of_cover')
+    if sort.lstrip('-') not in SORT_KEYS:
+        raise ApiError(f'Cannot sort by {sort!r}. Available: {", ".join(SORT_KEYS)}')
+
+    params = parse_analytics_args(request.args, current_app.config)
+    analytics = stock_analytics(**params)
+    rows = analytics.rows(sort.lstrip('-'), descending=sort.startswith('-'), limit=_page_size())
+    if request.args.get('names') == '1':
+        attach_names(rows)
+    return _json({
+        'end': analytics.end.isoformat(),
+        'window_days': analytics.window_days,
+        'lead_time_days': params['lead_time_days'],
+        'cells': len(analytics),
+        'data': rows,
+    })
+
+
+@api.route('/rollups')
+def movement_rollups():
+    """Movement quantities by type per hour, day or week, as parallel series.
+
+    ``granularity`` (default ``day``), ``start`` and ``end`` (ISO dates or
+    times; ``end`` is inclusive and defaults to now, ``start`` to 30
+    buckets before it) and optional ``location_id`` and ``product_id``.
+    """
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        raise ApiError(f'Unknown granularity {granularity!r}. Available: {", ".join(GRANULARITIES)}')
+
+    end = parse_as_of(request.args.get('end')) if request.args.get('end') else datetime.utcnow()
+    if end is None:
+        raise ApiError(f'Malformed end {request.args["end"]!r}.')
+    try:
+        start = (datetime.fromisoformat(request.args['start']) if request.args.get('start')
+                 else end - GRANULARITIES[granularity] * 29)
+    except ValueError:
+        raise ApiError(f'Malformed start {request.args["start"]!r}.')
+
+    try:
+        series = rollup_series(granularity, start, end,
+                               location_id=request.args.get('location_id', type=int),
+                               product_id=request.args.get('product_id', type=int),
+                               max_buckets=current_app.config['ROLLUP_MAX_BUCKETS'])
+    except ValueError as e:
+        raise ApiError(str(e))
+    return _json(series)
+
+
+# Writes
+
+@api.route('/movements/batch', methods=['POST'])
+def post_movement_batch():
+    """Add many movements in one request and one transaction.
+
+    The body is a JSON list of movements, or an object with a
+    ``movements`` list and an optional ``partial`` flag (also accepted as
+    ``?partial=1``). Responds 201 when every line was created, 207 when
+    only some were (partial mode) and 422 when none were, with a result
+    per line.
+    """
+    payload = request.get_json(silent=True)
+    partial = request.args.get('partial', '').lower() in ('1', 'true')
+    lines = payload
+    if isinstance(payload, dict):
+        lines = payload.get('movements')
+        partial = partial or payload.get('partial') is True
+
+    if not isinstance(lines, list) or not lines:
+        raise ApiError('Expected a non-empty JSON list of movements.')
+    if len(lines) > current_app.config['BATCH_MAX_LINES']:
+        raise ApiError(f'At most {current_app.config["BATCH_MAX_LINES"]} movements per batch.', 413)
+
+    results = record_movement_batch(lines, partial=partial)
+    created = sum(result['status'] == 'created' for result in results)
+    if created:
+        db.session.commit()
+        cache.bump_version('movements')
+    else:
+        db.session.rollback()
+
+    status = 201 if created == len(lines) else 207 if created else 422
+    return _json({'created': created,
+                  'rejected': sum(result['status'] == 'rejected' for result in results),
+                  'partial': partial, 'results': results}, status)
+
+
+# Change feed
+
+def _since(value):
+    try:
+        since = int(value or 0)
+    except ValueError:
+        raise ApiError(f'Malformed since {value!r}.')
+    if since < 0:
+        raise ApiError('since must not be negative.')
+    return since
+
+
+@api.route('/changes')
+def list_changes():
+    """Change events after ``since``, oldest first, with their balance deltas.
+
+    Repeat with ``next_since`` until ``data`` comes back empty. A 410 means
+    events after ``since`` were pruned: reload ``/balances`` and continue
+    from its ``seq``.
+    """
+    since = _since(request.args.get('since'))
+    events, missed = read_events(since, _page_size())
+    if missed:
+        raise ApiError(f'Changes after {since} are no longer kept; reload the balances.', 410)
+    return _json({'data': events, 'next_since': events[-1]['seq'] if events else since})
+
+
+@api.route('/changes/stream')
+def stream_changes():
+    """Stream change events after ``since`` as server-sent events.
+
+    Each event's id is its sequence number, so a reconnecting EventSource
+    resumes from Last-Event-ID. The stream ends after
+    CHANGES_STREAM_SECONDS and the client reconnects. A ``reset`` event
+    ends it when events were pruned before they were sent.
+    """
+    since = _since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    interval = current_app.config['CHANGES_POLL_INTERVAL']
+    keepalive = current_app.config['CHANGES_KEEPALIVE']
+    duration = current_app.config['CHANGES_STREAM_SECONDS']
+    limit = current_app.config['API_PAGE_SIZE']
+
+    def stream():
+        last = since
+        started = sent_at = time.monotonic()
+        yield f'retry: {int(interval * 1000)}\n\n'
+        while True:
+            events, missed = read_events(last, limit)
+            # Give the connection back before writing to a client that may be slow to read
+            db.session.close()
+            if missed:
+                yield f'event: reset\ndata: {json.dumps({"since": last})}\n\n'
+                return
+            for event in events:
+                yield (f'id: {event["seq"]}\nevent: change\n'
+                       f'data: {json.dumps(event, separators=(",", ":"))}\n\n')
+            now = time.monotonic()
+            if events:
+                last, sent_at = events[-1]['seq'], now
+            elif now - sent_at >= keepalive:
+                yield ': keepalive\n\n'
+                sent_at = now
+            if now - started >= duration:
+                return
+            if len(events) < limit:
+                time.sleep(interval)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Background jobs
+
+def job_submitted(job_id):
+    """202 response for a newly queued job, pointing at its status URL."""
+    response = _json({'data': job_as_dict(job_status(job_id)),
+                      'links': _job_links(job_id)}, 202)
+    response.headers['Location'] = url_for('api.get_job', job_id=job_id)
+    return response
+
+
+def _job_links(job_id):
+    return {
+        'self': url_for('api.get_job', job_id=job_id),
+        'events': url_for('api.job_events', job_id=job_id),
+        'artifact': url_for('api.job_artifact', job_id=job_id),
+    }
+
+
+def submit_job(kind, params=None, timeout=None):
+    """Queue a job, reporting JobError as a client error."""
+    try:
+        return jobs.submit(kind, params, timeout=timeout)
+    except JobQueueFull as e:
+        raise ApiError(str(e), 429)
+    except JobError as e:
+        raise ApiError(str(e))
+
+
+@api.route('/jobs', methods=['POST'])
+def post_job():
+    """Queue ``{"kind": ..., "params": {...}, "timeout": seconds}``."""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('params', {}), dict):
+        raise ApiError('Expected {"kind": ..., "params": {...}}.')
+    timeout = payload.get('timeout')
+    if timeout is not None and (not isinstance(timeout, int) or timeout <= 0):
+        raise ApiError('timeout must be a positive number of seconds.')
+    return job_submitted(submit_job(payload.get('kind'), payload.get('params'), timeout))
+
+
+@api.route('/jobs')
+def list_jobs():
+    """The 50 most recent jobs, optionally with one ``status``."""
+    query = select(*(getattr(Job, name) for name in JOB_COLUMNS))
+    if request.args.get('status'):
+        query = query.where(Job.status == request.args['status'])
+    rows = db.session.execute(query.order_by(Job.created_at.desc(), Job.job_id.desc()).limit(50))
+    return _json({'data': [job_as_dict(row) for row in rows]})
+
+
+@api.route('/jobs/<int:job_id>')
+def get_job(job_id):
+    row = job_status(job_id)
+    if row is None:
+        raise ApiError(f'Job {job_id} not found.', 404)
+    return _json({'data': job_as_dict(row), 'links': _job_links(job_id)})
+
+
+@api.route('/jobs/<int:job_id>/events')
+def job_events(job_id):
+    """Stream job progress as server-sent events until the job finishes."""
+    if job_status(job_id) is None:
+        raise ApiError(f'Job {job_id} not found.', 404)
+    interval = current_app.config['JOB_EVENTS_INTERVAL']
+
+    def events():
+        last = None
+        while True:
+            state = job_as_dict(job_status(job_id))
+            if state != last:
+                event = 'done' if state['status'] in FINISHED else 'progress'
+                yield f'event: {event}\ndata: {json.dumps(state, separators=(",", ":"))}\n\n'
+                last = state
+            if state['status'] in FINISHED:
+                return
+            time.sleep(interval)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@api.route('/jobs/<int:job_id>/artifact')
+def job_artifact(job_id):
+    row = job_status(job_id)
+    if row is None:
+        raise ApiError(f'Job {job_id} not found.', 404)
+    if row.status != SUCCEEDED or not row.artifact:
+        raise ApiError(f'Job {job_id} has no artifact (status {row.status}).', 409)
+    return send_file(os.path.join(current_app.config['JOB_ARTIFACT_DIR'], row.artifact),
+                     as_attachment=True, download_name=os.path.basename(row.artifact))
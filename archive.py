@@ -0,0 +1,136 @@
+"""
+Ledger archival.
+
+Movements older than a cutoff are moved from ``product_movement`` into
+``product_movement_archive`` unchanged, and their net effect is folded into
+per-(product, location) ``opening_balance`` rows. The balance engine reads
+the opening balances in place of the archived rows, so current balances and
+as-of answers after the archived history are unchanged, while the live
+table, and every query against it, stays small.
+
+Work is done in batches of ``batch_size`` movements, each copied, folded and
+deleted in its own short transaction, so the job can run alongside live
+traffic. Stock balances and snapshots are untouched: archiving does not
+change any balance.
+"""
+
+from sqlalchemy import delete, func, insert, select
+from models import db, ProductMovement, ProductMovementArchive, OpeningBalance
+from balances import (apply_balance_deltas, archived_balance_query, as_of_balance_query,
+                      rebuild_stock_balances, stored_balance_query)
+from ledger import net_deltas
+
+
+ARCHIVE_COLUMNS = ('movement_id', 'timestamp', 'from_location', 'to_location', 'product_id', 'qty')
+
+
+class ArchiveResult:
+    """Outcome of an archive run; ``problems`` lists verification failures."""
+
+    def __init__(self):
+        self.archived = 0
+        self.batches = 0
+        self.problems = []
+
+
+def _archive_batch(cutoff, batch_size, keep_id):
+    """Archive up to ``batch_size`` of the oldest movements before ``cutoff``.
+
+    Returns the number of movements archived. Commits.
+    """
+    columns = [getattr(ProductMovement, name) for name in ARCHIVE_COLUMNS]
+    rows = db.session.execute(
+        select(*columns)
+        .where(ProductMovement.timestamp < cutoff, ProductMovement.movement_id != keep_id)
+        .order_by(ProductMovement.timestamp, ProductMovement.movement_id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+
+    ids = [row.movement_id for row in rows]
+    db.session.execute(insert(ProductMovementArchive.__table__), [row._asdict() for row in rows])
+    apply_balance_deltas(net_deltas(rows), model=OpeningBalance)
+    db.session.execute(delete(ProductMovement).where(ProductMovement.movement_id.in_(ids)))
+    db.session.commit()
+
+    return len(rows)
+
+
+def archive_movements(cutoff, batch_size=5000, verify=False, progress=None):
+    """Move every movement with a timestamp before ``cutoff`` to the archive.
+
+    The newest movement is never archived: SQLite reuses the highest rowid
+    once it is deleted, which would let a new movement take an archived id.
+
+    With ``verify`` the current balances and the balances as of ``cutoff``
+    are computed before and after the run and compared, on top of the
+    checks in verify_archive(). ``progress`` is called with the running
+    count after each batch.
+    """
+    result = ArchiveResult()
+    keep_id = db.session.scalar(select(func.max(ProductMovement.movement_id)))
+
+    if verify:
+        before = _checkpoints(cutoff)
+
+    while True:
+        archived = _archive_batch(cutoff, batch_size, keep_id)
+        if not archived:
+            break
+        result.archived += archived
+        result.batches += 1
+        if progress is not None:
+            progress(result.archived)
+
+    if verify:
+        after = _checkpoints(cutoff)
+        for name in before:
+            if before[name] != after[name]:
+                result.problems.append(f'{name} balances changed by archiving')
+        result.problems += verify_archive()
+
+    return result
+
+
+def _checkpoints(cutoff):
+    """Balances that archiving before ``cutoff`` must leave unchanged."""
+    return {
+        'Current': db.session.execute(stored_balance_query()).all(),
+        f'As-of {cutoff}': db.session.execute(as_of_balance_query(cutoff)).all(),
+    }
+
+
+def verify_archive():
+    """Check the archive against the opening balances and stock balances.
+
+    Returns a list of problem descriptions, empty when everything matches:
+    each opening balance must equal the net of its archived movements, and
+    the opening balances plus the live ledger must equal the materialized
+    stock balances.
+    """
+    problems = []
+    archived = {
+        (row.product_id, row.location_id): row.qty
+        for row in db.session.execute(archived_balance_query())
+    }
+    openings = {
+        (row.product_id, row.location_id): row.qty
+        for row in db.session.execute(
+            select(OpeningBalance.product_id, OpeningBalance.location_id, OpeningBalance.qty)
+        )
+    }
+
+    for product_id, location_id in sorted(archived.keys() | openings.keys()):
+        opening_qty = openings.get((product_id, location_id), 0)
+        archived_qty = archived.get((product_id, location_id), 0)
+        if opening_qty != archived_qty:
+            problems.append(f'Opening balance of product {product_id} at location {location_id} '
+                            f'is {opening_qty}, archived movements net {archived_qty}')
+
+    for product_id, location_id, stored_qty, computed_qty in rebuild_stock_balances(check_only=True):
+        problems.append(f'Stock balance of product {product_id} at location {location_id} '
+                        f'is {stored_qty}, opening balance plus ledger is {computed_qty}')
+
+    return problems
+
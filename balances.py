@@ -0,0 +1,402 @@
+"""
+Stock balance engine.
+
+A product's balance at a location is everything moved in (to_location)
+minus everything moved out (from_location). Balances are computed for all
+(product, location) pairs at once with a single grouped query over the
+movement log instead of one query per cell.
+
+The result is materialized in the ``stock_balance`` table, which is kept
+current by applying per-cell deltas in the same transaction as each
+movement write and can be rebuilt from the log at any time.
+
+Historical ("as of") balances start from the nearest earlier balance
+snapshot and replay only the movements after it.
+
+Movements that have been archived out of the live ledger are folded into
+``opening_balance`` rows. Queries whose window starts at the beginning of
+history and ends after the newest archived movement use the opening
+balances in place of the archived rows; other windows read the archive.
+
+parallel_compute_balances() splits the live ledger into movement_id
+ranges, sums each range in a worker process over its own read-only
+connection and merges the partial sums with the opening balances;
+rebuild_stock_balances() uses it when given more than one worker.
+"""
+
+import multiprocessing
+from collections import defaultdict, namedtuple
+from functools import partial
+from itertools import chain
+from flask import current_app
+from sqlalchemy import delete, func, insert, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models import (db, Product, Location, ProductMovement, StockBalance,
+                    BalanceSnapshot, BalanceSnapshotRow, ProductMovementArchive, OpeningBalance)
+from changefeed import record_event
+import db_profile
+
+
+Balance = namedtuple('Balance', 'product_id location_id qty')
+
+
+def archive_watermark():
+    """Timestamp of the newest archived movement, or None if nothing is archived."""
+    return db.session.scalar(select(func.max(ProductMovementArchive.timestamp)))
+
+
+def _movement_sides(model, product_id, location_id, since, until, movement_range=None):
+    """Incoming and outgoing selects over a movement table, with filters applied.
+
+    ``movement_range`` is a half-open ``(first, end)`` range of movement
+    ids, either end None for unbounded.
+    """
+    incoming = select(
+        model.product_id.label('product_id'),
+        model.to_location.label('location_id'),
+        model.qty.label('qty'),
+    ).where(model.to_location.isnot(None))
+
+    outgoing = select(
+        model.product_id.label('product_id'),
+        model.from_location.label('location_id'),
+        (-model.qty).label('qty'),
+    ).where(model.from_location.isnot(None))
+
+    if product_id is not None:
+        incoming = incoming.where(model.product_id == product_id)
+        outgoing = outgoing.where(model.product_id == product_id)
+
+    if location_id is not None:
+        incoming = incoming.where(model.to_location == location_id)
+        outgoing = outgoing.where(model.from_location == location_id)
+
+    if since is not None:
+        incoming = incoming.where(model.timestamp > since)
+        outgoing = outgoing.where(model.timestamp > since)
+
+    if until is not None:
+        incoming = incoming.where(model.timestamp <= until)
+        outgoing = outgoing.where(model.timestamp <= until)
+
+    if movement_range is not None:
+        first, end = movement_range
+        if first is not None:
+            incoming = incoming.where(model.movement_id >= first)
+            outgoing = outgoing.where(model.movement_id >= first)
+        if end is not None:
+            incoming = incoming.where(model.movement_id < end)
+            outgoing = outgoing.where(model.movement_id < end)
+
+    return [incoming, outgoing]
+
+
+def _balance_side(model, product_id, location_id, *criteria):
+    """Select (product_id, location_id, qty) from a per-cell balance table."""
+    query = select(
+        model.product_id.label('product_id'),
+        model.location_id.label('location_id'),
+        model.qty.label('qty'),
+    ).where(*criteria)
+
+    if product_id is not None:
+        query = query.where(model.product_id == product_id)
+    if location_id is not None:
+        query = query.where(model.location_id == location_id)
+
+    return query
+
+
+def balance_query(product_id=None, location_id=None, since=None, until=None, snapshot_id=None):
+    """Build the grouped balance query.
+
+    The incoming and outgoing sides of the movement log are stacked with
+    UNION ALL (outgoing quantities negated) and summed per
+    (product_id, location_id). Filters are pushed into every side, so the
+    query has the same shape whether it is filtered by product, location,
+    both or neither. Zero balances are dropped.
+
+    ``since`` (exclusive) and ``until`` (inclusive) restrict the movements
+    by timestamp. ``snapshot_id`` adds that snapshot's rows as a starting
+    point, so replaying from its ``taken_at`` gives balances at ``until``.
+    Archived movements are covered by the opening balances when the window
+    spans all of them, and read from the archive otherwise.
+    """
+    sides = _movement_sides(ProductMovement, product_id, location_id, since, until)
+
+    if since is None and (until is None or until >= (archive_watermark() or until)):
+        sides.append(_balance_side(OpeningBalance, product_id, location_id))
+    else:
+        sides += _movement_sides(ProductMovementArchive, product_id, location_id, since, until)
+
+    if snapshot_id is not None:
+        sides.append(_balance_side(BalanceSnapshotRow, product_id, location_id,
+                                   BalanceSnapshotRow.snapshot_id == snapshot_id))
+
+    return _net_balances(sides)
+
+
+def _net_balances(sides):
+    """Sum stacked (product_id, location_id, qty) selects per cell, dropping zeros."""
+    sides = union_all(*sides).subquery('sides')
+    total = func.sum(sides.c.qty)
+
+    return (
+        select(sides.c.product_id, sides.c.location_id, total.label('qty'))
+        .group_by(sides.c.product_id, sides.c.location_id)
+        .having(total != 0)
+        .order_by(sides.c.product_id, sides.c.location_id)
+    )
+
+
+def archived_balance_query():
+    """Build a query for the net of archived movements per (product_id, location_id)."""
+    sides = union_all(*_movement_sides(ProductMovementArchive, None, None, None, None))
+    sides = sides.subquery('sides')
+
+    return (
+        select(sides.c.product_id, sides.c.location_id, func.sum(sides.c.qty).label('qty'))
+        .group_by(sides.c.product_id, sides.c.location_id)
+    )
+
+
+def as_of_balance_query(as_of, product_id=None, location_id=None):
+    """Build a query for balances at ``as_of`` (inclusive).
+
+    Starts from the latest snapshot taken at or before ``as_of`` and replays
+    the movements after it, so the work is bounded by the snapshot interval
+    rather than the age of the data.
+    """
+    snapshot = db.session.execute(
+        select(BalanceSnapshot.snapshot_id, BalanceSnapshot.taken_at)
+        .where(BalanceSnapshot.taken_at <= as_of)
+        .order_by(BalanceSnapshot.taken_at.desc())
+        .limit(1)
+    ).first()
+
+    if snapshot is None:
+        return balance_query(product_id, location_id, until=as_of)
+
+    return balance_query(product_id, location_id, since=snapshot.taken_at, until=as_of,
+                         snapshot_id=snapshot.snapshot_id)
+
+
+def compute_balances(product_id=None, location_id=None):
+    """Return every non-zero balance as (product_id, location_id, qty) rows."""
+    return db.session.execute(balance_query(product_id, location_id)).all()
+
+
+def movement_ranges(partitions):
+    """Split the live movement ids into up to ``partitions`` ranges of equal width.
+
+    Ranges are half-open ``(first, end)`` pairs; the first starts and the
+    last ends unbounded, so together they cover every movement.
+    """
+    lowest, highest = db.session.execute(
+        select(func.min(ProductMovement.movement_id), func.max(ProductMovement.movement_id))).one()
+    if lowest is None:
+        return [(None, None)]
+
+    width = -(-(highest - lowest + 1) // max(1, partitions))
+    bounds = [None, *range(lowest + width, highest + 1, width), None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _range_balances(url, settings, movement_range):
+    """Net per-cell sums of one range of live movements over a new read-only connection.
+
+    Runs in a worker process, so it only uses what it is passed.
+    """
+    query = _net_balances(_movement_sides(ProductMovement, None, None, None, None, movement_range))
+    engine = db_profile.read_only_engine(url, settings)
+    try:
+        with engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+    finally:
+        engine.dispose()
+
+
+def _worker_context():
+    # Forked workers start without importing the app again (a spawned one
+    # would re-run the main module); they only use the engine they open.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+
+def parallel_compute_balances(workers, partitions=None):
+    """compute_balances() split across ``workers`` processes.
+
+    The live ledger is cut into ``partitions`` movement_id ranges (one per
+    worker by default). Ids follow insertion order, so each range is a
+    contiguous stretch of the table of about the same size, however the
+    movements are spread over products. Each range is summed per
+    (product, location) in a worker process over its own read-only
+    connection, and the partial sums are merged here with the opening
+    balances. The result has the same rows in the same order as
+    compute_balances(), as Balance tuples.
+
+    Workers read committed data only, each in its own transaction: run it
+    while holding the write lock, as rebuild_stock_balances() does, for
+    every range to see the same state. Falls back to compute_balances()
+    with one worker or a database other processes cannot open.
+    """
+    engine = db.engines[None]
+    if workers <= 1 or not db_profile.shareable(engine.url):
+        return [Balance(*row) for row in compute_balances()]
+
+    url = engine.url.render_as_string(hide_password=False)
+    work = partial(_range_balances, url, db_profile.pragmas(current_app))
+    totals = defaultdict(int)
+    with _worker_context().Pool(workers) as pool:
+        partials = pool.imap_unordered(work, movement_ranges(partitions or workers))
+        # The opening balances stand in for archived movements; read them while the workers run
+        for rows in chain([db.session.execute(_balance_side(OpeningBalance, None, None))], partials):
+            for product_id, location_id, qty in rows:
+                totals[(product_id, location_id)] += qty
+
+    return [Balance(product_id, location_id, qty)
+            for (product_id, location_id), qty in sorted(totals.items()) if qty]
+
+
+def stored_balance_query(product_id=None, location_id=None):
+    """Build a query over the materialized balances, mirroring balance_query()."""
+    query = select(
+        StockBalance.product_id, StockBalance.location_id, StockBalance.qty
+    ).where(StockBalance.qty != 0)
+
+    if product_id is not None:
+        query = query.where(StockBalance.product_id == product_id)
+
+    if location_id is not None:
+        query = query.where(StockBalance.location_id == location_id)
+
+    return query.order_by(StockBalance.product_id, StockBalance.location_id)
+
+
+def balance_report(product_id=None, location_id=None, as_of=None):
+    """Return non-zero balances with product and location names attached.
+
+    Reads the materialized ``stock_balance`` table, or replays from the
+    nearest snapshot when ``as_of`` is given. Rows are dicts with
+    ``product``, ``location`` and ``quantity`` keys, the shape the reports
+    template expects.
+    """
+    if as_of is None:
+        balances = stored_balance_query(product_id, location_id)
+    else:
+        balances = as_of_balance_query(as_of, product_id, location_id)
+
+    balances = balances.subquery('balances')
+    query = (
+        select(Product.name, Location.name, balances.c.qty)
+        .join(Product, Product.product_id == balances.c.product_id)
+        .join(Location, Location.location_id == balances.c.location_id)
+        .order_by(balances.c.product_id, balances.c.location_id)
+    )
+
+    return [
+        {'product': product, 'location': location, 'quantity': qty}
+        for product, location, qty in db.session.execute(query)
+    ]
+
+
+def _upsert_statement(model):
+    """INSERT ... ON CONFLICT that adds the inserted qty to an existing row."""
+    dialect = db.session.get_bind().dialect.name
+    insert_ = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+    table = model.__table__
+    stmt = insert_(table)
+    return stmt.on_conflict_do_update(
+        index_elements=['product_id', 'location_id'],
+        set_={'qty': table.c.qty + stmt.excluded.qty},
+    )
+
+
+def apply_balance_deltas(deltas, model=StockBalance, check_negative=False):
+    """Add ``{(product_id, location_id): delta}`` to a per-cell balance table.
+
+    Defaults to the materialized stock balances. With ``check_negative``
+    each decrease is a conditional UPDATE that only applies while the
+    balance covers it, so the check and the write are one atomic statement
+    that locks only that balance row. Returns the cells whose decrease did
+    not apply; the caller must then roll back, since other deltas may have.
+
+    Runs inside the caller's transaction; nothing is committed here.
+    """
+    shortfalls = []
+    increases = []
+    for (product_id, location_id), delta in deltas.items():
+        if not delta:
+            continue
+        if delta > 0 or not check_negative:
+            increases.append({'product_id': product_id, 'location_id': location_id, 'qty': delta})
+            continue
+
+        applied = db.session.execute(
+            update(model)
+            .where(model.product_id == product_id, model.location_id == location_id,
+                   model.qty >= -delta)
+            .values(qty=model.qty + delta)
+            .execution_options(synchronize_session=False)
+        )
+        if applied.rowcount != 1:
+            shortfalls.append((product_id, location_id))
+
+    if increases and not shortfalls:
+        db.session.execute(_upsert_statement(model), increases)
+
+    return shortfalls
+
+
+def available_stock(product_id, location_id):
+    """Current materialized balance of one cell, 0 when it has none."""
+    return db.session.scalar(
+        select(StockBalance.qty)
+        .where(StockBalance.product_id == product_id, StockBalance.location_id == location_id)
+    ) or 0
+
+
+def rebuild_stock_balances(check_only=False, workers=1):
+    """Recompute ``stock_balance`` from the movement log.
+
+    Returns the drift found between the stored and recomputed values as a
+    list of ``(product_id, location_id, stored_qty, computed_qty)`` tuples.
+    Unless ``check_only`` is set, the table is then replaced with the
+    recomputed balances and committed, and the corrections are logged as a
+    change event. With more than one worker the balances come from
+    parallel_compute_balances().
+
+    A rebuild deletes the old rows before computing, so it holds the write
+    lock while the workers read and they all see the state it replaces. A
+    check takes no lock; with writes going on, its workers may read
+    slightly different points in time and report drift that is not there.
+    """
+    stored = {
+        (row.product_id, row.location_id): row.qty
+        for row in db.session.execute(stored_balance_query())
+    }
+    if not check_only:
+        db.session.execute(delete(StockBalance))
+    computed = {(row.product_id, row.location_id): row.qty
+                for row in parallel_compute_balances(workers)}
+
+    drift = []
+    for product_id, location_id in sorted(computed.keys() | stored.keys()):
+        stored_qty = stored.get((product_id, location_id), 0)
+        computed_qty = computed.get((product_id, location_id), 0)
+        if stored_qty != computed_qty:
+            drift.append((product_id, location_id, stored_qty, computed_qty))
+
+    if not check_only:
+        if computed:
+            db.session.execute(insert(StockBalance.__table__), [
+                {'product_id': product_id, 'location_id': location_id, 'qty': qty}
+                for (product_id, location_id), qty in computed.items()
+            ])
+        if drift:
+            record_event('rebuild', {(product_id, location_id): computed_qty - stored_qty
+                                     for product_id, location_id, stored_qty, computed_qty in drift})
+        db.session.commit()
+
+    return drift
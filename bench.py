@@ -0,0 +1,586 @@
+"""
+Benchmark harness for the inventory app.
+
+Drives the read and write routes through the Flask test client against the
+database in DATABASE_URL (build one with ``flask generate-data``), and
+records per scenario the p50/p95/p99 latency, the SQL statements per
+request and the process's peak RSS. Results can be saved as a baseline and
+later runs compared against it; a scenario regresses when its p95 grows by
+more than the tolerance (and by at least a few milliseconds, so fast routes
+are not flagged for noise) or it runs more statements than before.
+
+``--stock-stress`` runs threads that withdraw concurrently from one shared
+stock cell and from cells of their own, checking that no balance goes
+negative, and reports write throughput per thread count.
+
+``--concurrency`` instead runs reader and writer processes against copies
+of the database for each engine profile (see db_profile.py) and reports the
+read and write throughput and "database is locked" failures of each.
+
+``--render`` compares large list pages rendered in full with the same
+pages served from their cached fragments, and template compilation with
+loading from the bytecode cache.
+
+``--parallel-balances`` times the balance computation in one process and
+split across worker processes by movement id range, checking that every
+worker count gives the single-process result.
+
+``--startup`` times a cold import of the app and a ``gunicorn --preload``
+boot: how long until every worker has forked and the first request is
+answered, and the memory the workers take. ``--target`` and ``--cwd``
+point it at another checkout to compare.
+
+Run with:
+    python bench.py --requests 50 --save-baseline bench_baseline.json
+    python bench.py --requests 50 --baseline bench_baseline.json
+    python bench.py --stock-stress --threads 1,2,4,8 --seconds 5
+    python bench.py --concurrency --readers 4 --writers 4 --seconds 10
+    python bench.py --render --requests 5
+    python bench.py --parallel-balances --balance-workers 1,2,4,8
+    python bench.py --startup --workers 8
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from sqlalchemy import func, select
+
+from app import create_app
+from models import db, Product, Location, ProductMovement, StockBalance
+from balances import compute_balances, parallel_compute_balances, rebuild_stock_balances
+from cache import cache
+from ledger import encode_cursor
+from metrics import metrics
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def scenarios(app):
+    """Return ``{name: request factory}``; each factory returns (method, url, data)."""
+    with app.app_context():
+        product_id = db.session.scalar(select(func.min(Product.product_id)))
+        location_id = db.session.scalar(select(func.min(Location.location_id)))
+        newest = db.session.scalars(
+            select(ProductMovement)
+            .order_by(ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc())
+            .limit(1)
+        ).first()
+        cursor = encode_cursor(newest) if newest else ''
+        as_of = newest.timestamp.date().isoformat() if newest else ''
+
+    movement = {'product_id': product_id, 'to_location': location_id, 'qty': 1}
+
+    def added_movement_id():
+        with app.app_context():
+            return db.session.scalar(select(func.max(ProductMovement.movement_id)))
+
+    return {
+        'index': lambda: ('GET', '/', None),
+        'products': lambda: ('GET', '/products', None),
+        'locations': lambda: ('GET', '/locations', None),
+        'movements': lambda: ('GET', '/movements', None),
+        'movements_page_2': lambda: ('GET', f'/movements?cursor={cursor}', None),
+        'movements_filtered': lambda: ('GET', f'/movements?product_id={product_id}', None),
+        'reports': lambda: ('GET', '/reports', None),
+        'reports_as_of': lambda: ('GET', f'/reports?as_of={as_of}', None),
+        'add_movement': lambda: ('POST', '/movements/add', movement),
+        'edit_movement': lambda: ('POST', f'/movements/edit/{added_movement_id()}', movement),
+        'delete_movement': lambda: ('POST', f'/movements/delete/{added_movement_id()}', None),
+        'add_product': lambda: ('POST', '/products/add', {'name': 'Benchmark product'}),
+    }
+
+
+def run_benchmarks(app, requests=50, names=None, use_cache=False):
+    """Run each scenario ``requests`` times and return ``{name: stats}``.
+
+    The page and fragment caches are off unless ``use_cache`` is set, so
+    reads measure rendering rather than cache hits. Writes run in the order listed, so the
+    edit and delete scenarios act on movements added by ``add_movement``.
+    """
+    cache.enabled = cache.fragments_enabled = use_cache
+    metrics.query_header = True
+    results = {}
+
+    try:
+        for name, make_request in scenarios(app).items():
+            if names and name not in names:
+                continue
+
+            # Warm up reads so the first request's template compilation is not measured
+            if make_request()[0] == 'GET':
+                app.test_client().open(make_request()[1])
+
+            latencies = []
+            queries = []
+            for _ in range(requests):
+                method, url, data = make_request()
+                # A fresh client per request keeps flashed messages from piling up
+                client = app.test_client()
+                started = time.perf_counter()
+                response = client.open(url, method=method, data=data)
+                latencies.append(time.perf_counter() - started)
+                queries.append(int(response.headers.get('X-Query-Count', 0)))
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{name}: {method} {url} returned {response.status_code}')
+
+            results[name] = {
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                'queries': max(queries),
+                'peak_rss_mb': round(peak_rss_mb(), 1),
+            }
+    finally:
+        cache.enabled = app.config['CACHE_ENABLED']
+        cache.fragments_enabled = app.config['CACHE_ENABLED'] and app.config['CACHE_FRAGMENTS']
+        metrics.query_header = app.config['METRICS_QUERY_HEADER']
+
+    return results
+
+
+def run_render(app, urls=('/products', '/locations', '/movements?per_page=500'), requests=5):
+    """Time large list pages rendered in full and from their cached fragments.
+
+    The page cache stays off throughout, as for a response carrying a
+    flashed message or after a write to an unrelated table. Returns
+    ``{url: {full_ms, fragment_ms, kb}}`` with median times, plus the
+    milliseconds to load every template into a fresh environment with and
+    without the bytecode cache under ``"templates"``.
+    """
+    results = {}
+    cache.enabled = False
+    client = app.test_client()
+    try:
+        for url in urls:
+            timings = {}
+            for fragments in (False, True):
+                cache.fragments_enabled = fragments
+                # Warm up: compile the templates and, with fragments on, fill the cache
+                size = len(client.get(url).data)
+                latencies = []
+                for _ in range(requests):
+                    started = time.perf_counter()
+                    client.get(url)
+                    latencies.append(time.perf_counter() - started)
+                timings['fragment_ms' if fragments else 'full_ms'] = round(
+                    statistics.median(latencies) * 1000, 1)
+            results[url] = dict(timings, kb=round(size / 1024))
+    finally:
+        cache.enabled = app.config['CACHE_ENABLED']
+        cache.fragments_enabled = app.config['CACHE_ENABLED'] and app.config['CACHE_FRAGMENTS']
+
+    def load_all(environment):
+        started = time.perf_counter()
+        for name in environment.list_templates(extensions=['html']):
+            environment.get_template(name)
+        return round((time.perf_counter() - started) * 1000, 1)
+
+    uncached = app.create_jinja_environment()
+    uncached.bytecode_cache = None
+    # The first environment fills the bytecode cache, as the first worker would
+    load_all(app.create_jinja_environment())
+    loads = {'compile_ms': load_all(uncached), 'bytecode_ms': load_all(app.create_jinja_environment())}
+    results['templates'] = loads
+    return results
+
+
+def run_parallel_balances(app, worker_counts=(1, 2, 4), runs=3):
+    """Time compute_balances() against parallel_compute_balances() per worker count.
+
+    Returns ``{workers: {seconds, speedup, matches}}`` with median times;
+    workers 0 is the plain single-process query.
+    """
+    def timed(compute):
+        timings, rows = [], None
+        for _ in range(runs):
+            started = time.perf_counter()
+            rows = compute()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings), rows
+
+    results = {}
+    with app.app_context():
+        serial_s, serial = timed(compute_balances)
+        results[0] = {'seconds': round(serial_s, 2), 'speedup': 1.0, 'matches': True}
+        for workers in worker_counts:
+            seconds, rows = timed(lambda: parallel_compute_balances(workers))
+            results[workers] = {'seconds': round(seconds, 2), 'speedup': round(serial_s / seconds, 2),
+                                'matches': rows == serial}
+    return results
+
+
+def compare(results, baseline, tolerance=0.25, min_delta_ms=5):
+    """Return regression messages for ``results`` against a saved baseline."""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        limit = max(previous['p95_ms'] * (1 + tolerance), previous['p95_ms'] + min_delta_ms)
+        if current['p95_ms'] > limit:
+            regressions.append(f'{name}: p95 {current["p95_ms"]}ms, baseline {previous["p95_ms"]}ms')
+        if current['queries'] > previous['queries']:
+            regressions.append(f'{name}: {current["queries"]} queries, baseline {previous["queries"]}')
+    return regressions
+
+
+def run_stock_stress(app, threads=4, seconds=5, hot_stock=100):
+    """Withdraw stock from many threads at once and check no balance goes negative.
+
+    Every thread tries to take one unit at a time from a shared "hot" cell
+    holding ``hot_stock`` units, and moves stock back and forth between two
+    locations for a product of its own. A monitor thread samples the
+    balances meanwhile. Returns counts of accepted and rejected writes, the
+    lowest balance seen and the stock balance drift afterwards.
+    """
+    with app.app_context():
+        from_location, to_location = db.session.scalars(
+            select(Location.location_id).order_by(Location.location_id).limit(2)).all()
+        products = [Product(name=f'Stress product {index}') for index in range(threads + 1)]
+        db.session.add_all(products)
+        db.session.commit()
+        product_ids = [product.product_id for product in products]
+        hot_product, own_products = product_ids[0], product_ids[1:]
+
+        # Seed through the route too, in this context so the requests get fresh transactions
+        client = app.test_client()
+        client.post('/movements/add', data={'product_id': hot_product, 'to_location': from_location,
+                                            'qty': hot_stock})
+        for product_id in own_products:
+            client.post('/movements/add', data={'product_id': product_id,
+                                                'to_location': from_location, 'qty': 10})
+
+    counts = {'hot_taken': 0, 'hot_rejected': 0, 'own_moves': 0}
+    lowest = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+    stop = threading.Event()
+
+    def worker(product_id):
+        client = app.test_client()
+        route = [from_location, to_location]
+        while time.perf_counter() < deadline:
+            response = client.post('/movements/add', data={'product_id': hot_product,
+                                                           'from_location': from_location,
+                                                           'qty': 1})
+            with client.session_transaction() as session:
+                rejected = any('Not enough stock' in message
+                               for _, message in session.pop('_flashes', []))
+            with lock:
+                counts['hot_rejected' if rejected else 'hot_taken'] += 1
+
+            # Unrelated cells: move all ten units to the other location and back
+            client.post('/movements/add', data={'product_id': product_id, 'from_location': route[0],
+                                                'to_location': route[1], 'qty': 10})
+            route.reverse()
+            with lock:
+                counts['own_moves'] += 1
+
+    def monitor():
+        while not stop.is_set():
+            with app.app_context():
+                low = db.session.scalar(select(func.min(StockBalance.qty))
+                                        .where(StockBalance.product_id.in_(product_ids)))
+            lowest[0] = min(lowest[0], low or 0)
+            time.sleep(0.01)
+
+    watcher = threading.Thread(target=monitor)
+    watcher.start()
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(product_id,)) for product_id in own_products]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    watcher.join()
+
+    with app.app_context():
+        hot_balance = db.session.scalar(select(StockBalance.qty).where(
+            StockBalance.product_id == hot_product, StockBalance.location_id == from_location))
+        drift = rebuild_stock_balances(check_only=True)
+
+    writes = counts['hot_taken'] + counts['hot_rejected'] + counts['own_moves']
+    return dict(counts, hot_balance=hot_balance, lowest_balance=lowest[0], drift=len(drift),
+                writes_per_s=round(writes / elapsed, 1))
+
+
+def _load_worker(role, seconds, seed, results):
+    """Issue reads or writes in a loop for ``seconds``; runs in its own process."""
+    app = create_app({'PROPAGATE_EXCEPTIONS': True})
+    cache.enabled = cache.fragments_enabled = False
+    rng = random.Random(seed)
+    with app.app_context():
+        product_ids = list(db.session.scalars(select(Product.product_id)))
+        location_ids = list(db.session.scalars(select(Location.location_id)))
+
+    done = locked = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        client = app.test_client()
+        try:
+            if role == 'read':
+                client.get(f'/movements?product_id={rng.choice(product_ids)}')
+            else:
+                client.post('/movements/add', data={'product_id': rng.choice(product_ids),
+                                                    'to_location': rng.choice(location_ids),
+                                                    'qty': 1})
+            done += 1
+        except Exception as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+    results.put((role, done, locked))
+
+
+def run_concurrency(app, profile, readers=4, writers=4, seconds=10):
+    """Run concurrent readers and writers on a copy of the database under ``profile``.
+
+    Returns operations per second for each role and the number of
+    "database is locked" failures.
+    """
+    with app.app_context():
+        source = db.engine.url.database
+
+    workdir = tempfile.mkdtemp()
+    copy = os.path.join(workdir, 'bench.db')
+    with sqlite3.connect(source) as src, sqlite3.connect(copy) as dst:
+        src.backup(dst)
+        # The journal mode is stored in the file; start each profile from the stock one
+        dst.execute('PRAGMA journal_mode=DELETE')
+
+    # Worker processes create their own app, which reads these
+    os.environ['DATABASE_URL'] = f'sqlite:///{copy}'
+    os.environ['DB_PROFILE'] = profile
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    roles = ['read'] * readers + ['write'] * writers
+    workers = [context.Process(target=_load_worker, args=(role, seconds, index, results))
+               for index, role in enumerate(roles)]
+    for worker in workers:
+        worker.start()
+    totals = {'read': 0, 'write': 0, 'locked': 0}
+    for _ in workers:
+        role, done, locked = results.get()
+        totals[role] += done
+        totals['locked'] += locked
+    for worker in workers:
+        worker.join()
+
+    return {
+        'reads_per_s': round(totals['read'] / seconds, 1),
+        'writes_per_s': round(totals['write'] / seconds, 1),
+        'locked_errors': totals['locked'],
+    }
+
+
+def _pss_mb(pid):
+    # Proportional set size: pages shared after fork count once across processes
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_startup(target='app:create_app()', workers=8, runs=5, cwd=None, timeout=120):
+    """Time app startup in a fresh interpreter and under ``gunicorn --preload``.
+
+    ``target`` is a gunicorn app spec (``module:variable`` or
+    ``module:factory()``), run from ``cwd``, so an older checkout can be
+    measured the same way. Returns the median seconds to start Python,
+    import the module and build the app; the seconds from launching
+    gunicorn until all ``workers`` have booted and until the first response;
+    and the memory of the master and workers, counting shared pages once.
+    """
+    module, _, expression = target.partition(':')
+    code = f'import {module}; {module}.{expression}'
+    imports = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True)
+        imports.append(time.perf_counter() - started)
+
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--preload', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+         '--log-level', 'info', target],
+        cwd=cwd, stderr=subprocess.PIPE, text=True)
+    booted = []
+    watcher = threading.Thread(target=lambda: booted.extend(
+        time.perf_counter() for line in server.stderr if 'Booting worker' in line), daemon=True)
+    watcher.start()
+
+    try:
+        first_response = None
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with status {server.returncode}')
+            if first_response is None:
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=timeout) as response:
+                        response.read()
+                    first_response = time.perf_counter() - started
+                except OSError:
+                    pass
+            if first_response is not None and len(booted) >= workers:
+                break
+            time.sleep(0.02)
+        else:
+            raise RuntimeError(f'gunicorn not ready after {timeout}s')
+
+        with open(f'/proc/{server.pid}/task/{server.pid}/children') as f:
+            children = [int(pid) for pid in f.read().split()]
+        memory = sum(_pss_mb(pid) for pid in [server.pid, *children])
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'import_s': round(statistics.median(imports), 3),
+        'workers_booted_s': round(booted[workers - 1] - started, 3),
+        'first_response_s': round(first_response, 3),
+        'pss_mb': round(memory, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50, help='Requests per scenario.')
+    parser.add_argument('--scenario', action='append', help='Only run this scenario (repeatable).')
+    parser.add_argument('--cache', action='store_true', help='Leave the page cache enabled.')
+    parser.add_argument('--baseline', help='Compare against this baseline JSON file.')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed p95 growth over the baseline (0.25 = 25%%).')
+    parser.add_argument('--min-delta-ms', type=float, default=5,
+                        help='p95 growth below this many milliseconds is never a regression.')
+    parser.add_argument('--stock-stress', action='store_true',
+                        help='Withdraw stock from concurrent threads and check for negative balances.')
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help='Comma-separated thread counts (--stock-stress).')
+    parser.add_argument('--concurrency', action='store_true',
+                        help='Compare engine profiles under concurrent readers and writers.')
+    parser.add_argument('--readers', type=int, default=4, help='Reader processes (--concurrency).')
+    parser.add_argument('--writers', type=int, default=4, help='Writer processes (--concurrency).')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration per profile (--concurrency).')
+    parser.add_argument('--render', action='store_true',
+                        help='Time large list pages rendered in full and from cached fragments.')
+    parser.add_argument('--parallel-balances', action='store_true',
+                        help='Time the balance computation split across worker processes.')
+    parser.add_argument('--balance-workers', default='1,2,4',
+                        help='Comma-separated worker counts (--parallel-balances).')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per worker count (--parallel-balances).')
+    parser.add_argument('--startup', action='store_true',
+                        help='Time a cold start and a gunicorn --preload boot.')
+    parser.add_argument('--workers', type=int, default=8, help='Gunicorn workers (--startup).')
+    parser.add_argument('--target', default='app:create_app()', help='Gunicorn app spec (--startup).')
+    parser.add_argument('--cwd', help='Checkout to run the target from (--startup).')
+    args = parser.parse_args()
+
+    if args.startup:
+        stats = run_startup(args.target, args.workers, cwd=args.cwd)
+        print(f'{"import s":>9} {"booted s":>9} {"first s":>9} {"PSS MB":>8}')
+        print(f'{stats["import_s"]:>9} {stats["workers_booted_s"]:>9} {stats["first_response_s"]:>9} '
+              f'{stats["pss_mb"]:>8}')
+        return
+
+    app = create_app()
+
+    if args.render:
+        results = run_render(app, requests=args.requests)
+        templates = results.pop('templates')
+        print(f'{"page":<28} {"full ms":>9} {"fragment ms":>12} {"KB":>8}')
+        for url, stats in results.items():
+            print(f'{url:<28} {stats["full_ms"]:>9} {stats["fragment_ms"]:>12} {stats["kb"]:>8}')
+        print(f'\nLoading every template: {templates["compile_ms"]} ms compiled, '
+              f'{templates["bytecode_ms"]} ms from the bytecode cache')
+        return
+
+    if args.parallel_balances:
+        counts = [int(count) for count in args.balance_workers.split(',')]
+        results = run_parallel_balances(app, counts, args.runs)
+        print(f'{"workers":>7} {"seconds":>9} {"speedup":>8} {"matches":>8}')
+        for workers, stats in results.items():
+            print(f'{workers or "query":>7} {stats["seconds"]:>9} {stats["speedup"]:>8} '
+                  f'{str(stats["matches"]):>8}')
+        if not all(stats['matches'] for stats in results.values()):
+            sys.exit(1)
+        return
+
+    if args.stock_stress:
+        print(f'{"threads":>7} {"writes/s":>9} {"taken":>6} {"rejected":>8} {"lowest":>7} {"drift":>6}')
+        for threads in (int(count) for count in args.threads.split(',')):
+            stats = run_stock_stress(app, threads, args.seconds)
+            print(f'{threads:>7} {stats["writes_per_s"]:>9} {stats["hot_taken"]:>6} '
+                  f'{stats["hot_rejected"]:>8} {stats["lowest_balance"]:>7} {stats["drift"]:>6}')
+            if stats['lowest_balance'] < 0 or stats['drift']:
+                sys.exit(1)
+        return
+
+    if args.concurrency:
+        print(f'{"profile":<12} {"reads/s":>9} {"writes/s":>9} {"locked":>8}')
+        for profile in ('default', 'production'):
+            stats = run_concurrency(app, profile, args.readers, args.writers, args.seconds)
+            print(f'{profile:<12} {stats["reads_per_s"]:>9} {stats["writes_per_s"]:>9} '
+                  f'{stats["locked_errors"]:>8}')
+        return
+
+    results = run_benchmarks(app, args.requests, args.scenario, args.cache)
+
+    print(f'{"scenario":<20} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"rss MB":>8}')
+    for name, stats in results.items():
+        print(f'{name:<20} {stats["p50_ms"]:>9} {stats["p95_ms"]:>9} {stats["p99_ms"]:>9} '
+              f'{stats["queries"]:>8} {stats["peak_rss_mb"]:>8}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'\nBaseline saved to {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print('\nRegressions:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('\nNo regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
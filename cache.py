@@ -0,0 +1,326 @@
+"""
+Versioned page cache.
+
+Rendered pages are cached under a key that includes a global data-version
+counter. Write routes bump the counter after they commit, so every cached
+page becomes unreachable at once and no per-page invalidation is needed.
+The same version drives the ETag and Last-Modified headers, letting
+browsers and proxies revalidate with a 304 instead of a re-render.
+
+Entries live in an in-process LRU with a TTL. The version counters must
+be the same in every worker process, and CLI commands bump them too, so
+they are kept where all of them see it: in the ``cache_version`` table,
+read from the primary once per request. A shared backend with a
+Redis-like ``get``/``set``/``incr`` interface can be configured with
+CACHE_BACKEND instead; it then holds the counters and a second cache tier.
+
+List pages also cache their tables as fragments, keyed on a version per
+table instead of the global one: bump_version('locations') re-renders
+the pages that show locations but leaves the products table cached, and
+a fragment still serves the pages the page cache skips (those carrying a
+flashed message). Compiled templates are kept on disk in
+TEMPLATE_CACHE_DIR, so a fresh worker loads bytecode instead of
+recompiling every template.
+
+A request that read from a replica (see replication.py) caches under the
+replica's position as well, so markup rendered from a lagging replica is
+never served as current.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+from flask import g, has_request_context, make_response, request, session
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, CacheVersion
+
+
+VERSION_KEY = 'inventory:data_version'
+VERSION_TIME_KEY = 'inventory:data_version_at'
+TABLE_VERSION_KEY = 'inventory:table_version:{}'
+
+# Tables with their own fragment version; bump_version() with no names bumps all
+TABLES = ('products', 'locations', 'movements')
+
+# Name of the global version among the database counters
+DATA_VERSION = 'data'
+
+
+class DatabaseVersions:
+    """Version counters in the ``cache_version`` table.
+
+    read() returns ``{name: (version, updated_at)}``. Inside a request the
+    table is read once, on the primary, and kept for the rest of it.
+    """
+
+    _REQUEST_KEY = 'inventory.cache_versions'
+
+    def read(self):
+        if has_request_context() and self._REQUEST_KEY in request.environ:
+            return request.environ[self._REQUEST_KEY]
+
+        version = CacheVersion.__table__
+        with db.engines[None].connect() as connection:
+            versions = {name: (number, updated_at) for name, number, updated_at in connection.execute(
+                select(version.c.name, version.c.version, version.c.updated_at))}
+        if has_request_context():
+            request.environ[self._REQUEST_KEY] = versions
+        return versions
+
+    def bump(self, names):
+        engine = db.engines[None]
+        insert_ = postgresql.insert if engine.dialect.name == 'postgresql' else sqlite.insert
+        version = CacheVersion.__table__
+        now = datetime.utcnow()
+        stmt = insert_(version).values([{'name': name, 'version': 1, 'updated_at': now} for name in names])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'version': version.c.version + 1, 'updated_at': stmt.excluded.updated_at})
+        with engine.begin() as connection:
+            connection.execute(stmt)
+        if has_request_context():
+            request.environ.pop(self._REQUEST_KEY, None)
+
+
+class BackendVersions:
+    """Version counters kept in a shared CACHE_BACKEND."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def read(self):
+        versions = {table: (int(_text(self.backend.get(TABLE_VERSION_KEY.format(table))) or 0), None)
+                    for table in TABLES}
+        stamp = _text(self.backend.get(VERSION_TIME_KEY))
+        versions[DATA_VERSION] = (int(_text(self.backend.get(VERSION_KEY)) or 0),
+                                  datetime.utcfromtimestamp(float(stamp)) if stamp else None)
+        return versions
+
+    def bump(self, names):
+        for name in names:
+            if name != DATA_VERSION:
+                self.backend.incr(TABLE_VERSION_KEY.format(name))
+        self.backend.set(VERSION_TIME_KEY, str(time.time()))
+        self.backend.incr(VERSION_KEY)
+
+
+class LRUCache:
+    """Thread-safe LRU mapping whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _read_source():
+    # Set by replication.route_reads() when the request reads from a replica
+    return g.get('read_source', 'primary') if has_request_context() else 'primary'
+
+
+class ViewCache:
+    """Page cache keyed on the global data version."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.fragments_enabled = False
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_ENABLED', True)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 256)
+        app.config.setdefault('CACHE_TTL', 300)
+        app.config.setdefault('CACHE_BACKEND', None)
+        app.config.setdefault('CACHE_FRAGMENTS', True)
+        app.config.setdefault('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja'))
+
+        self.enabled = app.config['CACHE_ENABLED']
+        self.fragments_enabled = app.config['CACHE_ENABLED'] and app.config['CACHE_FRAGMENTS']
+        self.local = LRUCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'])
+        self.shared = app.config['CACHE_BACKEND']
+        self.versions = BackendVersions(self.shared) if self.shared is not None else DatabaseVersions()
+        self.ttl = app.config['CACHE_TTL']
+        self._started_at = time.time()
+        app.extensions['view_cache'] = self
+
+        # Read when the Jinja environment is first created, so set it now
+        if app.config['TEMPLATE_CACHE_DIR']:
+            os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+            app.jinja_options = {**app.jinja_options,
+                                 'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])}
+
+    def data_version(self):
+        return self.versions.read().get(DATA_VERSION, (0, None))[0]
+
+    def last_modified(self):
+        updated_at = self.versions.read().get(DATA_VERSION, (0, None))[1]
+        if updated_at is None:
+            return datetime.fromtimestamp(self._started_at, timezone.utc)
+        return updated_at.replace(tzinfo=timezone.utc)
+
+    def table_versions(self, tables):
+        versions = self.versions.read()
+        return [versions.get(table, (0, None))[0] for table in tables]
+
+    def bump_version(self, *tables):
+        """Invalidate every cached page. Call after committing a write.
+
+        Fragments are only invalidated for the ``tables`` written (see
+        TABLES), or for all of them when none are named. Every worker
+        process sees the new versions on its next request.
+        """
+        self.versions.bump([*(tables or TABLES), DATA_VERSION])
+
+    def _load(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = _text(self.shared.get(key))
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def get(self, key):
+        value = self._load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, ex=self.ttl)
+
+    def fragment(self, name, tables, params, render):
+        """Markup of fragment ``name`` for ``params``, from the cache or ``render()``.
+
+        ``tables`` are the tables the fragment shows rows of; the key
+        includes their versions, so a write to any of them re-renders it.
+        """
+        if not self.fragments_enabled:
+            return Markup(render())
+
+        versions = '.'.join(str(version) for version in self.table_versions(tables))
+        digest = hashlib.sha1(repr(params).encode()).hexdigest()
+        key = f'fragment:{name}:{versions}:{_read_source()}:{digest}'
+        body = self._load(key)
+        if body is None:
+            self.fragment_misses += 1
+            body = render()
+            self.set(key, body)
+        else:
+            self.fragment_hits += 1
+        return Markup(body)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'fragment_hits': self.fragment_hits,
+            'fragment_misses': self.fragment_misses,
+            'entries': len(self.local),
+            'data_version': self.data_version(),
+        }
+
+
+cache = ViewCache()
+
+
+def cached_view(view=None, *, period=None):
+    """Serve a GET view from the page cache with ETag/Last-Modified validation.
+
+    Responses carrying flashed messages are never cached or validated, since
+    the messages are consumed by the render. For a view whose output also
+    depends on the current time, ``period`` (a timedelta) adds the start of
+    the current period to the key, so the cached page, its ETag and its
+    Last-Modified move on at every period boundary.
+    """
+    if view is None:
+        return lambda view: cached_view(view, period=period)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not cache.enabled or request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        version = cache.data_version()
+        key = f'view:{version}:{_read_source()}:{request.full_path}'
+        last_modified = cache.last_modified()
+        if period is not None:
+            seconds = period.total_seconds()
+            period_start = datetime.fromtimestamp(time.time() // seconds * seconds, timezone.utc)
+            key += f':{period_start.timestamp():.0f}'
+            last_modified = max(last_modified, period_start)
+        etag = hashlib.sha1(key.encode()).hexdigest()
+
+        if request.if_none_match:
+            fresh = etag in request.if_none_match
+        else:
+            # HTTP dates have one-second resolution
+            fresh = (request.if_modified_since is not None
+                     and request.if_modified_since >= last_modified.replace(microsecond=0))
+
+        if fresh:
+            cache.not_modified += 1
+            response = make_response('', 304)
+        else:
+            body = cache.get(key)
+            if body is None:
+                body = view(*args, **kwargs)
+                if not isinstance(body, str):
+                    return body
+                cache.set(key, body)
+            response = make_response(body)
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
@@ -0,0 +1,98 @@
+"""
+Change feed of movement events.
+
+Every write to the movement ledger appends a ``movement_event`` row in the
+same transaction, with the net stock balance deltas it caused:
+
+- record_change() appends one for a create, edit or delete;
+- record_inserts() appends one per batch or import batch;
+- rebuild_stock_balances() appends its corrections when it finds drift.
+
+Balances read at feed position N plus the deltas of every event after N
+are therefore the current balances. A dashboard can keep its view current
+from the feed instead of re-running the reports. ``/api/v1/balances``
+reports the position it was read at, in the same transaction.
+
+Clients follow the feed by sequence number, either with
+``/api/v1/changes?since=<seq>`` or as server-sent events from
+``/api/v1/changes/stream``. Sequence numbers follow commit order on
+SQLite, which runs one write transaction at a time. On a database with
+concurrent writers, an event can commit after a later-numbered one has
+already been read.
+
+Readers never hold anything a writer waits on. Each poll is one short
+read, and the stream releases its connection before handing events to the
+client, so a consumer that stops reading only stalls its own response.
+
+prune_events() drops old events but always keeps the newest. A client
+whose ``since`` is before the oldest kept event has missed changes and
+must reload the balances; the API reports that as 410 Gone.
+"""
+
+import json
+from datetime import datetime
+from sqlalchemy import delete, func, insert, select
+from models import db, MovementEvent
+
+
+KINDS = ('create', 'edit', 'delete', 'batch', 'rebuild')
+
+_events = MovementEvent.__table__
+
+
+def record_event(kind, deltas, movement_id=None):
+    """Append an event with ``{(product_id, location_id): delta}``. Does not commit."""
+    rows = [[product_id, location_id, delta]
+            for (product_id, location_id), delta in sorted(deltas.items()) if delta]
+    db.session.execute(insert(_events).values(
+        kind=kind, movement_id=movement_id, created_at=datetime.utcnow(),
+        deltas=json.dumps(rows, separators=(',', ':'))))
+
+
+def latest_seq():
+    """Sequence number of the newest event, 0 before the first."""
+    return db.session.scalar(select(func.max(_events.c.seq))) or 0
+
+
+def event_as_dict(row):
+    return {
+        'seq': row.seq,
+        'kind': row.kind,
+        'movement_id': row.movement_id,
+        'created_at': row.created_at.isoformat(),
+        'deltas': [{'product_id': product_id, 'location_id': location_id, 'delta': delta}
+                   for product_id, location_id, delta in json.loads(row.deltas)],
+    }
+
+
+def read_events(since, limit):
+    """Up to ``limit`` events after ``since``, oldest first.
+
+    Returns ``(events, missed)``; ``missed`` is True, with no events, when
+    events after ``since`` have been pruned.
+    """
+    oldest = db.session.scalar(select(func.min(_events.c.seq)))
+    if oldest is not None and since < oldest - 1:
+        return [], True
+
+    rows = db.session.execute(
+        select(_events.c.seq, _events.c.kind, _events.c.movement_id,
+               _events.c.created_at, _events.c.deltas)
+        .where(_events.c.seq > since)
+        .order_by(_events.c.seq)
+        .limit(limit)
+    )
+    return [event_as_dict(row) for row in rows], False
+
+
+def prune_events(before):
+    """Delete events created before ``before``, keeping the newest, and commit.
+
+    Returns the number deleted.
+    """
+    newest = latest_seq()
+    deleted = db.session.execute(
+        delete(_events).where(_events.c.created_at < before, _events.c.seq < newest)
+    ).rowcount
+    db.session.commit()
+    return deleted
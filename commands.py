@@ -0,0 +1,333 @@
+"""
+Command line interface, registered on the app as ``flask <command>``.
+
+The schema is only created or upgraded by ``flask init-db``, and sample
+data only added by ``flask seed`` (or ``init-db --seed``); starting the
+app never touches either, so workers boot without a round of DDL.
+
+Commands that write run their transactions with BEGIN IMMEDIATE, like
+write requests, so they cannot fail on a lock upgrade when the web app
+commits while they are reading.
+"""
+
+import time
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, inspect
+from sqlalchemy.schema import CreateColumn
+from models import db, Product, Location, ProductMovement, StockBalance, HourlyMovementRollup
+from db_profile import REPLICA_BIND, immediate_transactions
+from archive import archive_movements, verify_archive
+from balances import rebuild_stock_balances
+from cache import cache
+from changefeed import prune_events
+from datagen import generate_dataset
+from importer import FORMATS, detect_format, import_movements, iter_rows
+from replication import ensure_heartbeat, replicate_sqlite
+from rollups import rebuild_rollups
+from search import install_search_indexes
+from snapshots import take_snapshots
+
+
+def create_schema():
+    """Create missing tables, indexes and search indexes, and backfill derived tables.
+
+    Safe to run against an existing database; this is how older databases
+    are upgraded.
+    """
+    # Only the primary; the other binds are read-only views of it or its replica
+    db.create_all(bind_key=None)
+    
+    # create_all() skips tables that already exist; add any columns and
+    # indexes they lack. Added columns are all nullable.
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                with db.engine.begin() as connection:
+                    connection.execute(DDL(f'ALTER TABLE {table.name} ADD COLUMN '
+                                           f'{CreateColumn(column).compile(db.engine)}'))
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    
+    # Full-text search tables and their sync triggers (SQLite with FTS5)
+    install_search_indexes(db.engine)
+    
+    # Materialize balances for databases created before stock_balance existed
+    if StockBalance.query.first() is None and ProductMovement.query.first() is not None:
+        rebuild_stock_balances()
+    
+    # Likewise for the movement rollups
+    if HourlyMovementRollup.query.first() is None and ProductMovement.query.first() is not None:
+        rebuild_rollups()
+    
+    ensure_heartbeat()
+    db.session.commit()
+
+
+def seed_sample_data():
+    """Add the sample products, locations and movements to an empty database.
+
+    Returns False, adding nothing, when there are products already.
+    """
+    if Product.query.first() is not None:
+        return False
+    
+    # Add sample products
+    products = [
+        Product(name='Laptop Dell XPS 15', description='High-performance laptop with 16GB RAM and 512GB SSD'),
+        Product(name='Wireless Mouse Logitech', description='Ergonomic wireless mouse with USB receiver'),
+        Product(name='USB-C Cable', description='2-meter USB-C charging and data cable'),
+        Product(name='Monitor Samsung 27"', description='27-inch 4K UHD monitor with HDR support')
+    ]
+    
+    for product in products:
+        db.session.add(product)
+    
+    # Add sample locations
+    locations = [
+        Location(name='Main Warehouse', address='123 Industrial Blvd, New York, NY 10001'),
+        Location(name='Retail Store Downtown', address='456 Main Street, New York, NY 10002'),
+        Location(name='Distribution Center East', address='789 Logistics Ave, Newark, NJ 07102'),
+        Location(name='Regional Hub West', address='321 Commerce Dr, Los Angeles, CA 90001')
+    ]
+    
+    for location in locations:
+        db.session.add(location)
+    
+    db.session.commit()
+    
+    # Add sample product movements
+    movements = [
+        # Initial stock arrivals (from_location = None means incoming)
+        ProductMovement(from_location=None, to_location=1, product_id=1, qty=50),
+        ProductMovement(from_location=None, to_location=1, product_id=2, qty=100),
+        ProductMovement(from_location=None, to_location=1, product_id=3, qty=200),
+        ProductMovement(from_location=None, to_location=1, product_id=4, qty=30),
+        
+        # Transfers between warehouses
+        ProductMovement(from_location=1, to_location=2, product_id=1, qty=10),
+        ProductMovement(from_location=1, to_location=3, product_id=1, qty=15),
+        ProductMovement(from_location=1, to_location=4, product_id=1, qty=5),
+        
+        ProductMovement(from_location=1, to_location=2, product_id=2, qty=25),
+        ProductMovement(from_location=1, to_location=3, product_id=2, qty=30),
+        ProductMovement(from_location=1, to_location=4, product_id=2, qty=15),
+        
+        ProductMovement(from_location=1, to_location=2, product_id=3, qty=50),
+        ProductMovement(from_location=1, to_location=3, product_id=3, qty=60),
+        ProductMovement(from_location=1, to_location=4, product_id=3, qty=40),
+        
+        ProductMovement(from_location=1, to_location=2, product_id=4, qty=8),
+        ProductMovement(from_location=1, to_location=3, product_id=4, qty=10),
+        
+        # Sales/outgoing (to_location = None means outgoing)
+        ProductMovement(from_location=2, to_location=None, product_id=1, qty=3),
+        ProductMovement(from_location=2, to_location=None, product_id=2, qty=10),
+        ProductMovement(from_location=3, to_location=None, product_id=3, qty=20),
+        ProductMovement(from_location=4, to_location=None, product_id=4, qty=2),
+        
+        # Additional restocking
+        ProductMovement(from_location=None, to_location=2, product_id=2, qty=50),
+    ]
+    
+    for movement in movements:
+        db.session.add(movement)
+    
+    db.session.commit()
+    
+    # The sample movements bypass record_change(); derive their state in one go
+    rebuild_stock_balances()
+    rebuild_rollups()
+    return True
+
+
+@click.command('init-db')
+@click.option('--seed', is_flag=True, help='Also add sample data to an empty database.')
+@with_appcontext
+@immediate_transactions()
+def init_db_command(seed):
+    """Create or upgrade the database schema."""
+    create_schema()
+    click.echo('Database schema is up to date.')
+    if seed:
+        click.get_current_context().invoke(seed_command)
+
+
+@click.command('seed')
+@with_appcontext
+@immediate_transactions()
+def seed_command():
+    """Add sample data to an empty database."""
+    if seed_sample_data():
+        cache.bump_version()
+        click.echo('Database initialized with sample data!')
+    else:
+        click.echo('Database already has products, no sample data added.')
+
+
+@click.command('import-movements')
+@click.argument('source', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per executemany batch.')
+@click.option('--defer-indexes', is_flag=True,
+              help='Drop movement indexes during the load and rebuild them afterwards.')
+@with_appcontext
+@immediate_transactions()
+def import_movements_command(source, fmt, batch_size, defer_indexes):
+    """Bulk import movements from a CSV or NDJSON file ('-' for stdin)."""
+    fmt = fmt or detect_format(source.name)
+    if fmt is None:
+        raise click.UsageError('Cannot tell the file format from its name, pass --format.')
+    
+    started = time.perf_counter()
+    result = import_movements(
+        iter_rows(source, fmt),
+        batch_size=batch_size,
+        defer_indexes=defer_indexes,
+        max_errors=0,
+        on_error=lambda line, message: click.echo(f'Line {line}: {message}', err=True),
+    )
+    cache.bump_version('movements')
+    elapsed = time.perf_counter() - started
+    
+    click.echo(f'Imported {result.inserted} movement(s) with {result.error_count} error(s) '
+               f'in {elapsed:.1f}s ({result.inserted / elapsed:,.0f} rows/s).')
+
+
+@click.command('generate-data')
+@click.option('--products', default=1000, show_default=True)
+@click.option('--locations', default=50, show_default=True)
+@click.option('--movements', default=100000, show_default=True)
+@click.option('--days', default=365, show_default=True, help='Days of history to spread movements over.')
+@click.option('--seed', default=42, show_default=True, help='Same seed and sizes, same data.')
+@with_appcontext
+@immediate_transactions()
+def generate_data_command(products, locations, movements, days, seed):
+    """Add a seeded synthetic dataset for load testing and benchmarks."""
+    started = time.perf_counter()
+    counts = generate_dataset(products=products, locations=locations, movements=movements,
+                              seed=seed, days=days, batch_size=current_app.config['IMPORT_BATCH_SIZE'])
+    cache.bump_version()
+    
+    click.echo(f'Added {counts["products"]} product(s), {counts["locations"]} location(s) and '
+               f'{counts["movements"]} movement(s) in {time.perf_counter() - started:.1f}s.')
+
+
+@click.command('snapshot-balances')
+@click.option('--until', type=click.DateTime(), help='Latest boundary to snapshot (default: now, UTC).')
+@with_appcontext
+@immediate_transactions()
+def snapshot_balances_command(until):
+    """Checkpoint balances at every snapshot interval boundary not yet taken."""
+    interval = timedelta(hours=current_app.config['SNAPSHOT_INTERVAL_HOURS'])
+    created = take_snapshots(interval=interval, until=until)
+    click.echo(f'Created {created} snapshot(s).')
+
+
+@click.command('rebuild-balances')
+@click.option('--check-only', is_flag=True, help='Report drift without rewriting the table.')
+@click.option('--workers', default=1, show_default=True,
+              help='Processes to split the computation across, by movement id range.')
+@with_appcontext
+def rebuild_balances_command(check_only, workers):
+    """Recompute stock balances from the movement log."""
+    with immediate_transactions(not check_only):
+        drift = rebuild_stock_balances(check_only=check_only, workers=workers)
+    if not check_only:
+        cache.bump_version()
+    
+    for product_id, location_id, stored_qty, computed_qty in drift:
+        click.echo(f'Drift: product {product_id} at location {location_id}: '
+                   f'stored {stored_qty}, computed {computed_qty}')
+    
+    if not drift:
+        click.echo('Stock balances match the movement log.')
+    elif check_only:
+        click.echo(f'{len(drift)} balance(s) out of sync.')
+        raise SystemExit(1)
+    else:
+        click.echo(f'Rebuilt stock balances, {len(drift)} balance(s) corrected.')
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+@immediate_transactions()
+def rebuild_rollups_command():
+    """Recompute the hourly and daily movement rollups from the ledger."""
+    started = time.perf_counter()
+    counts = rebuild_rollups()
+    cache.bump_version()
+    click.echo(f'Rebuilt {counts["hour"]} hourly and {counts["day"]} daily rollup row(s) '
+               f'in {time.perf_counter() - started:.1f}s.')
+
+
+@click.command('replicate')
+@click.option('--interval', type=float, help='Seconds between copies (default DB_REPLICA_SYNC_INTERVAL).')
+@click.option('--once', is_flag=True, help='Copy once and exit.')
+@with_appcontext
+def replicate_command(interval, once):
+    """Keep a SQLite replica in sync by copying the primary (a local stand-in)."""
+    if REPLICA_BIND not in db.engines:
+        raise click.UsageError('Set DB_REPLICA_URI (or DATABASE_REPLICA_URL) to a SQLite file first.')
+    interval = interval or current_app.config['DB_REPLICA_SYNC_INTERVAL']
+    while True:
+        started = time.perf_counter()
+        position = replicate_sqlite()
+        click.echo(f'Replica at position {position} ({time.perf_counter() - started:.2f}s).')
+        if once:
+            return
+        time.sleep(interval)
+
+
+@click.command('archive-movements')
+@click.option('--before', type=click.DateTime(), help='Archive movements older than this (UTC).')
+@click.option('--batch-size', default=5000, show_default=True, help='Movements per transaction.')
+@click.option('--verify', is_flag=True, help='Check that no balance changed after archiving.')
+@click.option('--verify-only', is_flag=True, help='Only check the archive, do not archive anything.')
+@with_appcontext
+def archive_movements_command(before, batch_size, verify, verify_only):
+    """Move old movements to the archive, folding them into opening balances."""
+    if verify_only:
+        problems = verify_archive()
+    elif before is None:
+        raise click.UsageError('Pass --before, or --verify-only to only check the archive.')
+    else:
+        started = time.perf_counter()
+        with immediate_transactions():
+            result = archive_movements(before, batch_size=batch_size, verify=verify)
+        cache.bump_version('movements')
+        click.echo(f'Archived {result.archived} movement(s) in {result.batches} batch(es) '
+                   f'in {time.perf_counter() - started:.1f}s.')
+        problems = result.problems
+    
+    for problem in problems:
+        click.echo(problem, err=True)
+    
+    if problems:
+        raise SystemExit(1)
+    if verify or verify_only:
+        click.echo('Archive verified: opening balances and stock balances match.')
+
+
+@click.command('prune-changes')
+@click.option('--days', default=7, show_default=True, help='Keep the change events of this many days.')
+@with_appcontext
+@immediate_transactions()
+def prune_changes_command(days):
+    """Delete old change feed events; clients further behind must reload."""
+    deleted = prune_events(datetime.utcnow() - timedelta(days=days))
+    click.echo(f'Deleted {deleted} change event(s).')
+
+
+COMMANDS = [init_db_command, seed_command, import_movements_command, generate_data_command,
+            snapshot_balances_command, rebuild_balances_command, rebuild_rollups_command,
+            archive_movements_command, prune_changes_command, replicate_command]
+
+
+def init_app(app):
+    for command in COMMANDS:
+        app.cli.add_command(command)
@@ -0,0 +1,70 @@
+"""
+Application configuration.
+
+Config holds the defaults. create_app() applies them, then the
+environment, then any overrides passed to it:
+
+- DATABASE_URL, DATABASE_REPLICA_URL, SECRET_KEY, JOB_WORKERS, DB_PROFILE
+  and DB_READ_ONLY_GETS are read under those names.
+- Any other setting can be given as ``INVENTORY_<NAME>``; values are parsed
+  as JSON where possible, so ``INVENTORY_MOVEMENTS_PER_PAGE=100`` is an
+  integer and ``INVENTORY_CACHE_ENABLED=false`` a boolean.
+
+Extensions add defaults for their own settings in init_app().
+"""
+
+import os
+
+
+class Config:
+    SECRET_KEY = 'your-secret-key-here-change-in-production'
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///inventory.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    MOVEMENTS_PER_PAGE = 50
+    MOVEMENTS_MAX_PER_PAGE = 500
+    IMPORT_BATCH_SIZE = 10000
+    IMPORT_MAX_REPORTED_ERRORS = 1000
+    SNAPSHOT_INTERVAL_HOURS = 24
+    ALLOW_NEGATIVE_STOCK = False
+    BATCH_MAX_LINES = 1000
+    SEARCH_MAX_RESULTS = 100
+    ANALYTICS_WINDOW_DAYS = 90
+    ANALYTICS_LEAD_TIME_DAYS = 7
+    ANALYTICS_SERVICE_Z = 1.65
+    ANALYTICS_TARGET_COVER_DAYS = 30
+    ANALYTICS_PAGE_ROWS = 200
+    MOVEMENT_FORM_TYPEAHEAD = 200
+    API_ENABLED = True
+    API_PAGE_SIZE = 100
+    API_MAX_PAGE_SIZE = 1000
+    API_COMPRESS_MIN_SIZE = 1024
+    ROLLUP_MAX_BUCKETS = 5000
+    JOB_WORKERS = 2
+    JOB_EVENTS_INTERVAL = 0.5
+    CHANGES_POLL_INTERVAL = 1.0
+    CHANGES_KEEPALIVE = 15
+    CHANGES_STREAM_SECONDS = 300
+    DB_PROFILE = 'production'
+    DB_READ_ONLY_GETS = False
+    DB_REPLICA_URI = None
+
+
+ENV_PREFIX = 'INVENTORY'
+
+
+def environment_config(environ=os.environ):
+    """Settings read from the unprefixed environment variables."""
+    config = {}
+    if 'DATABASE_URL' in environ:
+        config['SQLALCHEMY_DATABASE_URI'] = environ['DATABASE_URL']
+    if 'DATABASE_REPLICA_URL' in environ:
+        config['DB_REPLICA_URI'] = environ['DATABASE_REPLICA_URL']
+    if 'SECRET_KEY' in environ:
+        config['SECRET_KEY'] = environ['SECRET_KEY']
+    if 'JOB_WORKERS' in environ:
+        config['JOB_WORKERS'] = int(environ['JOB_WORKERS'])
+    if 'DB_PROFILE' in environ:
+        config['DB_PROFILE'] = environ['DB_PROFILE']
+    if 'DB_READ_ONLY_GETS' in environ:
+        config['DB_READ_ONLY_GETS'] = environ['DB_READ_ONLY_GETS'] == '1'
+    return config
@@ -0,0 +1,109 @@
+"""
+Seeded synthetic data for load testing and benchmarks.
+
+generate_dataset() adds products, locations and a movement history of any
+size. The same seed and sizes always produce the same data. Movements are
+spread evenly over the ``days`` days up to ``end`` with a realistic mix:
+
+- Product demand is skewed, so a few products see most of the traffic.
+- Each product is stocked at a handful of locations.
+- Transfers and outgoing movements only ever draw on stock that exists,
+  so no balance goes negative.
+
+Movements are written through importer.insert_movements(), the same
+batched path as bulk imports, so stock balances are maintained as they
+load.
+"""
+
+import random
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import insert, select
+from models import db, Product, Location
+from importer import insert_movements
+from ledger import MovementState
+
+
+# Share of movements by type; TRANSFER and OUT fall back to IN without stock
+MOVEMENT_MIX = {'IN': 0.40, 'TRANSFER': 0.35, 'OUT': 0.25}
+LOCATIONS_PER_PRODUCT = 4
+
+
+def _add_rows(model, rows, batch_size=10000):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(insert(model.__table__), rows[start:start + batch_size])
+    db.session.commit()
+
+
+def generate_movements(rng, product_ids, location_ids, count, start, end):
+    """Yield ``count`` MovementState rows between ``start`` and ``end``, oldest first."""
+    # Zipf-like demand: the n-th product is drawn with weight 1/n
+    demand = list(accumulate(1 / rank for rank in range(1, len(product_ids) + 1)))
+    total_demand = demand[-1]
+    homes = {
+        product_id: rng.sample(location_ids, min(LOCATIONS_PER_PRODUCT, len(location_ids)))
+        for product_id in product_ids
+    }
+    stock = {product_id: {} for product_id in product_ids}
+    kinds = list(MOVEMENT_MIX)
+    kind_weights = list(accumulate(MOVEMENT_MIX.values()))
+    total_kind_weight = kind_weights[-1]
+    step = (end - start) / max(count, 1)
+
+    for index in range(count):
+        # Inlined weighted draws; random.choices() is several times slower per call
+        product_id = product_ids[bisect(demand, rng.random() * total_demand)]
+        kind = kinds[bisect(kind_weights, rng.random() * total_kind_weight)]
+        timestamp = start + step * index
+        stocked = stock[product_id]
+
+        if kind == 'IN' or not stocked:
+            location = rng.choice(homes[product_id])
+            qty = rng.randint(10, 200)
+            stocked[location] = stocked.get(location, 0) + qty
+            yield MovementState(product_id, None, location, qty, timestamp)
+            continue
+
+        source = rng.choice(list(stocked))
+        qty = rng.randint(1, stocked[source])
+        stocked[source] -= qty
+        if not stocked[source]:
+            del stocked[source]
+
+        destination = None
+        if kind == 'TRANSFER' and len(location_ids) > 1:
+            destination = rng.choice(homes[product_id])
+            while destination == source:
+                destination = rng.choice(location_ids)
+            stocked[destination] = stocked.get(destination, 0) + qty
+
+        yield MovementState(product_id, source, destination, qty, timestamp)
+
+
+def generate_dataset(products=1000, locations=50, movements=100000, seed=42, days=365,
+                     end=datetime(2024, 1, 1), batch_size=10000):
+    """Add a synthetic dataset and return the number of rows added per table.
+
+    Movements reference every product and location in the database, so
+    generated data can be layered over existing data.
+    """
+    rng = random.Random(seed)
+
+    _add_rows(Product, [
+        {'name': f'Product {seed}-{number:06d}', 'description': f'Synthetic product {number}'}
+        for number in range(1, products + 1)
+    ], batch_size)
+    _add_rows(Location, [
+        {'name': f'Location {seed}-{number:04d}', 'address': f'{number} Synthetic Way'}
+        for number in range(1, locations + 1)
+    ], batch_size)
+
+    product_ids = list(db.session.scalars(select(Product.product_id).order_by(Product.product_id)))
+    location_ids = list(db.session.scalars(select(Location.location_id).order_by(Location.location_id)))
+
+    states = generate_movements(rng, product_ids, location_ids, movements,
+                                end - timedelta(days=days), end)
+    inserted = insert_movements(states, batch_size=batch_size)
+
+    return {'products': products, 'locations': locations, 'movements': inserted}
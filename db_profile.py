@@ -0,0 +1,202 @@
+"""
+Database engine profile.
+
+With the default SQLite settings a writer locks the whole database file,
+so readers wait behind ``add_movement`` and concurrent workers see
+"database is locked". The ``production`` profile, used unless DB_PROFILE
+says otherwise, sets these pragmas on every new connection:
+
+- ``journal_mode=WAL`` so readers and a writer no longer block each other
+- ``synchronous=NORMAL``, which is safe with WAL, to sync only at checkpoints
+- ``busy_timeout`` so a writer waits for the lock instead of failing
+- ``mmap_size`` and ``cache_size`` to serve hot pages from memory
+
+It also lets SQLAlchemy issue BEGIN itself. Transactions in write requests
+start with BEGIN IMMEDIATE: they take the write lock up front instead of
+failing when a read transaction upgrades to a write after another writer
+committed. It also makes SAVEPOINT work. Writers outside a request (CLI
+commands, the importer, write jobs) read before they write too, and get
+the same by running inside immediate_transactions().
+
+The ``default`` profile leaves the driver's stock behaviour for
+comparison. SQLITE_PRAGMAS overrides individual pragmas, and the DB_POOL_*
+settings size the connection pool.
+
+With DB_READ_ONLY_GETS, queries made while handling GET and HEAD requests
+go to a second engine that opens the same file read-only, so a read
+handler can never take the write lock.
+
+DB_REPLICA_URI adds a ``replica`` bind instead (opened read-only when it
+is a SQLite file), and replication.py decides per request whether GET
+handlers read from it or from the primary.
+
+read_only_engine() opens the database read-only outside the app, for
+worker processes that must not share the app's pooled connections.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+
+PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        # Negative means KiB rather than pages
+        'cache_size': -64 * 1024,
+    },
+}
+
+READ_ONLY_BIND = 'readonly'
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_immediate = ContextVar('immediate_transactions', default=False)
+
+
+def _is_file_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _read_only_url(url):
+    """Same SQLite database opened read-only, as a driver-level URI."""
+    database = url.database
+    if not database.startswith('file:'):
+        database = f'file:{database}'
+    return url.set(database=database, query=dict(url.query, mode='ro', uri='true'))
+
+
+def shareable(url):
+    """Whether another process can open the database at ``url``."""
+    return url.get_backend_name() != 'sqlite' or _is_file_sqlite(url)
+
+
+def read_only_engine(url, settings=None):
+    """A pool-less engine on ``url`` that cannot write.
+
+    SQLite files are opened read-only with ``settings`` as pragmas, and
+    PostgreSQL transactions are started READ ONLY.
+    """
+    url = make_url(url)
+    if _is_file_sqlite(url):
+        url = _read_only_url(url)
+    engine = create_engine(url, poolclass=NullPool)
+    if engine.dialect.name == 'sqlite':
+        if settings:
+            _install_sqlite_hooks(engine, settings, read_only=True)
+    elif engine.dialect.name == 'postgresql':
+        engine = engine.execution_options(postgresql_readonly=True)
+    return engine
+
+
+@contextmanager
+def immediate_transactions(enabled=True):
+    """Start the transactions begun inside the block with BEGIN IMMEDIATE.
+
+    For code outside a request that reads and then writes. A transaction
+    already open when the block is entered keeps its deferred BEGIN.
+    """
+    token = _immediate.set(enabled)
+    try:
+        yield
+    finally:
+        _immediate.reset(token)
+
+
+def configure(app):
+    """Set engine options and binds from the profile. Call before db.init_app()."""
+    app.config.setdefault('DB_PROFILE', 'production')
+    app.config.setdefault('SQLITE_PRAGMAS', {})
+    app.config.setdefault('DB_POOL_SIZE', 10)
+    app.config.setdefault('DB_MAX_OVERFLOW', 20)
+    app.config.setdefault('DB_POOL_TIMEOUT', 30)
+    app.config.setdefault('DB_READ_ONLY_GETS', False)
+    app.config.setdefault('DB_REPLICA_URI', None)
+
+    if app.config['DB_PROFILE'] not in PROFILES:
+        raise ValueError(f'Unknown DB_PROFILE {app.config["DB_PROFILE"]!r}, '
+                         f'expected one of {", ".join(PROFILES)}')
+
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and not _is_file_sqlite(url):
+        # In-memory databases use a single static connection
+        return
+
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+    options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', app.config['DB_POOL_TIMEOUT'])
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    if _is_file_sqlite(url):
+        binds.setdefault(READ_ONLY_BIND, str(_read_only_url(url)))
+    if app.config['DB_REPLICA_URI']:
+        replica = make_url(app.config['DB_REPLICA_URI'])
+        # Nothing but the replication stand-in may write to a SQLite replica
+        binds.setdefault(REPLICA_BIND, str(_read_only_url(replica)) if _is_file_sqlite(replica)
+                         else app.config['DB_REPLICA_URI'])
+
+
+def pragmas(app):
+    """The pragmas set on each connection for the app's profile."""
+    return {**PROFILES[app.config['DB_PROFILE']], **app.config['SQLITE_PRAGMAS']}
+
+
+def init_app(app, db):
+    """Install connection hooks on the app's engines. Call after db.init_app()."""
+    settings = pragmas(app)
+    if not settings:
+        return
+
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name == 'sqlite' and _is_file_sqlite(engine.url):
+                _install_sqlite_hooks(engine, settings, read_only=key in (READ_ONLY_BIND, REPLICA_BIND))
+
+
+def _install_sqlite_hooks(engine, settings, read_only=False):
+    if read_only:
+        # The journal mode is a property of the file, set by the writer
+        settings = {name: value for name, value in settings.items() if name != 'journal_mode'}
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        # Let SQLAlchemy emit BEGIN instead of the driver's implicit one
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        writing = not read_only and (
+            _immediate.get() or (has_request_context() and request.method not in READ_METHODS))
+        conn.exec_driver_sql('BEGIN IMMEDIATE' if writing else 'BEGIN')
+
+
+class RoutingSession(Session):
+    """Session that sends GET/HEAD queries to a read engine when enabled.
+
+    The engine is the one replication.py chose for the request (``g.read_bind``),
+    else the read-only engine with DB_READ_ONLY_GETS.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context()
+                and request.method in READ_METHODS):
+            key = g.get('read_bind')
+            if key is None and current_app.config.get('DB_READ_ONLY_GETS'):
+                key = READ_ONLY_BIND
+            engine = self._db.engines.get(key) if key else None
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -0,0 +1,120 @@
+"""
+Streaming CSV/NDJSON export of the movement ledger and balance report.
+
+Rows are read through a server-side cursor with ``yield_per`` and encoded
+one at a time, so memory use does not grow with the size of the export.
+Encoded rows are handed to the response in small chunks.
+"""
+
+import csv
+import io
+import json
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from models import db, movement_type, Product, Location, ProductMovement
+from balances import as_of_balance_query, stored_balance_query
+from ledger import filter_movements
+
+
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+MOVEMENT_COLUMNS = ('movement_id', 'timestamp', 'product_id', 'product', 'from_location',
+                    'from_location_name', 'to_location', 'to_location_name', 'qty', 'type')
+BALANCE_COLUMNS = ('product_id', 'product', 'location_id', 'location', 'qty')
+
+
+def movement_export_query(filters=None):
+    """Ledger rows with names joined, in the same order as the movements page."""
+    from_loc = aliased(Location)
+    to_loc = aliased(Location)
+
+    query = (
+        select(
+            ProductMovement.movement_id, ProductMovement.timestamp,
+            ProductMovement.product_id, Product.name,
+            ProductMovement.from_location, from_loc.name,
+            ProductMovement.to_location, to_loc.name,
+            ProductMovement.qty,
+        )
+        .join(Product, Product.product_id == ProductMovement.product_id)
+        .outerjoin(from_loc, from_loc.location_id == ProductMovement.from_location)
+        .outerjoin(to_loc, to_loc.location_id == ProductMovement.to_location)
+    )
+
+    return filter_movements(query, filters or {}).order_by(
+        ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc()
+    )
+
+
+def balance_export_query(product_id=None, location_id=None, as_of=None):
+    """Non-zero balances with names joined, in report order."""
+    if as_of is None:
+        balances = stored_balance_query(product_id, location_id)
+    else:
+        balances = as_of_balance_query(as_of, product_id, location_id)
+    balances = balances.subquery('balances')
+
+    return (
+        select(balances.c.product_id, Product.name, balances.c.location_id,
+               Location.name, balances.c.qty)
+        .join(Product, Product.product_id == balances.c.product_id)
+        .join(Location, Location.location_id == balances.c.location_id)
+        .order_by(balances.c.product_id, balances.c.location_id)
+    )
+
+
+def iter_movement_rows(filters=None, yield_per=1000):
+    """Yield export rows for the ledger, with the movement type appended."""
+    query = movement_export_query(filters).execution_options(yield_per=yield_per)
+    for row in db.session.execute(query):
+        yield (*row, movement_type(row.from_location, row.to_location))
+
+
+def iter_balance_rows(product_id=None, location_id=None, as_of=None, yield_per=1000):
+    """Yield export rows for the balance report, optionally as of a past time."""
+    query = balance_export_query(product_id, location_id, as_of).execution_options(yield_per=yield_per)
+    yield from db.session.execute(query)
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def encode_csv(columns, rows, chunk_rows=500):
+    """Encode rows as CSV text with a header, yielding a chunk every ``chunk_rows`` rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for count, row in enumerate(rows, 1):
+        writer.writerow(_json_value(value) for value in row)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def encode_ndjson(columns, rows, chunk_rows=500):
+    """Encode rows as one JSON object per line, yielding a chunk every ``chunk_rows`` rows."""
+    lines = []
+
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, map(_json_value, row)))))
+        if len(lines) == chunk_rows:
+            yield '\n'.join(lines) + '\n'
+            lines.clear()
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def encode(fmt, columns, rows):
+    """Encode rows in ``fmt`` ('csv' or 'ndjson')."""
+    if fmt == 'csv':
+        return encode_csv(columns, rows)
+    if fmt == 'ndjson':
+        return encode_ndjson(columns, rows)
+    raise ValueError(f'Unsupported export format: {fmt}')
@@ -0,0 +1,420 @@
+"""
+Background jobs.
+
+Long exports and archive compaction run on a bounded thread pool instead of
+in the request worker. submit() records a ``job`` row and returns its id
+straight away; the row tracks status (queued, running, succeeded, failed or
+timed_out), progress and the artifact the job produced. Artifacts are
+written to a temporary file and renamed into JOB_ARTIFACT_DIR when
+complete, so a download never sees a partial file.
+
+- JOB_WORKERS threads run jobs; at most JOB_MAX_PENDING may be queued or
+  running at once, and submit() raises JobQueueFull beyond that.
+- Each job has a deadline (JOB_TIMEOUT seconds unless the submitter passes
+  one). Tasks report progress through their JobContext, which raises
+  JobTimeout once the deadline has passed; threads cannot be killed, so a
+  task is stopped at its next progress report.
+- Every process with JOBS_ENABLED runs the jobs it queued. A job is
+  leased to its process for JOB_LEASE_SECONDS, and a heartbeat thread
+  renews the leases four times per period while the process lives.
+- Each process sweeps for expired leases on its first request and on every
+  heartbeat after that. A job whose process stopped is taken over by
+  the first process to sweep, up to JOB_MAX_ATTEMPTS runs. Tasks restart
+  from the beginning, so they must be safe to rerun; exports are, and
+  archiving resumes where it stopped. A task that reports progress after
+  its job was taken over is stopped with JobLost.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, func, insert, inspect, or_, select, update
+from models import db, Job, ProductMovement
+import exporter
+from archive import archive_movements
+from cache import cache
+from db_profile import immediate_transactions
+from ledger import filter_movements, parse_as_of, parse_movement_filters
+
+
+log = logging.getLogger(__name__)
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, TIMED_OUT = 'queued', 'running', 'succeeded', 'failed', 'timed_out'
+FINISHED = (SUCCEEDED, FAILED, TIMED_OUT)
+
+JOB_COLUMNS = ('job_id', 'kind', 'params', 'status', 'done', 'total', 'message', 'error',
+               'artifact', 'timeout', 'attempts', 'created_at', 'started_at', 'finished_at',
+               'updated_at')
+
+
+class JobError(Exception):
+    """Raised for a job that cannot be submitted."""
+
+
+class JobQueueFull(JobError):
+    """Raised when JOB_MAX_PENDING jobs are already queued or running."""
+
+
+class JobTimeout(Exception):
+    """Raised inside a task once its job is past its deadline."""
+
+
+class JobLost(Exception):
+    """Raised inside a task whose job another process has taken over."""
+
+
+def job_as_dict(row):
+    """JSON-ready dict of a job row from job_status()."""
+    values = {name: getattr(row, name) for name in JOB_COLUMNS}
+    values['params'] = json.loads(values['params'])
+    for name in ('created_at', 'started_at', 'finished_at', 'updated_at'):
+        if values[name] is not None:
+            values[name] = values[name].isoformat()
+    return values
+
+
+def _set(job_id, owner, **values):
+    """Update a job row held by ``owner`` in its own short transaction.
+
+    Tasks read through the session, possibly inside a long read
+    transaction; progress writes go through a separate connection so they
+    never have to upgrade it to a write. Returns False, changing nothing,
+    when the job has passed to another owner.
+    """
+    values['updated_at'] = datetime.utcnow()
+    with db.engine.begin() as connection:
+        return connection.execute(
+            update(Job).where(Job.job_id == job_id, Job.owner == owner).values(**values)
+        ).rowcount > 0
+
+
+def job_status(job_id):
+    """The current job row, read outside any session transaction; None if missing."""
+    with db.engine.connect() as connection:
+        return connection.execute(
+            select(*(getattr(Job, name) for name in JOB_COLUMNS)).where(Job.job_id == job_id)
+        ).first()
+
+
+class JobContext:
+    """Handed to a running task to report progress and write its artifact."""
+
+    def __init__(self, job_id, owner, deadline, artifact_dir, report_every=0.5):
+        self.job_id = job_id
+        self.owner = owner
+        self.deadline = deadline
+        self.artifact_dir = artifact_dir
+        self.report_every = report_every
+        self._reported = 0.0
+
+    def check(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise JobTimeout(f'Job {self.job_id} exceeded its timeout')
+
+    def progress(self, done, total=None, message=None, force=False):
+        """Record progress, at most every ``report_every`` seconds unless ``force``."""
+        self.check()
+        now = time.monotonic()
+        if not force and now - self._reported < self.report_every:
+            return
+        self._reported = now
+        values = {'done': done}
+        if total is not None:
+            values['total'] = total
+        if message is not None:
+            values['message'] = message
+        if not _set(self.job_id, self.owner, **values):
+            raise JobLost(f'Job {self.job_id} was taken over by another process')
+
+    def track(self, items, total=None, every=1000):
+        """Yield ``items``, reporting progress every ``every`` items."""
+        if total is not None:
+            self.progress(0, total, force=True)
+        count = 0
+        for count, item in enumerate(items, 1):
+            if count % every == 0:
+                self.progress(count)
+            yield item
+        self.progress(count, force=True)
+
+    def write_artifact(self, filename, chunks, mode='w'):
+        """Write ``chunks`` to ``filename`` in the job's artifact directory.
+
+        Returns the artifact path relative to JOB_ARTIFACT_DIR.
+        """
+        directory = os.path.join(self.artifact_dir, str(self.job_id))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        partial = path + '.partial'
+        with open(partial, mode, encoding=None if 'b' in mode else 'utf-8', newline='') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(partial, path)
+        return os.path.join(str(self.job_id), filename)
+
+
+class JobRunner:
+    """Bounded thread pool running registered tasks as persistent jobs."""
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        self.writing_tasks = set()
+        self.app = None
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._resumed = False
+        self._heartbeat = None
+        self._stopping = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_ENABLED', True)
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_MAX_PENDING', 20)
+        app.config.setdefault('JOB_TIMEOUT', 30 * 60)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 3)
+        app.config.setdefault('JOB_LEASE_SECONDS', 60)
+        app.config.setdefault('JOB_ARTIFACT_DIR', os.path.join(app.instance_path, 'jobs'))
+
+        self.app = app
+        app.extensions['jobs'] = self
+        if app.config['JOBS_ENABLED']:
+            app.before_request(self._resume_once)
+
+    @property
+    def owner(self):
+        """This process as recorded on the jobs it holds; each forked worker is its own."""
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _lease(self):
+        return datetime.utcnow() + timedelta(seconds=self.app.config['JOB_LEASE_SECONDS'])
+
+    def task(self, kind, writes=False):
+        """Register a task function ``fn(job, **params)`` that returns an artifact path or None.
+
+        Tasks that write through the session pass ``writes`` so their
+        transactions take the write lock up front.
+        """
+        def register(function):
+            self.tasks[kind] = function
+            if writes:
+                self.writing_tasks.add(kind)
+            return function
+        return register
+
+    # Submission
+
+    def submit(self, kind, params=None, timeout=None):
+        """Queue a job and return its id."""
+        if not self.app.config['JOBS_ENABLED']:
+            raise JobError('Background jobs are disabled.')
+        if kind not in self.tasks:
+            raise JobError(f'Unknown job kind {kind!r}. Available: {", ".join(sorted(self.tasks))}')
+
+        with self._lock:
+            self._futures = {job_id: future for job_id, future in self._futures.items()
+                             if not future.done()}
+            if len(self._futures) >= self.app.config['JOB_MAX_PENDING']:
+                raise JobQueueFull(f'{len(self._futures)} jobs are already queued or running.')
+
+            now = datetime.utcnow()
+            with db.engine.begin() as connection:
+                job_id = connection.execute(insert(Job).values(
+                    kind=kind, params=json.dumps(params or {}), status=QUEUED,
+                    timeout=timeout or self.app.config['JOB_TIMEOUT'],
+                    owner=self.owner, lease_expires=self._lease(),
+                    created_at=now, updated_at=now,
+                )).inserted_primary_key[0]
+            self._enqueue(job_id)
+        return job_id
+
+    def _enqueue(self, job_id):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.app.config['JOB_WORKERS'],
+                                                thread_name_prefix='job')
+        self._futures[job_id] = self._executor.submit(self._run, job_id)
+        self._start_heartbeat()
+
+    def wait(self, job_id, timeout=None):
+        """Block until a job this process runs has finished; returns its row."""
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout)
+        return job_status(job_id)
+
+    def shutdown(self, wait=True):
+        if self._heartbeat is not None:
+            self._stopping.set()
+            self._heartbeat = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    # Leases and recovery
+
+    def _start_heartbeat(self):
+        """Start the lease heartbeat unless it runs already; called holding the lock."""
+        if self._heartbeat is not None:
+            return
+        self._stopping = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, args=(self.app, self._stopping),
+                                           name='job-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self, app, stopping):
+        while not stopping.wait(app.config['JOB_LEASE_SECONDS'] / 4):
+            with app.app_context():
+                try:
+                    self.renew()
+                    self.resume()
+                except Exception:
+                    log.exception('Job heartbeat failed')
+
+    def renew(self):
+        """Extend the lease of every unfinished job this process holds."""
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(Job).where(Job.owner == self.owner, Job.status.in_((QUEUED, RUNNING)))
+                .values(lease_expires=self._lease())
+            )
+
+    def _resume_once(self):
+        if self._resumed:
+            return
+        with self._lock:
+            if self._resumed:
+                return
+            self._resumed = True
+            # The schema is only created by `flask init-db`, never on a request
+            if not inspect(db.engine).has_table(Job.__tablename__):
+                log.error('The job table is missing; run "flask init-db". '
+                          'Background jobs will not be resumed.')
+                return
+            self._start_heartbeat()
+        self.resume()
+
+    def resume(self):
+        """Take over queued and running jobs whose lease has expired.
+
+        Returns the ids requeued. Jobs that already used JOB_MAX_ATTEMPTS
+        runs are marked failed instead.
+        """
+        max_attempts = current_app.config['JOB_MAX_ATTEMPTS']
+        now = datetime.utcnow()
+        expired = and_(Job.status.in_((QUEUED, RUNNING)),
+                       or_(Job.lease_expires.is_(None), Job.lease_expires < now))
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(Job)
+                .where(expired, Job.status == RUNNING, Job.attempts >= max_attempts)
+                .values(status=FAILED, error='Interrupted too many times', finished_at=now)
+            )
+            connection.execute(
+                update(Job).where(expired)
+                .values(status=QUEUED, owner=self.owner, lease_expires=self._lease(),
+                        message='Resumed after restart')
+            )
+            job_ids = connection.execute(
+                select(Job.job_id).where(Job.owner == self.owner, Job.status == QUEUED)
+                .order_by(Job.job_id)
+            ).scalars().all()
+
+        with self._lock:
+            for job_id in job_ids:
+                if job_id not in self._futures:
+                    self._enqueue(job_id)
+        return job_ids
+
+    # Execution
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            started = datetime.utcnow()
+            # Claim the job; another runner may have taken it
+            with db.engine.begin() as connection:
+                claimed = connection.execute(
+                    update(Job).where(Job.job_id == job_id, Job.status == QUEUED,
+                                      Job.owner == self.owner)
+                    .values(status=RUNNING, attempts=Job.attempts + 1, started_at=started,
+                            lease_expires=self._lease(), finished_at=None, error=None,
+                            updated_at=started)
+                ).rowcount
+            if not claimed:
+                return
+
+            row = job_status(job_id)
+            deadline = time.monotonic() + row.timeout if row.timeout else None
+            owner = self.owner
+            job = JobContext(job_id, owner, deadline, self.app.config['JOB_ARTIFACT_DIR'])
+            try:
+                with immediate_transactions(row.kind in self.writing_tasks):
+                    artifact = self.tasks[row.kind](job, **json.loads(row.params))
+            except JobLost:
+                db.session.rollback()
+                log.warning('Job %s (%s) was taken over by another process', job_id, row.kind)
+            except JobTimeout as e:
+                db.session.rollback()
+                _set(job_id, owner, status=TIMED_OUT, error=str(e), finished_at=datetime.utcnow())
+            except Exception as e:
+                db.session.rollback()
+                log.exception('Job %s (%s) failed', job_id, row.kind)
+                _set(job_id, owner, status=FAILED, error=str(e) or type(e).__name__,
+                     finished_at=datetime.utcnow())
+            else:
+                _set(job_id, owner, status=SUCCEEDED, artifact=artifact, finished_at=datetime.utcnow())
+
+
+jobs = JobRunner()
+
+
+# Tasks
+
+@jobs.task('export-movements')
+def export_movements_job(job, format='csv', **filters):
+    """Ledger export (``format`` csv or ndjson) with the movements page filters."""
+    if format not in exporter.FORMATS:
+        raise ValueError(f'Unsupported export format: {format}')
+    filters = parse_movement_filters(filters)
+    total = db.session.scalar(filter_movements(select(func.count(ProductMovement.movement_id)), filters))
+    rows = job.track(exporter.iter_movement_rows(filters), total)
+    return job.write_artifact(f'movements.{format}',
+                              exporter.encode(format, exporter.MOVEMENT_COLUMNS, rows))
+
+
+@jobs.task('export-balances')
+def export_balances_job(job, format='csv', product_id=None, location_id=None, as_of=None):
+    """Balance report export, optionally ``as_of`` an ISO date or time."""
+    if format not in exporter.FORMATS:
+        raise ValueError(f'Unsupported export format: {format}')
+    filters = parse_movement_filters({'product_id': product_id, 'location_id': location_id})
+    rows = job.track(exporter.iter_balance_rows(filters['product_id'], filters['location_id'],
+                                                parse_as_of(as_of)))
+    return job.write_artifact(f'balances.{format}',
+                              exporter.encode(format, exporter.BALANCE_COLUMNS, rows))
+
+
+@jobs.task('archive-movements', writes=True)
+def archive_movements_job(job, before, batch_size=5000, verify=False):
+    """Archive compaction of movements before ``before`` (ISO date or time)."""
+    cutoff = datetime.fromisoformat(before)
+    total = db.session.scalar(
+        select(func.count(ProductMovement.movement_id)).where(ProductMovement.timestamp < cutoff)
+    )
+    db.session.rollback()
+    job.progress(0, total, force=True)
+    result = archive_movements(cutoff, batch_size=batch_size, verify=verify, progress=job.progress)
+
+    cache.bump_version('movements')
+    summary = {'archived': result.archived, 'batches': result.batches, 'problems': result.problems}
+    job.progress(result.archived, message=f'Archived {result.archived} movement(s)', force=True)
+    if result.problems:
+        raise RuntimeError('; '.join(result.problems))
+    return job.write_artifact('archive.json', [json.dumps(summary, indent=2)])
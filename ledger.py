@@ -0,0 +1,470 @@
+"""
+Movement ledger helpers.
+
+Every create, edit and delete of a ProductMovement goes through
+record_change() so that state derived from the movement log is updated in
+the same transaction as the movement itself, and the change is appended to
+the change feed (see changefeed.py).
+
+Reads of the ledger are keyset-paginated on (timestamp, movement_id), so
+fetching a page costs the same wherever it is in the history.
+"""
+
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import exists, literal, or_, select, tuple_, union_all
+from sqlalchemy.orm import joinedload
+from models import db, Location, Product, ProductMovement, ProductMovementArchive
+from balances import apply_balance_deltas, available_stock
+from changefeed import record_event
+from rollups import apply_rollup_deltas, insert_rollup_deltas, rollup_deltas
+from snapshots import invalidate_snapshots
+
+
+MOVEMENT_TYPES = ('IN', 'OUT', 'TRANSFER')
+
+
+class MovementError(ValueError):
+    """Raised when movement fields fail validation; the message is user-facing."""
+
+
+class InsufficientStock(MovementError):
+    """Raised when a write would take a stock balance below zero.
+
+    Part of the write may already be applied; the caller must roll back.
+    """
+
+    def __init__(self, product_id, location_id, available, requested):
+        self.product_id = product_id
+        self.location_id = location_id
+        self.available = available
+        self.requested = requested
+
+        product = db.session.get(Product, product_id)
+        location = db.session.get(Location, location_id)
+        super().__init__(
+            f'Not enough stock: "{product.name if product else product_id}" at '
+            f'"{location.name if location else location_id}" has {available}, '
+            f'{requested} needed!'
+        )
+
+
+def _optional_id(value, message):
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise MovementError(message)
+
+
+def parse_movement(product_id, from_location, to_location, qty):
+    """Validate raw movement fields and convert them to integers.
+
+    Accepts form strings or JSON values. Empty locations become None.
+    Returns a dict of ``product_id``, ``from_location``, ``to_location`` and
+    ``qty``; raises MovementError with the reason on invalid input.
+    """
+    product_id = _optional_id(product_id, 'Product is required!')
+    if product_id is None:
+        raise MovementError('Product is required!')
+
+    try:
+        qty = int(qty)
+    except (TypeError, ValueError):
+        qty = 0
+    if qty <= 0:
+        raise MovementError('Quantity must be greater than 0!')
+
+    from_location = _optional_id(from_location, 'From location is invalid!')
+    to_location = _optional_id(to_location, 'To location is invalid!')
+
+    if from_location is None and to_location is None:
+        raise MovementError('At least one location (From or To) must be selected!')
+
+    if from_location == to_location:
+        raise MovementError('From and To locations cannot be the same!')
+
+    return {
+        'product_id': product_id,
+        'from_location': from_location,
+        'to_location': to_location,
+        'qty': qty,
+    }
+
+
+MovementState = namedtuple(
+    'MovementState', ['product_id', 'from_location', 'to_location', 'qty', 'timestamp']
+)
+
+
+def movement_state(movement):
+    """Capture the balance-relevant fields of a movement."""
+    return MovementState(
+        product_id=movement.product_id,
+        from_location=movement.from_location,
+        to_location=movement.to_location,
+        qty=movement.qty,
+        timestamp=movement.timestamp,
+    )
+
+
+def _accumulate(deltas, product_id, from_location, to_location, qty):
+    if to_location is not None:
+        deltas[(product_id, to_location)] += qty
+    if from_location is not None:
+        deltas[(product_id, from_location)] -= qty
+
+
+def balance_deltas(old=None, new=None):
+    """Return the net ``{(product_id, location_id): delta}`` of a change.
+
+    ``old`` is the movement before the change (None for an insert) and
+    ``new`` the movement after it (None for a delete); an edit reverses the
+    old movement and applies the new one.
+    """
+    deltas = defaultdict(int)
+
+    if old is not None:
+        _accumulate(deltas, old.product_id, old.from_location, old.to_location, -old.qty)
+    if new is not None:
+        _accumulate(deltas, new.product_id, new.from_location, new.to_location, new.qty)
+
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def _apply_stock_deltas(deltas):
+    """Apply stock deltas, refusing negative balances unless ALLOW_NEGATIVE_STOCK."""
+    check_negative = not current_app.config.get('ALLOW_NEGATIVE_STOCK', False)
+    shortfalls = apply_balance_deltas(deltas, check_negative=check_negative)
+    if shortfalls:
+        product_id, location_id = shortfalls[0]
+        raise InsufficientStock(product_id, location_id,
+                                available_stock(product_id, location_id),
+                                -deltas[(product_id, location_id)])
+
+
+def record_change(old=None, new=None, movement=None):
+    """Apply a movement change to derived state and log it. Does not commit.
+
+    ``movement`` is the ProductMovement changed, if any, whose id tags the
+    change event (see changefeed.py); a new one is flushed to get its id.
+    Raises InsufficientStock if the change would leave a negative balance.
+    """
+    deltas = balance_deltas(old, new)
+    _apply_stock_deltas(deltas)
+    apply_rollup_deltas(rollup_deltas(old, new))
+
+    if movement is not None and movement.movement_id is None:
+        db.session.flush()
+    kind = 'create' if old is None else 'delete' if new is None else 'edit'
+    record_event(kind, deltas, movement.movement_id if movement is not None else None)
+
+    # A new movement without a timestamp yet is stamped "now", after any snapshot
+    timestamps = [state.timestamp for state in (old, new) if state and state.timestamp]
+    if timestamps:
+        invalidate_snapshots(min(timestamps))
+
+
+def net_deltas(states):
+    """Return the combined ``{(product_id, location_id): delta}`` of many movements."""
+    deltas = defaultdict(int)
+    for state in states:
+        _accumulate(deltas, state.product_id, state.from_location, state.to_location, state.qty)
+    return deltas
+
+
+def record_inserts(states):
+    """Apply a batch of inserted movements (MovementState) to derived state.
+
+    Used by bulk writers that insert with executemany instead of the ORM;
+    deltas are aggregated per cell so each cell is written once per batch,
+    and the batch is logged as one change event.
+    Raises InsufficientStock if the batch would leave a negative balance.
+    Does not commit.
+    """
+    deltas = net_deltas(states)
+    _apply_stock_deltas(deltas)
+    apply_rollup_deltas(insert_rollup_deltas(states))
+    if states:
+        record_event('batch', deltas)
+        invalidate_snapshots(min(state.timestamp for state in states))
+
+
+def _existing_ids(movements):
+    """Return the product and location ids of ``movements`` that exist, in one query."""
+    product_ids = {values['product_id'] for values in movements}
+    location_ids = {location for values in movements
+                    for location in (values['from_location'], values['to_location'])
+                    if location is not None}
+
+    found = {'product': set(), 'location': set()}
+    for kind, id_ in db.session.execute(union_all(
+        select(literal('product'), Product.product_id).where(Product.product_id.in_(product_ids)),
+        select(literal('location'), Location.location_id)
+        .where(Location.location_id.in_(location_ids)),
+    )):
+        found[kind].add(id_)
+    return found['product'], found['location']
+
+
+def record_movement_batch(lines, partial=False):
+    """Validate and add a list of movements as one document.
+
+    ``lines`` are dicts with the movement form fields. Every line is
+    validated with parse_movement() and the products and locations they
+    reference are looked up together. Lines share one timestamp.
+
+    By default the batch is all-or-nothing: if any line is rejected nothing
+    is added. With ``partial`` each line is added in its own savepoint and
+    rejected lines are skipped.
+
+    Returns one result dict per line, with a ``status`` of ``created`` (and
+    the ``movement_id``), ``rejected`` (and the ``error``) or
+    ``not_applied``. Does not commit; roll back if nothing was created.
+    """
+    results = [{'line': number} for number in range(1, len(lines) + 1)]
+    parsed = {}
+    for index, line in enumerate(lines):
+        try:
+            if not isinstance(line, dict):
+                raise MovementError('Line must be an object!')
+            parsed[index] = parse_movement(line.get('product_id'), line.get('from_location'),
+                                           line.get('to_location'), line.get('qty'))
+        except MovementError as e:
+            results[index].update(status='rejected', error=str(e))
+
+    products, locations = _existing_ids(parsed.values())
+    for index, values in list(parsed.items()):
+        missing = [f'Location {values[field]} does not exist!'
+                   for field in ('from_location', 'to_location')
+                   if values[field] is not None and values[field] not in locations]
+        if values['product_id'] not in products:
+            missing.insert(0, f'Product {values["product_id"]} does not exist!')
+        if missing:
+            results[index].update(status='rejected', error=missing[0])
+            del parsed[index]
+
+    if not partial and len(parsed) < len(lines):
+        for index in parsed:
+            results[index]['status'] = 'not_applied'
+        return results
+
+    timestamp = datetime.utcnow()
+    movements = {index: ProductMovement(timestamp=timestamp, **values)
+                 for index, values in parsed.items()}
+
+    if partial:
+        for index, movement in movements.items():
+            try:
+                with db.session.begin_nested():
+                    db.session.add(movement)
+                    record_change(new=movement_state(movement), movement=movement)
+            except MovementError as e:
+                results[index].update(status='rejected', error=str(e))
+            else:
+                results[index].update(status='created', movement_id=movement.movement_id)
+        return results
+
+    db.session.add_all(movements.values())
+    try:
+        record_inserts([movement_state(movement) for movement in movements.values()])
+    except InsufficientStock as e:
+        # Blame the first line that takes the short balance below zero
+        running = e.available
+        blamed = None
+        for index, values in parsed.items():
+            if values['product_id'] != e.product_id:
+                continue
+            if values['to_location'] == e.location_id:
+                running += values['qty']
+            if values['from_location'] == e.location_id:
+                running -= values['qty']
+                if running < 0 and blamed is None:
+                    blamed = index
+        for index in parsed:
+            results[index]['status'] = 'not_applied'
+        results[blamed].update(status='rejected', error=str(e))
+        return results
+
+    db.session.flush()
+    for index, movement in movements.items():
+        results[index].update(status='created', movement_id=movement.movement_id)
+    return results
+
+
+def _parse_int(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def _movement_probes(product_id=None, location_id=None):
+    """EXISTS probes for live or archived movements of a product or location.
+
+    The ids may be values or correlated columns. Every probe matches the
+    leading column of an index, so it stops at the first entry it finds.
+    """
+    probes = []
+    for model in (ProductMovement, ProductMovementArchive):
+        if product_id is not None:
+            probes.append(exists().where(model.product_id == product_id))
+        if location_id is not None:
+            probes.append(exists().where(model.from_location == location_id))
+            probes.append(exists().where(model.to_location == location_id))
+    return or_(*probes)
+
+
+def has_movements_query(product_id=None, location_id=None):
+    """Select whether any live or archived movement references the product or location."""
+    return select(_movement_probes(product_id, location_id))
+
+
+def has_movements(product_id=None, location_id=None):
+    """Whether any live or archived movement references the product or location."""
+    return bool(db.session.scalar(has_movements_query(product_id, location_id)))
+
+
+def referenced_ids_query(model, ids=None):
+    """Select the ids of ``model`` (Product or Location) rows that movements reference."""
+    if model is Product:
+        key = Product.product_id
+        query = select(key).where(_movement_probes(product_id=key))
+    else:
+        key = Location.location_id
+        query = select(key).where(_movement_probes(location_id=key))
+    return query if ids is None else query.where(key.in_(ids))
+
+
+def referenced_ids(model, ids=None):
+    """The ids among ``ids`` (default all) of ``model`` rows that cannot be deleted."""
+    return set(db.session.scalars(referenced_ids_query(model, ids)))
+
+
+def parse_as_of(value):
+    """Parse an ``as_of`` request value, inclusive.
+
+    Accepts an ISO date and time, or a bare date meaning the end of that day;
+    a time without seconds means the end of that minute. Returns None when
+    missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        as_of = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+    if len(value) == 10:
+        as_of += timedelta(days=1, microseconds=-1)
+    elif len(value) == 16:
+        as_of += timedelta(minutes=1, microseconds=-1)
+    return as_of
+
+
+def parse_movement_filters(args):
+    """Read ledger filters from request args, ignoring malformed values.
+
+    Recognised keys are ``product_id``, ``location_id`` (either side of the
+    movement), ``type`` (IN, OUT or TRANSFER) and ``date_from``/``date_to``
+    as YYYY-MM-DD, both inclusive.
+    """
+    movement_type = (args.get('type') or '').upper()
+
+    return {
+        'product_id': _parse_int(args.get('product_id')),
+        'location_id': _parse_int(args.get('location_id')),
+        'type': movement_type if movement_type in MOVEMENT_TYPES else None,
+        'date_from': _parse_date(args.get('date_from')),
+        'date_to': _parse_date(args.get('date_to')),
+    }
+
+
+def filter_movements(query, filters):
+    """Apply parse_movement_filters() output to a ProductMovement select."""
+    if filters.get('product_id') is not None:
+        query = query.where(ProductMovement.product_id == filters['product_id'])
+
+    if filters.get('location_id') is not None:
+        query = query.where(or_(
+            ProductMovement.from_location == filters['location_id'],
+            ProductMovement.to_location == filters['location_id'],
+        ))
+
+    # Same rules as ProductMovement.get_movement_type()
+    if filters.get('type') == 'IN':
+        query = query.where(ProductMovement.from_location.is_(None),
+                            ProductMovement.to_location.isnot(None))
+    elif filters.get('type') == 'OUT':
+        query = query.where(ProductMovement.from_location.isnot(None),
+                            ProductMovement.to_location.is_(None))
+    elif filters.get('type') == 'TRANSFER':
+        query = query.where(ProductMovement.from_location.isnot(None),
+                            ProductMovement.to_location.isnot(None))
+
+    if filters.get('date_from') is not None:
+        query = query.where(ProductMovement.timestamp >= filters['date_from'])
+
+    if filters.get('date_to') is not None:
+        query = query.where(ProductMovement.timestamp < filters['date_to'] + timedelta(days=1))
+
+    return query
+
+
+def encode_cursor(movement):
+    """Encode the keyset position just after ``movement``."""
+    return f'{movement.timestamp.isoformat()}_{movement.movement_id}'
+
+
+def decode_cursor(cursor):
+    """Decode encode_cursor() output into (timestamp, movement_id), or None."""
+    if not cursor:
+        return None
+
+    timestamp, _, movement_id = cursor.rpartition('_')
+    try:
+        return datetime.fromisoformat(timestamp), int(movement_id)
+    except ValueError:
+        return None
+
+
+def movement_page_query(filters=None, cursor=None, per_page=50):
+    """Build the select for one ledger page, with one extra row to detect a next page."""
+    query = filter_movements(select(ProductMovement), filters or {}).options(
+        joinedload(ProductMovement.product),
+        joinedload(ProductMovement.from_loc),
+        joinedload(ProductMovement.to_loc),
+    )
+
+    position = decode_cursor(cursor)
+    if position is not None:
+        query = query.where(
+            tuple_(ProductMovement.timestamp, ProductMovement.movement_id) < tuple_(*position)
+        )
+
+    return query.order_by(
+        ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc()
+    ).limit(per_page + 1)
+
+
+def movement_page(filters=None, cursor=None, per_page=50):
+    """Fetch one page of the ledger, newest first.
+
+    Returns ``(movements, next_cursor)``; ``next_cursor`` is None on the last
+    page. Products and locations are joined in the same query so rendering
+    the page does not lazy-load them row by row.
+    """
+    query = movement_page_query(filters, cursor, per_page)
+    movements = db.session.execute(query).scalars().all()
+    next_cursor = encode_cursor(movements[per_page - 1]) if len(movements) > per_page else None
+
+    return movements[:per_page], next_cursor
@@ -0,0 +1,201 @@
+"""
+Per-request latency and SQL instrumentation.
+
+Flask request hooks time every request, and SQLAlchemy cursor events count
+the statements it runs and the time spent in them. Totals are aggregated
+per endpoint into Prometheus histograms, and the slowest statements seen
+are kept with the endpoint that ran them. render() produces the Prometheus
+text exposition format served at ``/metrics``.
+
+A page whose statement count grows with the number of rows it shows (an
+N+1 query) stands out in ``inventory_request_sql_statements``. With
+METRICS_QUERY_HEADER enabled every response also carries its own count in
+an ``X-Query-Count`` header.
+"""
+
+import heapq
+import re
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from models import db
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _statement_text(statement, limit=200):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= limit else statement[:limit - 3] + '...'
+
+
+class RequestMetrics:
+    """Collects request latency and SQL statistics per endpoint."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_QUERY_HEADER', False)
+        app.config.setdefault('METRICS_SLOW_STATEMENTS', 10)
+
+        self.enabled = app.config['METRICS_ENABLED']
+        self.query_header = app.config['METRICS_QUERY_HEADER']
+        self.slow_limit = app.config['METRICS_SLOW_STATEMENTS']
+        app.extensions['request_metrics'] = self
+
+        if not self.enabled:
+            return
+
+        app.before_request(self._start_request)
+        app.after_request(self._add_headers)
+        app.teardown_request(self._end_request)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def reset(self):
+        with self._lock:
+            self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+            self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+            self.db_seconds = defaultdict(float)
+            self.slowest = []
+
+    # Flask hooks
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    def _add_headers(self, response):
+        if self.query_header and 'sql_statements' in g:
+            response.headers['X-Query-Count'] = str(g.sql_statements)
+        return response
+
+    def _end_request(self, exc=None):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            self.latency[endpoint].observe(time.perf_counter() - started)
+            self.statements[endpoint].observe(g.sql_statements)
+            self.db_seconds[endpoint] += g.sql_seconds
+
+    # SQLAlchemy hooks
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Kept on the statement's execution context, which a failed statement
+        # takes with it, rather than on the long-lived connection
+        if context is not None:
+            context.metrics_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'metrics_started', None)
+        if started is None or not has_request_context() or 'metrics_started' not in g:
+            return
+        elapsed = time.perf_counter() - started
+
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+        entry = (elapsed, request.endpoint or 'unmatched', statement)
+        with self._lock:
+            if len(self.slowest) < self.slow_limit:
+                heapq.heappush(self.slowest, entry)
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    # Exposition
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            self._render_histograms(
+                lines, 'inventory_request_duration_seconds', 'Request latency by endpoint.',
+                self.latency)
+            self._render_histograms(
+                lines, 'inventory_request_sql_statements', 'SQL statements per request by endpoint.',
+                self.statements)
+
+            lines.append('# HELP inventory_request_sql_seconds_total Time spent in SQL by endpoint.')
+            lines.append('# TYPE inventory_request_sql_seconds_total counter')
+            for endpoint, seconds in sorted(self.db_seconds.items()):
+                lines.append(f'inventory_request_sql_seconds_total{{endpoint="{_label(endpoint)}"}} '
+                             f'{seconds:.6f}')
+
+            lines.append('# HELP inventory_slow_statement_seconds Slowest SQL statements seen.')
+            lines.append('# TYPE inventory_slow_statement_seconds gauge')
+            for elapsed, endpoint, statement in sorted(self.slowest, reverse=True):
+                lines.append(f'inventory_slow_statement_seconds{{endpoint="{_label(endpoint)}",'
+                             f'statement="{_label(_statement_text(statement))}"}} {elapsed:.6f}')
+
+        view_cache = current_app.extensions.get('view_cache')
+        if view_cache is not None:
+            stats = view_cache.stats()
+            for name, kind in (('hits', 'counter'), ('misses', 'counter'),
+                               ('not_modified', 'counter'), ('entries', 'gauge'),
+                               ('data_version', 'gauge')):
+                metric = f'inventory_cache_{name}' + ('_total' if kind == 'counter' else '')
+                lines.append(f'# TYPE {metric} {kind}')
+                lines.append(f'{metric} {stats[name]}')
+
+        replicas = current_app.extensions.get('replica_monitor')
+        if replicas is not None and current_app.config['DB_REPLICA_URI']:
+            stats = replicas.stats()
+            for name, kind in (('replica_reads', 'counter'), ('sticky_reads', 'counter'),
+                               ('lagging_reads', 'counter'), ('replica_lag_seconds', 'gauge'),
+                               ('replica_position', 'gauge')):
+                metric = f'inventory_db_{name}' + ('_total' if kind == 'counter' else '')
+                lines.append(f'# TYPE {metric} {kind}')
+                lines.append(f'{metric} {stats[name]}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histograms(lines, name, help_text, histograms):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for endpoint, histogram in sorted(histograms.items()):
+            label = f'endpoint="{_label(endpoint)}"'
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{{label}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{label}}} {histogram.count}')
+
+
+metrics = RequestMetrics()
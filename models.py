@@ -1,7 +1,19 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from db_profile import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def movement_type(from_location, to_location):
+    """Determine the type of a movement from its locations"""
+    if from_location is None and to_location is not None:
+        return "IN"
+    elif from_location is not None and to_location is None:
+        return "OUT"
+    else:
+        return "TRANSFER"
 
-db = SQLAlchemy()
 
 class Product(db.Model):
     __tablename__ = 'product'
@@ -10,8 +22,11 @@ class Product(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     
-    # Relationship to movements
-    movements = db.relationship('ProductMovement', backref='product', lazy=True)
+    # Write-only: a product can have any number of movements, so the collection
+    # is never loaded; query it with product.movements.select(), or
+    # ledger.has_movements() for an existence check
+    movements = db.relationship('ProductMovement', back_populates='product',
+                                lazy='write_only', passive_deletes=True)
     
     def __repr__(self):
         return f'<Product {self.name}>'
@@ -24,15 +39,15 @@ class Location(db.Model):
     name = db.Column(db.String(100), nullable=False)
     address = db.Column(db.String(200))
     
-    # Relationships to movements
+    # Relationships to movements, write-only like Product.movements
     movements_from = db.relationship('ProductMovement', 
                                     foreign_keys='ProductMovement.from_location',
-                                    backref='from_loc', 
-                                    lazy=True)
+                                    back_populates='from_loc', 
+                                    lazy='write_only', passive_deletes=True)
     movements_to = db.relationship('ProductMovement', 
                                   foreign_keys='ProductMovement.to_location',
-                                  backref='to_loc', 
-                                  lazy=True)
+                                  back_populates='to_loc', 
+                                  lazy='write_only', passive_deletes=True)
     
     def __repr__(self):
         return f'<Location {self.name}>'
@@ -40,6 +55,16 @@ class Location(db.Model):
 
 class ProductMovement(db.Model):
     __tablename__ = 'product_movement'
+    __table_args__ = (
+        # Per-product balances and the product delete guard
+        db.Index('ix_product_movement_product_to', 'product_id', 'to_location'),
+        db.Index('ix_product_movement_product_from', 'product_id', 'from_location'),
+        # Per-location balances, ledger location filter and the location delete guard
+        db.Index('ix_product_movement_to_product', 'to_location', 'product_id'),
+        db.Index('ix_product_movement_from_product', 'from_location', 'product_id'),
+        # Keyset pagination of the ledger, newest first
+        db.Index('ix_product_movement_timestamp_id', 'timestamp', 'movement_id'),
+    )
     
     movement_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -48,14 +73,201 @@ class ProductMovement(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), nullable=False)
     qty = db.Column(db.Integer, nullable=False)
     
+    product = db.relationship('Product', back_populates='movements')
+    from_loc = db.relationship('Location', foreign_keys=[from_location], back_populates='movements_from')
+    to_loc = db.relationship('Location', foreign_keys=[to_location], back_populates='movements_to')
+    
     def __repr__(self):
         return f'<ProductMovement {self.movement_id}>'
     
     def get_movement_type(self):
         """Determine the type of movement"""
-        if self.from_location is None and self.to_location is not None:
-            return "IN"
-        elif self.from_location is not None and self.to_location is None:
-            return "OUT"
-        else:
-            return "TRANSFER"
\ No newline at end of file
+        return movement_type(self.from_location, self.to_location)
+
+
+class StockBalance(db.Model):
+    """Materialized balance of a product at a location.
+
+    Maintained incrementally from every movement write; the movement log
+    remains the source of truth and the table can be rebuilt from it.
+    """
+    __tablename__ = 'stock_balance'
+    __table_args__ = (
+        # The primary key covers product lookups; this covers per-location reads
+        db.Index('ix_stock_balance_location', 'location_id'),
+    )
+    
+    product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.location_id'), primary_key=True)
+    qty = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<StockBalance {self.product_id}@{self.location_id}: {self.qty}>'
+
+
+
+class BalanceSnapshot(db.Model):
+    """Checkpoint of every balance as of ``taken_at`` (movements at or before it)."""
+    __tablename__ = 'balance_snapshot'
+    
+    snapshot_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    taken_at = db.Column(db.DateTime, nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BalanceSnapshot {self.taken_at}>'
+
+
+class BalanceSnapshotRow(db.Model):
+    __tablename__ = 'balance_snapshot_row'
+    
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('balance_snapshot.snapshot_id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.location_id'), primary_key=True)
+    qty = db.Column(db.Integer, nullable=False)
+
+
+
+class ProductMovementArchive(db.Model):
+    """Archived ProductMovement rows, moved out of the live ledger unchanged."""
+    __tablename__ = 'product_movement_archive'
+    __table_args__ = (
+        # Replaying archived history for as-of queries, and the archive watermark
+        db.Index('ix_product_movement_archive_timestamp_id', 'timestamp', 'movement_id'),
+        # Delete guards
+        db.Index('ix_product_movement_archive_product', 'product_id'),
+        db.Index('ix_product_movement_archive_from', 'from_location'),
+        db.Index('ix_product_movement_archive_to', 'to_location'),
+    )
+    
+    movement_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    from_location = db.Column(db.Integer, db.ForeignKey('location.location_id'), nullable=True)
+    to_location = db.Column(db.Integer, db.ForeignKey('location.location_id'), nullable=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), nullable=False)
+    qty = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ProductMovementArchive {self.movement_id}>'
+
+
+class OpeningBalance(db.Model):
+    """Net balance of all archived movements for a product at a location."""
+    __tablename__ = 'opening_balance'
+    __table_args__ = (
+        db.Index('ix_opening_balance_location', 'location_id'),
+    )
+    
+    product_id = db.Column(db.Integer, db.ForeignKey('product.product_id'), primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.location_id'), primary_key=True)
+    qty = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<OpeningBalance {self.product_id}@{self.location_id}: {self.qty}>'
+
+
+class MovementRollup:
+    """Columns shared by the hourly and daily movement rollups.
+
+    One row per (location, product, bucket) with the quantities moved in
+    that bucket by movement type; ``bucket`` is the start of the hour or
+    day (UTC). ``product_id`` 0 holds the total over all products at the
+    location and ``location_id`` 0 the total over all locations for the
+    product, so charts over either never have to sum per-cell rows.
+    """
+    location_id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    in_qty = db.Column(db.Integer, nullable=False, default=0)
+    out_qty = db.Column(db.Integer, nullable=False, default=0)
+    transfer_in_qty = db.Column(db.Integer, nullable=False, default=0)
+    transfer_out_qty = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.product_id}@{self.location_id} {self.bucket}>'
+
+
+class HourlyMovementRollup(MovementRollup, db.Model):
+    __tablename__ = 'movement_rollup_hour'
+
+
+class DailyMovementRollup(MovementRollup, db.Model):
+    __tablename__ = 'movement_rollup_day'
+
+
+class Job(db.Model):
+    """A background job and its progress; see jobs.py."""
+    __tablename__ = 'job'
+    __table_args__ = (
+        # Resuming interrupted jobs and listing recent ones
+        db.Index('ix_job_status', 'status'),
+        db.Index('ix_job_created_at', 'created_at'),
+    )
+    
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    message = db.Column(db.String(200))
+    error = db.Column(db.Text)
+    artifact = db.Column(db.String(200))
+    timeout = db.Column(db.Integer)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # The process running the job, and until when its heartbeat has renewed it
+    owner = db.Column(db.String(100))
+    lease_expires = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Job {self.job_id} {self.kind} {self.status}>'
+
+
+class MovementEvent(db.Model):
+    """One change to the movement ledger and the balance deltas it caused; see changefeed.py."""
+    __tablename__ = 'movement_event'
+    __table_args__ = (
+        # Pruning by age
+        db.Index('ix_movement_event_created_at', 'created_at'),
+        # Never hand out a pruned sequence number again
+        {'sqlite_autoincrement': True},
+    )
+    
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(20), nullable=False)
+    movement_id = db.Column(db.Integer)
+    # JSON list of [product_id, location_id, delta]
+    deltas = db.Column(db.Text, nullable=False, default='[]')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<MovementEvent {self.seq} {self.kind}>'
+
+
+class CacheVersion(db.Model):
+    """A page cache version counter shared by every process; see cache.py."""
+    __tablename__ = 'cache_version'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CacheVersion {self.name} {self.version}>'
+
+
+class ReplicationHeartbeat(db.Model):
+    """Single row counting committed write transactions; see replication.py."""
+    __tablename__ = 'replication_heartbeat'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    written_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ReplicationHeartbeat {self.position} at {self.written_at}>'
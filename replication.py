@@ -0,0 +1,200 @@
+"""
+Read-replica routing.
+
+With DB_REPLICA_URI set, GET and HEAD handlers (the product, location,
+movement and report pages and the JSON API) read from the ``replica``
+bind, and everything else, including every write, uses the primary.
+Any database SQLAlchemy can reach works as the replica, as long as the
+``replication_heartbeat`` table is replicated with the rest.
+
+Replica freshness is tracked with that heartbeat: every transaction that
+writes to the primary also advances ``position`` and stamps
+``written_at`` before it commits. Comparing the replica's copy of the row
+with the primary's tells how far behind it is. A replica that is behind
+is taken to be as stale as its newest write, so the lag estimate errs
+towards reading from the primary.
+
+For each read request, route_reads() picks the engine:
+
+- If this client's last write is not on the replica yet, it reads from the
+  primary. The write's position is kept in the session cookie, which
+  gives read-your-writes.
+- If the replica lags more than DB_REPLICA_MAX_LAG seconds, the read falls
+  back to the primary.
+- Otherwise it reads from the replica.
+
+Both heartbeats are read at most once per DB_REPLICA_CHECK_INTERVAL
+seconds per process. Pages and fragments read from a replica are cached
+under its position (see cache.py), so a lagging replica never caches
+stale markup under a new data version.
+
+replicate_sqlite() is a stand-in for real replication with two SQLite
+files. It copies the primary over the replica with SQLite's online backup
+API, and ``flask replicate`` repeats that on an interval. It copies the
+whole file each time, so it is meant for local testing, not large
+databases.
+"""
+
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
+from flask import current_app, g, has_request_context, request, session
+from sqlalchemy import event, select, update
+from db_profile import READ_METHODS, REPLICA_BIND
+from models import db, ReplicationHeartbeat
+
+
+SESSION_KEY = 'replica_position'
+
+_WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+_heartbeat = ReplicationHeartbeat.__table__
+
+
+def ensure_heartbeat():
+    """Add the heartbeat row if it is missing. Does not commit."""
+    if db.session.get(ReplicationHeartbeat, 1) is None:
+        db.session.add(ReplicationHeartbeat(id=1, position=0))
+
+
+def install_heartbeat(engine):
+    """Advance the heartbeat in every transaction on ``engine`` that writes."""
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def note_write(conn, cursor, statement, parameters, context, executemany):
+        # rowcount is -1 when the driver cannot tell, which counts as a write
+        if (cursor.rowcount != 0 and _WRITE_STATEMENT.match(statement)
+                and _heartbeat.name not in statement):
+            conn.info['replication_dirty'] = True
+
+    @event.listens_for(engine, 'commit')
+    def beat(conn):
+        if not conn.info.pop('replication_dirty', False):
+            return
+        conn.execute(update(_heartbeat).where(_heartbeat.c.id == 1).values(
+            position=_heartbeat.c.position + 1, written_at=datetime.utcnow()))
+        if has_request_context():
+            g.replication_position = conn.execute(
+                select(_heartbeat.c.position).where(_heartbeat.c.id == 1)).scalar()
+
+    @event.listens_for(engine, 'rollback')
+    def discard(conn):
+        conn.info.pop('replication_dirty', None)
+
+
+def _heartbeat_row(engine):
+    with engine.connect() as connection:
+        return connection.execute(
+            select(_heartbeat.c.position, _heartbeat.c.written_at).where(_heartbeat.c.id == 1)).first()
+
+
+class ReplicaMonitor:
+    """Caches the replica's position and lag, and counts routing decisions."""
+
+    def __init__(self, app=None):
+        self.replica_reads = 0
+        self.sticky_reads = 0
+        self.lagging_reads = 0
+        self._checked_at = None
+        self._status = (0, float('inf'))
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DB_REPLICA_MAX_LAG', 5.0)
+        app.config.setdefault('DB_REPLICA_CHECK_INTERVAL', 1.0)
+        app.config.setdefault('DB_REPLICA_SYNC_INTERVAL', 1.0)
+
+        self.app = app
+        app.extensions['replica_monitor'] = self
+        if not app.config['DB_REPLICA_URI']:
+            return
+
+        with app.app_context():
+            install_heartbeat(db.engines[None])
+        app.before_request(route_reads)
+        app.after_request(remember_write)
+
+    def status(self):
+        """``(replica position, lag in seconds)``, refreshed once per check interval."""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and \
+                    now - self._checked_at < self.app.config['DB_REPLICA_CHECK_INTERVAL']:
+                return self._status
+
+        try:
+            primary = _heartbeat_row(db.engines[None])
+            replica = _heartbeat_row(db.engines[REPLICA_BIND])
+        except Exception:
+            current_app.logger.warning('Replica heartbeat unavailable', exc_info=True)
+            primary = replica = None
+
+        if primary is None or replica is None:
+            status = (0, float('inf'))
+        elif replica.position >= primary.position:
+            status = (replica.position, 0.0)
+        else:
+            status = (replica.position, (datetime.utcnow() - replica.written_at).total_seconds())
+
+        with self._lock:
+            self._status, self._checked_at = status, now
+        return status
+
+    def stats(self):
+        position, lag = self.status()
+        return {
+            'replica_position': position,
+            'replica_lag_seconds': lag,
+            'replica_reads': self.replica_reads,
+            'sticky_reads': self.sticky_reads,
+            'lagging_reads': self.lagging_reads,
+        }
+
+
+replicas = ReplicaMonitor()
+
+
+def route_reads():
+    """Choose the engine for this request's reads (before_request)."""
+    # g outlives the request when a caller pushed the app context itself
+    for name in ('read_bind', 'read_source', 'replication_position'):
+        g.pop(name, None)
+    if request.method not in READ_METHODS:
+        return
+
+    position, lag = replicas.status()
+    if session.get(SESSION_KEY, 0) > position:
+        replicas.sticky_reads += 1
+    elif lag > current_app.config['DB_REPLICA_MAX_LAG']:
+        replicas.lagging_reads += 1
+    else:
+        session.pop(SESSION_KEY, None)
+        replicas.replica_reads += 1
+        g.read_bind = REPLICA_BIND
+        g.read_source = f'replica@{position}'
+
+
+def remember_write(response):
+    """Keep this client on the primary until the replica has its write (after_request)."""
+    position = g.get('replication_position')
+    if position is not None:
+        session[SESSION_KEY] = max(position, session.get(SESSION_KEY, 0))
+    return response
+
+
+def _sqlite_path(url):
+    database = url.database
+    return database[len('file:'):] if url.query.get('uri') else database
+
+
+def replicate_sqlite():
+    """Copy the primary SQLite file over the replica. Returns the replica's position."""
+    source = _sqlite_path(db.engines[None].url)
+    target = _sqlite_path(db.engines[REPLICA_BIND].url)
+    with closing(sqlite3.connect(source)) as src, closing(sqlite3.connect(target)) as dst:
+        src.backup(dst)
+    return _heartbeat_row(db.engines[REPLICA_BIND]).position
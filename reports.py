@@ -0,0 +1,65 @@
+"""
+Stock reports: current and as-of balances, velocity and reorder analytics,
+and balance exports.
+
+The ``reports`` blueprint is mounted at /reports. Analytics import NumPy
+only when first requested, so processes that never serve them do not pay
+for loading it.
+"""
+
+from datetime import timedelta
+from flask import Blueprint, current_app, jsonify, render_template, request
+import exporter
+from balances import balance_report
+from cache import cached_view
+from ledger import parse_as_of, parse_movement_filters
+from views import export_job, export_response, filter_options
+
+
+reports = Blueprint('reports', __name__, url_prefix='/reports')
+
+
+@reports.route('')
+@cached_view
+def balances():
+    filters = parse_movement_filters(request.args)
+    as_of = parse_as_of(request.args.get('as_of'))
+    
+    # Balance = SUM(qty where to_location = location_id) - SUM(qty where from_location = location_id),
+    # read from the materialized stock_balance table, or replayed from the nearest snapshot for as_of
+    balance_data = balance_report(filters['product_id'], filters['location_id'], as_of)
+    
+    return render_template('reports.html', balance_data=balance_data, filters=filters, as_of=as_of,
+                           **filter_options(filters['product_id'], filters['location_id']))
+
+
+@reports.route('/analytics')
+@cached_view(period=timedelta(hours=1))
+def analytics():
+    # NumPy is only loaded once analytics are asked for
+    from analytics import attach_names, parse_analytics_args, stock_analytics
+    
+    params = parse_analytics_args(request.args, current_app.config)
+    analytics = stock_analytics(**params)
+    # Lowest cover first: the cells closest to running out
+    rows = attach_names(analytics.rows(limit=current_app.config['ANALYTICS_PAGE_ROWS']))
+    
+    return render_template('analytics.html', rows=rows, analytics=analytics, params=params,
+                           **filter_options(params['product_id'], params['location_id']))
+
+
+@reports.route('/export')
+def export_balances():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exporter.FORMATS:
+        return jsonify(error='Unknown export format, expected csv or ndjson.'), 400
+    
+    if request.args.get('background') == '1':
+        params = {key: request.args[key] for key in ('product_id', 'location_id', 'as_of')
+                  if request.args.get(key)}
+        return export_job('export-balances', dict(params, format=fmt))
+    
+    filters = parse_movement_filters(request.args)
+    as_of = parse_as_of(request.args.get('as_of'))
+    rows = exporter.iter_balance_rows(filters['product_id'], filters['location_id'], as_of)
+    return export_response(fmt, exporter.BALANCE_COLUMNS, rows, 'balances')
@@ -0,0 +1,269 @@
+"""
+Hourly and daily movement rollups for charts.
+
+``movement_rollup_hour`` and ``movement_rollup_day`` hold, per location,
+product and time bucket, the quantities moved by type as
+get_movement_type() classifies them: IN, OUT, and TRANSFER split into the
+quantity transferred in and out of the location. Rows with ``product_id``
+0 total every product at a location and rows with ``location_id`` 0 every
+location for a product, so a chart reads one row per bucket whatever it is
+filtered by.
+
+The rollups are maintained like the stock balances: every movement write
+adds its per-bucket deltas in the same transaction (an edit or delete
+subtracts the old movement from its buckets and adds the new one), so
+each affected bucket ends up exactly as a recount would leave it. Archived
+movements keep their buckets. rebuild_rollups() recomputes both tables
+from the live and archived ledger.
+
+Weekly series are summed from the daily rollup.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from operator import itemgetter
+from sqlalchemy import case, delete, func, insert, literal, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from models import (db, movement_type, DailyMovementRollup, HourlyMovementRollup,
+                    ProductMovement, ProductMovementArchive)
+
+
+# Sentinel id for the all-products and all-locations totals
+ALL = 0
+
+ROLLUP_MODELS = {'hour': HourlyMovementRollup, 'day': DailyMovementRollup}
+GRANULARITIES = {'hour': timedelta(hours=1), 'day': timedelta(days=1), 'week': timedelta(weeks=1)}
+ROLLUP_COLUMNS = ('in_qty', 'out_qty', 'transfer_in_qty', 'transfer_out_qty')
+
+# Bucket starts in SQLAlchemy's SQLite DateTime storage format
+SQLITE_BUCKET_FORMATS = {'hour': '%Y-%m-%d %H:00:00.000000', 'day': '%Y-%m-%d 00:00:00.000000'}
+
+
+def bucket_start(timestamp, granularity):
+    """Start of the hour, day or week (from Monday) containing ``timestamp``."""
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == 'week':
+        day -= timedelta(days=day.weekday())
+    return day
+
+
+def _sides(from_location, to_location):
+    """``(location_id, column index)`` pairs a movement counts towards."""
+    kind = movement_type(from_location, to_location)
+    if kind == 'IN':
+        return [(to_location, 0)]
+    if kind == 'OUT':
+        return [(from_location, 1)]
+    return [(to_location, 2), (from_location, 3)]
+
+
+def _hour(state):
+    # A movement not yet flushed is stamped "now" by the column default
+    return bucket_start(state.timestamp or datetime.utcnow(), 'hour')
+
+
+def _accumulate(deltas, product_id, from_location, to_location, hour, qty):
+    day = hour.replace(hour=0)
+    for location_id, index in _sides(from_location, to_location):
+        for granularity, bucket in (('hour', hour), ('day', day)):
+            deltas[(granularity, location_id, product_id, bucket)][index] += qty
+            deltas[(granularity, location_id, ALL, bucket)][index] += qty
+            deltas[(granularity, ALL, product_id, bucket)][index] += qty
+            deltas[(granularity, ALL, ALL, bucket)][index] += qty
+
+
+def rollup_deltas(old=None, new=None):
+    """Per-bucket rollup deltas of a change, like ledger.balance_deltas().
+
+    Returns ``{(granularity, location_id, product_id, bucket): [in, out,
+    transfer_in, transfer_out]}``.
+    """
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for state, sign in ((old, -1), (new, 1)):
+        if state is not None:
+            _accumulate(deltas, state.product_id, state.from_location, state.to_location,
+                        _hour(state), sign * state.qty)
+    return deltas
+
+
+def insert_rollup_deltas(states):
+    """Combined rollup deltas of many inserted movements.
+
+    Movements are summed per product, locations and hour first, so the
+    eight bucket updates of a movement are made once per group of them.
+    """
+    groups = defaultdict(int)
+    for state in states:
+        groups[(state.product_id, state.from_location, state.to_location, _hour(state))] += state.qty
+
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for (product_id, from_location, to_location, hour), qty in groups.items():
+        _accumulate(deltas, product_id, from_location, to_location, hour, qty)
+    return deltas
+
+
+def _upsert_statement(model):
+    """INSERT ... ON CONFLICT that adds the inserted quantities to an existing row."""
+    dialect = db.session.get_bind().dialect.name
+    insert_ = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+    table = model.__table__
+    stmt = insert_(table)
+    return stmt.on_conflict_do_update(
+        index_elements=['location_id', 'product_id', 'bucket'],
+        set_={column: table.c[column] + stmt.excluded[column] for column in ROLLUP_COLUMNS},
+    )
+
+
+def apply_rollup_deltas(deltas):
+    """Add rollup deltas to the rollup tables. Does not commit.
+
+    A batch of inserts touches several rows per movement, so the upsert is
+    compiled once and run with executemany over plain tuples, like
+    importer.insert_movements().
+    """
+    if not deltas:
+        return
+
+    connection = db.session.connection()
+    keys = ['location_id', 'product_id', 'bucket', *ROLLUP_COLUMNS]
+    timestamp_type = HourlyMovementRollup.__table__.c.bucket.type.dialect_impl(connection.dialect)
+    to_db_timestamp = timestamp_type.bind_processor(connection.dialect) or (lambda value: value)
+
+    # Rows with the bucket already in the dialect's storage format
+    rows = defaultdict(list)
+    buckets = {}
+    for (granularity, location_id, product_id, bucket), values in deltas.items():
+        if any(values):
+            stored = buckets.get(bucket)
+            if stored is None:
+                stored = buckets[bucket] = to_db_timestamp(bucket)
+            rows[granularity].append((location_id, product_id, stored, *values))
+
+    for granularity, params in rows.items():
+        compiled = _upsert_statement(ROLLUP_MODELS[granularity]).compile(
+            dialect=connection.dialect, column_keys=keys)
+        if not compiled.positional:
+            params = [dict(zip(keys, row)) for row in params]
+        elif list(compiled.positiontup) != keys:
+            # Parameters in the compiled statement's positional order
+            ordered = itemgetter(*(keys.index(key) for key in compiled.positiontup))
+            params = [ordered(row) for row in params]
+        connection.exec_driver_sql(str(compiled), params)
+
+
+def bucket_expression(column, granularity):
+    """SQL for the start of the ``granularity`` bucket of a timestamp column."""
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return func.strftime(SQLITE_BUCKET_FORMATS[granularity], column)
+    return func.date_trunc(granularity, column)
+
+
+def _movement_rollup_sides(model, granularity):
+    """Incoming and outgoing per-movement rollup rows of a movement table."""
+    bucket = bucket_expression(model.timestamp, granularity).label('bucket')
+    zero = literal(0)
+    incoming = select(
+        model.to_location.label('location_id'),
+        model.product_id.label('product_id'),
+        bucket,
+        case((model.from_location.is_(None), model.qty), else_=0).label('in_qty'),
+        zero.label('out_qty'),
+        case((model.from_location.isnot(None), model.qty), else_=0).label('transfer_in_qty'),
+        zero.label('transfer_out_qty'),
+    ).where(model.to_location.isnot(None))
+    outgoing = select(
+        model.from_location.label('location_id'),
+        model.product_id.label('product_id'),
+        bucket,
+        zero.label('in_qty'),
+        case((model.to_location.is_(None), model.qty), else_=0).label('out_qty'),
+        zero.label('transfer_in_qty'),
+        case((model.to_location.isnot(None), model.qty), else_=0).label('transfer_out_qty'),
+    ).where(model.from_location.isnot(None))
+    return [incoming, outgoing]
+
+
+def _grouped(source, location_id, product_id):
+    """Sum ``source`` rows per bucket and the given location and product columns."""
+    keys = [column for column in (location_id, product_id) if not isinstance(column, int)]
+    return (
+        select(
+            literal(location_id) if isinstance(location_id, int) else location_id,
+            literal(product_id) if isinstance(product_id, int) else product_id,
+            source.c.bucket,
+            *(func.sum(source.c[column]) for column in ROLLUP_COLUMNS),
+        )
+        .group_by(*keys, source.c.bucket)
+    )
+
+
+def rebuild_rollups():
+    """Recompute both rollup tables from the live and archived ledger and commit.
+
+    Returns the number of hourly and daily rows written.
+    """
+    counts = {}
+    columns = ['location_id', 'product_id', 'bucket', *ROLLUP_COLUMNS]
+    for granularity, model in ROLLUP_MODELS.items():
+        db.session.execute(delete(model))
+
+        sides = union_all(*(side for movements in (ProductMovement, ProductMovementArchive)
+                            for side in _movement_rollup_sides(movements, granularity)))
+        sides = sides.subquery('sides')
+        db.session.execute(insert(model).from_select(
+            columns, _grouped(sides, sides.c.location_id, sides.c.product_id)))
+
+        # Totals, from the per-cell rows just written
+        cells = select(model).where(model.location_id != ALL, model.product_id != ALL).subquery('cells')
+        for location_id, product_id in ((cells.c.location_id, ALL), (ALL, cells.c.product_id), (ALL, ALL)):
+            db.session.execute(insert(model).from_select(
+                columns, _grouped(cells, location_id, product_id)))
+
+        counts[granularity] = db.session.scalar(select(func.count()).select_from(model))
+    db.session.commit()
+    return counts
+
+
+def rollup_series(granularity, start, end, location_id=None, product_id=None, max_buckets=None):
+    """Chart series for the buckets from the one containing ``start`` up to ``end`` (inclusive).
+
+    ``granularity`` is ``hour``, ``day`` or ``week``; omitted ids mean all
+    locations or all products. Returns a dict of parallel lists: the
+    bucket starts and the ``in``, ``out``, ``transfer_in`` and
+    ``transfer_out`` quantities, zero for buckets without movements. The
+    work is proportional to the number of buckets, not movements.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Unknown granularity {granularity!r}. Available: {", ".join(GRANULARITIES)}')
+    step = GRANULARITIES[granularity]
+    first = bucket_start(start, granularity)
+    count = (end - first) // step + 1 if end >= first else 0
+    if max_buckets is not None and count > max_buckets:
+        raise ValueError(f'{count} {granularity} buckets requested, at most {max_buckets} allowed.')
+
+    model = ROLLUP_MODELS['day' if granularity == 'week' else granularity]
+    rows = db.session.execute(
+        select(model.bucket, *(getattr(model, column) for column in ROLLUP_COLUMNS))
+        .where(model.location_id == (location_id or ALL), model.product_id == (product_id or ALL),
+               model.bucket >= first, model.bucket <= end)
+    )
+
+    series = {column: [0] * count for column in ROLLUP_COLUMNS}
+    for bucket, *values in rows:
+        index = (bucket - first) // step
+        for column, value in zip(ROLLUP_COLUMNS, values):
+            series[column][index] += value
+
+    return {
+        'granularity': granularity,
+        'location_id': location_id,
+        'product_id': product_id,
+        'buckets': [(first + step * index).isoformat() for index in range(count)],
+        'in': series['in_qty'],
+        'out': series['out_qty'],
+        'transfer_in': series['transfer_in_qty'],
+        'transfer_out': series['transfer_out_qty'],
+    }
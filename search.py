@@ -0,0 +1,126 @@
+"""
+Product and location search.
+
+On SQLite builds with FTS5, ``product_fts`` and ``location_fts`` index the
+names and descriptions/addresses as external-content tables: the text
+stays in ``product`` and ``location`` and triggers keep the index in step
+with every insert, update and delete, including bulk loads that bypass the
+ORM. Each search term matches as a prefix ("lap dell" finds "Laptop Dell
+XPS 15"), and results are ranked by bm25 with name matches weighted above
+the longer text column.
+
+Without FTS5 (or on another database) search falls back to LIKE over the
+same columns, ordered by name.
+"""
+
+import re
+from sqlalchemy import and_, or_, select, text
+from models import db, Product, Location
+
+
+# name weight, secondary column weight for bm25()
+NAME_WEIGHT = 10.0
+TEXT_WEIGHT = 1.0
+
+INDEXES = {
+    'products': (Product, 'product_fts', 'product_id', 'name', 'description'),
+    'locations': (Location, 'location_fts', 'location_id', 'name', 'address'),
+}
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def _index_ddl(table, key, name, other):
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"{name}, {other}, content='{table}', content_rowid='{key}', "
+        f"tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {name}, {other}) VALUES (new.{key}, new.{name}, new.{other}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {name}, {other}) "
+        f"VALUES ('delete', old.{key}, old.{name}, old.{other}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {name}, {other} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {name}, {other}) "
+        f"VALUES ('delete', old.{key}, old.{name}, old.{other}); "
+        f"INSERT INTO {fts}(rowid, {name}, {other}) VALUES (new.{key}, new.{name}, new.{other}); END",
+    ]
+
+
+def fts5_supported(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = connection.exec_driver_sql('PRAGMA compile_options').scalars().all()
+    return 'ENABLE_FTS5' in options
+
+
+def install_search_indexes(engine):
+    """Create the FTS5 tables and triggers if missing, indexing existing rows.
+
+    Returns False when the database has no FTS5, in which case search uses
+    LIKE. Safe to call on every start.
+    """
+    with engine.begin() as connection:
+        if not fts5_supported(connection):
+            return False
+
+        existing = set(connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%\\_fts' ESCAPE '\\'"
+        ).scalars())
+        for model, fts, key, name, other in INDEXES.values():
+            for statement in _index_ddl(model.__tablename__, key, name, other):
+                connection.exec_driver_sql(statement)
+            if fts not in existing:
+                connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    return True
+
+
+def has_search_index(kind):
+    """Whether the FTS table for ``kind`` exists in the session's database."""
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return False
+    return db.session.scalar(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': INDEXES[kind][1]},
+    ) is not None
+
+
+def _terms(query):
+    return _TERM.findall(query or '')
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query of quoted prefix terms, all required."""
+    return ' '.join(f'"{term}"*' for term in _terms(query))
+
+
+def search(kind, query, limit=20):
+    """Return up to ``limit`` ``(id, name)`` rows of ``kind`` matching ``query``.
+
+    ``kind`` is ``products`` or ``locations``. Best matches come first.
+    """
+    model, fts, key, name, other = INDEXES[kind]
+    terms = _terms(query)
+    if not terms:
+        return []
+
+    if has_search_index(kind):
+        return db.session.execute(
+            text(f"SELECT {fts}.rowid, {model.__tablename__}.{name} FROM {fts} "
+                 f"JOIN {model.__tablename__} ON {model.__tablename__}.{key} = {fts}.rowid "
+                 f"WHERE {fts} MATCH :match "
+                 f"ORDER BY bm25({fts}, {NAME_WEIGHT}, {TEXT_WEIGHT}) LIMIT :limit"),
+            {'match': match_expression(query), 'limit': limit},
+        ).all()
+
+    key_column, name_column, other_column = (getattr(model, column) for column in (key, name, other))
+    return db.session.execute(
+        select(key_column, name_column)
+        .where(and_(*(
+            or_(name_column.ilike(f'%{term}%'), other_column.ilike(f'%{term}%')) for term in terms
+        )))
+        .order_by(name_column, key_column)
+        .limit(limit)
+    ).all()
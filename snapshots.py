@@ -0,0 +1,102 @@
+"""
+Periodic balance snapshots for point-in-time reporting.
+
+A snapshot stores every non-zero balance as of an interval boundary,
+counting movements with a timestamp at or before it. Boundaries are
+aligned to the Unix epoch, so with a 24-hour interval snapshots fall at
+midnight UTC. Each snapshot is built from the previous one plus the
+movements in between, and intervals without movements are skipped.
+
+Snapshots are only valid while the movements before them are unchanged.
+A write that touches a timestamp at or before an existing snapshot (a
+backdated import, or an edit or delete of an old movement) deletes that
+snapshot and every later one in the same transaction; the next
+take_snapshots() run rebuilds them.
+"""
+
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, literal, select
+from models import db, BalanceSnapshot, BalanceSnapshotRow, ProductMovement, ProductMovementArchive
+from balances import balance_query
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def interval_end(timestamp, interval):
+    """Return the first interval boundary at or after ``timestamp``."""
+    periods = -((timestamp - EPOCH) // -interval)
+    return EPOCH + periods * interval
+
+
+def latest_snapshot(before=None):
+    """Return the latest snapshot, optionally only those taken at or before ``before``."""
+    query = select(BalanceSnapshot)
+    if before is not None:
+        query = query.where(BalanceSnapshot.taken_at <= before)
+    return db.session.scalars(query.order_by(BalanceSnapshot.taken_at.desc()).limit(1)).first()
+
+
+def _next_timestamp(after=None):
+    """Earliest movement timestamp after ``after``, live or archived."""
+    timestamps = []
+    for model in (ProductMovement, ProductMovementArchive):
+        query = select(func.min(model.timestamp))
+        if after is not None:
+            query = query.where(model.timestamp > after)
+        timestamp = db.session.scalar(query)
+        if timestamp is not None:
+            timestamps.append(timestamp)
+    return min(timestamps, default=None)
+
+
+def take_snapshots(interval=timedelta(days=1), until=None):
+    """Checkpoint balances at every interval boundary with movements, up to ``until``.
+
+    ``until`` defaults to now; only boundaries at or before it are taken, so
+    a snapshot never precedes movements still to be written for its period.
+    Returns the number of snapshots created and commits.
+    """
+    until = until or datetime.utcnow()
+    created = 0
+    previous = latest_snapshot()
+
+    while True:
+        first_timestamp = _next_timestamp(previous.taken_at if previous else None)
+        if first_timestamp is None:
+            break
+
+        taken_at = interval_end(first_timestamp, interval)
+        if taken_at > until:
+            break
+
+        snapshot = BalanceSnapshot(taken_at=taken_at)
+        db.session.add(snapshot)
+        db.session.flush()
+
+        balances = balance_query(
+            since=previous.taken_at if previous else None,
+            until=taken_at,
+            snapshot_id=previous.snapshot_id if previous else None,
+        ).subquery('balances')
+        db.session.execute(insert(BalanceSnapshotRow).from_select(
+            ['snapshot_id', 'product_id', 'location_id', 'qty'],
+            select(literal(snapshot.snapshot_id), balances.c.product_id,
+                   balances.c.location_id, balances.c.qty),
+        ))
+        db.session.commit()
+
+        previous = snapshot
+        created += 1
+
+    return created
+
+
+def invalidate_snapshots(since):
+    """Drop snapshots taken at or after ``since``. Does not commit."""
+    stale = select(BalanceSnapshot.snapshot_id).where(BalanceSnapshot.taken_at >= since)
+    if db.session.execute(stale.limit(1)).first() is None:
+        return
+
+    db.session.execute(delete(BalanceSnapshotRow).where(BalanceSnapshotRow.snapshot_id.in_(stale)))
+    db.session.execute(delete(BalanceSnapshot).where(BalanceSnapshot.taken_at >= since))
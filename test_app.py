@@ -3,8 +3,54 @@ Test Suite for Inventory Management System
 Run with: python test_app.py
 """
 
-from app import app, db, Product, Location, ProductMovement
-from sqlalchemy import func
+import gzip
+import io
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+# Run against a throwaway database so write tests never touch instance/inventory.db
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test_inventory.db'))
+
+from app import create_app
+from models import db, Product, Location, ProductMovement, StockBalance
+from cache import cache
+from db_profile import immediate_transactions
+from changefeed import prune_events
+from balances import (as_of_balance_query, balance_query, balance_report, compute_balances,
+                      movement_ranges, parallel_compute_balances, rebuild_stock_balances,
+                      stored_balance_query)
+from importer import import_movements
+from jobs import jobs
+from ledger import (has_movements, has_movements_query, movement_page, movement_page_query,
+                    movement_state, record_change, referenced_ids, referenced_ids_query)
+from analytics import stock_analytics
+from archive import archive_movements, verify_archive
+from bench import compare, run_benchmarks, run_stock_stress
+from commands import create_schema, seed_sample_data
+from datagen import generate_dataset, generate_movements
+from metrics import metrics
+from models import (BalanceSnapshot, HourlyMovementRollup, Job, MovementEvent, OpeningBalance,
+                    ProductMovementArchive)
+from replication import replicas, replicate_sqlite
+from rollups import rebuild_rollups, rollup_series
+import search as search_module
+from search import search
+from snapshots import take_snapshots
+from sqlalchemy import event, func, or_, select, update
+
+app = create_app()
+with app.app_context():
+    create_schema()
+    seed_sample_data()
 
 def test_database_connection():
     """Test database connection and tables"""
@@ -52,6 +98,9 @@ def test_sample_data():
             print(f"❌ Error checking sample data: {e}")
             return False
 
+def count_rows(statement):
+    return db.session.scalar(select(func.count()).select_from(statement.subquery()))
+
 def test_models():
     """Test model relationships"""
     print("\nTesting model relationships...")
@@ -60,13 +109,13 @@ def test_models():
             # Test Product model
             product = Product.query.first()
             print(f"✅ Product: {product.name}")
-            print(f"✅ Product has {len(product.movements)} movements")
+            print(f"✅ Product has {count_rows(product.movements.select())} movements")
             
             # Test Location model
             location = Location.query.first()
             print(f"✅ Location: {location.name}")
-            print(f"✅ Location has {len(location.movements_from)} outgoing movements")
-            print(f"✅ Location has {len(location.movements_to)} incoming movements")
+            print(f"✅ Location has {count_rows(location.movements_from.select())} outgoing movements")
+            print(f"✅ Location has {count_rows(location.movements_to.select())} incoming movements")
             
             # Test ProductMovement model
             movement = ProductMovement.query.first()
@@ -111,6 +160,1293 @@ def test_balance_calculation():
             print(f"❌ Error calculating balance: {e}")
             return False
 
+def test_balance_engine():
+    """Test grouped balance engine against per-cell sums"""
+    print("\nTesting balance engine...")
+    with app.app_context():
+        try:
+            expected = {}
+            for product in Product.query.all():
+                for location in Location.query.all():
+                    incoming = db.session.query(func.sum(ProductMovement.qty)).filter(
+                        ProductMovement.product_id == product.product_id,
+                        ProductMovement.to_location == location.location_id
+                    ).scalar() or 0
+                    outgoing = db.session.query(func.sum(ProductMovement.qty)).filter(
+                        ProductMovement.product_id == product.product_id,
+                        ProductMovement.from_location == location.location_id
+                    ).scalar() or 0
+                    if incoming - outgoing != 0:
+                        expected[(product.product_id, location.location_id)] = incoming - outgoing
+            
+            balances = {(row.product_id, row.location_id): row.qty for row in compute_balances()}
+            if balances != expected:
+                print(f"❌ Balance engine mismatch: {balances} != {expected}")
+                return False
+            print(f"✅ Balance engine matches per-cell sums ({len(balances)} non-zero cells)")
+            
+            product_id, location_id = next(iter(expected))
+            filtered = compute_balances(product_id=product_id, location_id=location_id)
+            if [tuple(row) for row in filtered] != [(product_id, location_id, expected[(product_id, location_id)])]:
+                print(f"❌ Filtered balance mismatch: {filtered}")
+                return False
+            by_product = compute_balances(product_id=product_id)
+            if any(row.product_id != product_id for row in by_product):
+                print("❌ Product filter returned other products")
+                return False
+            print("✅ Product and location filters applied")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing balance engine: {e}")
+            return False
+
+def test_stock_balance_maintenance():
+    """Test stock_balance is kept in sync by movement writes"""
+    print("\nTesting stock balance maintenance...")
+    with app.app_context():
+        try:
+            def stored(product_id, location_id):
+                balance = db.session.get(StockBalance, (product_id, location_id))
+                return balance.qty if balance else 0
+            
+            product = Product.query.first()
+            source, target = Location.query.order_by(Location.location_id).limit(2).all()
+            before_source = stored(product.product_id, source.location_id)
+            before_target = stored(product.product_id, target.location_id)
+            
+            client = app.test_client()
+            client.post('/movements/add', data={
+                'product_id': product.product_id, 'from_location': source.location_id,
+                'to_location': target.location_id, 'qty': 3,
+            })
+            movement = ProductMovement.query.order_by(ProductMovement.movement_id.desc()).first()
+            db.session.expire_all()
+            if (stored(product.product_id, source.location_id) != before_source - 3
+                    or stored(product.product_id, target.location_id) != before_target + 3):
+                print("❌ Insert did not update stock balances")
+                return False
+            print("✅ Insert applied to stock balances")
+            
+            client.post(f'/movements/edit/{movement.movement_id}', data={
+                'product_id': product.product_id, 'from_location': '',
+                'to_location': target.location_id, 'qty': 5,
+            })
+            db.session.expire_all()
+            if (stored(product.product_id, source.location_id) != before_source
+                    or stored(product.product_id, target.location_id) != before_target + 5):
+                print("❌ Edit did not apply old-vs-new delta")
+                return False
+            print("✅ Edit applied old-vs-new delta")
+            
+            client.post(f'/movements/delete/{movement.movement_id}')
+            db.session.expire_all()
+            if stored(product.product_id, target.location_id) != before_target:
+                print("❌ Delete did not reverse stock balances")
+                return False
+            print("✅ Delete reversed stock balances")
+            
+            drift = rebuild_stock_balances(check_only=True)
+            if drift:
+                print(f"❌ Stock balances drifted from movement log: {drift}")
+                return False
+            print("✅ Stock balances match movement log")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing stock balance maintenance: {e}")
+            return False
+
+def test_movement_pagination():
+    """Test keyset pagination walks the ledger exactly once"""
+    print("\nTesting movement pagination...")
+    with app.app_context():
+        try:
+            seen = []
+            cursor = None
+            while True:
+                page, cursor = movement_page(cursor=cursor, per_page=6)
+                seen.extend(movement.movement_id for movement in page)
+                if cursor is None:
+                    break
+            
+            expected = [movement.movement_id for movement in ProductMovement.query.order_by(
+                ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc()).all()]
+            if seen != expected:
+                print(f"❌ Pages returned {len(seen)} movements, expected {len(expected)}")
+                return False
+            print(f"✅ Walked {len(seen)} movements in pages of 6")
+            
+            page, _ = movement_page(filters={'type': 'OUT'}, per_page=100)
+            if not page or any(movement.get_movement_type() != 'OUT' for movement in page):
+                print("❌ Type filter returned other movement types")
+                return False
+            print("✅ Type filter applied")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing movement pagination: {e}")
+            return False
+
+def explain_query_plan(statement):
+    """Return the EXPLAIN QUERY PLAN detail lines for a SQLAlchemy statement"""
+    compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+    with db.engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)
+        return [row[3] for row in rows]
+
+def test_query_plans():
+    """Test hot queries are served by indexes rather than table scans"""
+    print("\nTesting query plans...")
+    with app.app_context():
+        try:
+            cursor = f'{datetime.utcnow().isoformat()}_1'
+            hot_queries = [
+                ('product balance', balance_query(product_id=1)),
+                ('location balance', balance_query(location_id=1)),
+                ('product/location balance', balance_query(product_id=1, location_id=1)),
+                ('stored product balance', stored_balance_query(product_id=1)),
+                ('stored location balance', stored_balance_query(location_id=1)),
+                ('ledger first page', movement_page_query()),
+                ('ledger next page', movement_page_query(cursor=cursor)),
+                ('ledger by product', movement_page_query({'product_id': 1})),
+                ('ledger by location', movement_page_query({'location_id': 1})),
+                ('product delete guard', has_movements_query(product_id=1)),
+                ('location delete guard', has_movements_query(location_id=1)),
+                ('products in use', referenced_ids_query(Product, [1, 2])),
+                ('locations in use', referenced_ids_query(Location, [1, 2])),
+            ]
+            
+            passed = True
+            for name, statement in hot_queries:
+                # A SCAN of a real table with no index is a full table scan
+                scans = [line for line in explain_query_plan(statement)
+                         if line.startswith('SCAN ') and 'USING' not in line
+                         and line.split()[1] in db.metadata.tables]
+                if scans:
+                    print(f"❌ {name}: {scans}")
+                    passed = False
+                else:
+                    print(f"✅ {name}: indexed")
+            
+            return passed
+        except Exception as e:
+            print(f"❌ Error testing query plans: {e}")
+            return False
+
+def test_bulk_import():
+    """Test streaming CSV/NDJSON import with per-row errors"""
+    print("\nTesting bulk import...")
+    with app.app_context():
+        try:
+            before = ProductMovement.query.count()
+            client = app.test_client()
+            
+            csv_file = (
+                "product_id,from_location,to_location,qty\n"
+                "1,,1,5\n"
+                "1,1,1,5\n"
+                "2,1,,0\n"
+                "9999,,1,1\n"
+                "2,1,3,4\n"
+            )
+            response = client.post('/movements/import', data={
+                'file': (io.BytesIO(csv_file.encode()), 'movements.csv'),
+            })
+            result = response.get_json()
+            if result['inserted'] != 2 or [error['line'] for error in result['errors']] != [3, 4, 5]:
+                print(f"❌ Unexpected CSV import result: {result}")
+                return False
+            print(f"✅ CSV import: {result['inserted']} inserted, {result['error_count']} rejected")
+            
+            ndjson_file = '{"product_id": 3, "to_location": 2, "qty": 7}\nnot json\n'
+            response = client.post('/movements/import', data=ndjson_file,
+                                   content_type='application/x-ndjson')
+            result = response.get_json()
+            if result['inserted'] != 1 or result['error_count'] != 1:
+                print(f"❌ Unexpected NDJSON import result: {result}")
+                return False
+            print("✅ NDJSON import from raw request body")
+            
+            if ProductMovement.query.count() != before + 3:
+                print("❌ Imported rows missing from movement log")
+                return False
+            
+            drift = rebuild_stock_balances(check_only=True)
+            if drift:
+                print(f"❌ Import left stock balances out of sync: {drift}")
+                return False
+            print("✅ Stock balances updated by import")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing bulk import: {e}")
+            return False
+
+def test_streaming_export():
+    """Test CSV/NDJSON export of the ledger and balance report"""
+    print("\nTesting streaming export...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            
+            response = client.get('/movements/export?type=OUT')
+            lines = response.data.decode().splitlines()
+            expected = ProductMovement.query.filter(
+                ProductMovement.from_location.isnot(None),
+                ProductMovement.to_location.is_(None)
+            ).count()
+            if response.mimetype != 'text/csv' or len(lines) != expected + 1:
+                print(f"❌ Movement CSV export returned {len(lines) - 1} rows, expected {expected}")
+                return False
+            print(f"✅ Movement CSV export: {expected} OUT movements")
+            
+            response = client.get('/reports/export?format=ndjson')
+            rows = [json.loads(line) for line in response.data.decode().splitlines()]
+            balances = {(row.product_id, row.location_id): row.qty for row in compute_balances()}
+            if {(row['product_id'], row['location_id']): row['qty'] for row in rows} != balances:
+                print("❌ Balance NDJSON export does not match balances")
+                return False
+            print(f"✅ Balance NDJSON export: {len(rows)} rows")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing streaming export: {e}")
+            return False
+
+def test_report_cache():
+    """Test cached pages revalidate with ETags and are invalidated by writes"""
+    print("\nTesting report cache...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            
+            first = client.get('/reports')
+            etag = first.headers.get('ETag')
+            if not etag or not first.headers.get('Last-Modified'):
+                print("❌ Cached page has no ETag/Last-Modified")
+                return False
+            
+            hits = cache.hits
+            if client.get('/reports').data != first.data or cache.hits != hits + 1:
+                print("❌ Second request was not served from cache")
+                return False
+            print("✅ Repeat request served from cache")
+            
+            if client.get('/reports', headers={'If-None-Match': etag}).status_code != 304:
+                print("❌ Matching ETag did not return 304")
+                return False
+            print("✅ Matching ETag returned 304")
+            
+            product = Product.query.first()
+            client.post(f'/products/edit/{product.product_id}',
+                        data={'name': product.name, 'description': product.description})
+            client.get('/products')  # consume the flash message
+            if client.get('/reports', headers={'If-None-Match': etag}).status_code != 200:
+                print("❌ Write did not invalidate cached page")
+                return False
+            print("✅ Write invalidated cached pages")
+            
+            # Another worker or a CLI command writing, in a process of its own
+            etag = client.get('/reports').headers['ETag']
+            other = subprocess.run(
+                [sys.executable, '-c', 'import app; from cache import cache; '
+                 'instance = app.create_app(); instance.app_context().push(); cache.bump_version()'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+            if other.returncode != 0 or \
+                    client.get('/reports', headers={'If-None-Match': etag}).status_code != 200:
+                print(f"❌ Version bumped by another process not seen: {other.stderr}")
+                return False
+            print("✅ Versions bumped by another process invalidate this one's pages")
+            
+            # The analytics window ends now, so its page moves on with the hour
+            analytics_etag = client.get('/reports/analytics').headers['ETag']
+            etag = client.get('/reports').headers['ETag']
+            with mock.patch('time.time', return_value=time.time() + 3600):
+                later = client.get('/reports/analytics', headers={'If-None-Match': analytics_etag})
+                balances = client.get('/reports', headers={'If-None-Match': etag})
+            if later.status_code != 200 or later.headers['ETag'] == analytics_etag \
+                    or balances.status_code != 304:
+                print("❌ Analytics page not revalidated in the next hour")
+                return False
+            print("✅ Analytics page is re-rendered every hour, other reports only on writes")
+            
+            stats = client.get('/cache/stats').get_json()
+            print(f"✅ Cache stats: {stats['hits']} hits, {stats['misses']} misses")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing report cache: {e}")
+            return False
+
+def test_fragment_cache():
+    """Test list tables are cached as fragments invalidated per table"""
+    print("\nTesting fragment cache...")
+    with app.app_context():
+        # Bypass the page cache so every request reaches the fragments
+        cache.enabled = False
+        try:
+            client = app.test_client()
+            first = client.get('/products').data
+            hits = cache.fragment_hits
+            if client.get('/products').data != first or cache.fragment_hits != hits + 1:
+                print("❌ Products table not served from its fragment")
+                return False
+            print("✅ Repeat render served the table from its fragment")
+            
+            location = Location.query.first()
+            client.post(f'/locations/edit/{location.location_id}',
+                        data={'name': location.name + ' (moved)', 'address': location.address})
+            hits, misses = cache.fragment_hits, cache.fragment_misses
+            client.get('/products')
+            if cache.fragment_hits != hits + 1 or b'(moved)' not in client.get('/locations').data \
+                    or cache.fragment_misses != misses + 1:
+                print("❌ Location write invalidated the wrong fragments")
+                return False
+            if b'(moved)' not in client.get('/movements').data:
+                print("❌ Movements table shows a stale location name")
+                return False
+            print("✅ A location write only re-renders the tables that show locations")
+            
+            product = Product.query.first()
+            name = product.name
+            client.post(f'/products/edit/{product.product_id}',
+                        data={'name': name + ' v2', 'description': product.description})
+            if f'{name} v2'.encode() not in client.get('/products').data:
+                print("❌ Product write did not re-render the products table")
+                return False
+            client.post(f'/locations/edit/{location.location_id}',
+                        data={'name': location.name.replace(' (moved)', ''), 'address': location.address})
+            client.post(f'/products/edit/{product.product_id}',
+                        data={'name': name, 'description': product.description})
+            print("✅ Product writes re-render the products table")
+            
+            compiled = os.listdir(app.config['TEMPLATE_CACHE_DIR'])
+            if not any(name.endswith('.cache') for name in compiled):
+                print("❌ No compiled templates in the bytecode cache")
+                return False
+            print(f"✅ {len(compiled)} compiled template(s) in the bytecode cache")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing fragment cache: {e}")
+            return False
+        finally:
+            cache.enabled = app.config['CACHE_ENABLED']
+
+def test_as_of_balances():
+    """Test point-in-time balances from snapshots plus log replay"""
+    print("\nTesting as-of balances...")
+    with app.app_context():
+        try:
+            # Backdated history over ten days, well before the sample data
+            start = datetime(2001, 3, 1, 9, 30)
+            records = [(line, (1, None, 1, 10, (start + timedelta(days=day)).isoformat()))
+                       for line, day in enumerate(range(10), 1)]
+            records += [(11 + day, (1, 1, 2, 3, (start + timedelta(days=day, hours=5)).isoformat()))
+                        for day in range(0, 10, 2)]
+            import_movements(records)
+            
+            checkpoints = [start + timedelta(days=day, hours=hours)
+                           for day in range(11) for hours in (0, 6)]
+            
+            def matches():
+                for as_of in checkpoints:
+                    replayed = db.session.execute(as_of_balance_query(as_of)).all()
+                    expected = db.session.execute(balance_query(until=as_of)).all()
+                    if replayed != expected:
+                        print(f"❌ As-of {as_of}: {replayed} != {expected}")
+                        return False
+                return True
+            
+            created = take_snapshots(interval=timedelta(days=1), until=datetime(2001, 3, 20))
+            if created != 10 or not matches():
+                print(f"❌ Snapshots ({created}) gave wrong as-of balances")
+                return False
+            print(f"✅ {created} daily snapshots match full log replay")
+            
+            old = ProductMovement.query.filter(ProductMovement.timestamp == start + timedelta(days=4)).first()
+            app.test_client().post(f'/movements/edit/{old.movement_id}',
+                                   data={'product_id': 1, 'to_location': 1, 'qty': 25})
+            db.session.expire_all()
+            remaining = BalanceSnapshot.query.count()
+            if remaining != 4 or not matches():
+                print(f"❌ Backdated edit left {remaining} snapshots or wrong balances")
+                return False
+            print("✅ Backdated edit invalidated later snapshots")
+            
+            response = app.test_client().get('/reports?as_of=2001-03-05')
+            if response.status_code != 200 or b'as of 2001-03-05 23:59' not in response.data:
+                print("❌ Reports page did not render as-of balances")
+                return False
+            print("✅ /reports?as_of= renders historical balances")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing as-of balances: {e}")
+            return False
+
+def test_archive():
+    """Test archiving old movements into opening balances"""
+    print("\nTesting ledger archival...")
+    with app.app_context():
+        try:
+            product = Product(name='Archived Widget')
+            db.session.add(product)
+            db.session.commit()
+            start = datetime(1999, 6, 1, 12, 0)
+            records = [(day, (product.product_id, None, 1, 5, (start + timedelta(days=day)).isoformat()))
+                       for day in range(5)]
+            # The newest movement always stays live, so end with a current one
+            import_movements(records + [(6, (product.product_id, 1, None, 1, None))])
+            
+            checkpoints = [datetime(1999, 6, 3), datetime(2001, 3, 3), datetime(2001, 3, 4, 12),
+                           datetime(2001, 3, 12), datetime(2001, 3, 20)]
+            before = [db.session.execute(as_of_balance_query(as_of)).all() for as_of in checkpoints]
+            current = db.session.execute(stored_balance_query()).all()
+            live = ProductMovement.query.count()
+            old = ProductMovement.query.filter(ProductMovement.timestamp < datetime(2001, 3, 4)).count()
+            
+            result = archive_movements(datetime(2001, 3, 4), batch_size=4, verify=True)
+            if result.problems or result.archived != old or result.batches != -(-old // 4):
+                print(f"❌ Archived {result.archived} in {result.batches} batches: {result.problems}")
+                return False
+            if ProductMovement.query.count() != live - old or ProductMovementArchive.query.count() != old:
+                print("❌ Movements were not moved to the archive")
+                return False
+            print(f"✅ Archived {result.archived} movements in {result.batches} batches")
+            
+            after = [db.session.execute(as_of_balance_query(as_of)).all() for as_of in checkpoints]
+            if after != before or db.session.execute(stored_balance_query()).all() != current:
+                print("❌ Archiving changed current or as-of balances")
+                return False
+            if compute_balances() != db.session.execute(stored_balance_query()).all() or verify_archive():
+                print("❌ Opening balances plus ledger do not match stock balances")
+                return False
+            opening = db.session.get(OpeningBalance, (product.product_id, 1))
+            if opening is None or opening.qty != 25:
+                print("❌ Opening balance not folded from archived movements")
+                return False
+            print("✅ Current and as-of balances unchanged, opening balances verified")
+            
+            response = app.test_client().post(f'/products/delete/{product.product_id}')
+            db.session.expire_all()
+            if db.session.get(Product, product.product_id) is None:
+                print("❌ Product with archived movements was deleted")
+                return False
+            print("✅ Products with archived movements cannot be deleted")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing ledger archival: {e}")
+            return False
+
+def test_request_metrics():
+    """Test per-request SQL counts and the /metrics endpoint"""
+    print("\nTesting request metrics...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            metrics.query_header = True
+            try:
+                # Each request starts its own transaction, as it would outside the test
+                db.session.commit()
+                small = client.get('/movements?per_page=2').headers.get('X-Query-Count')
+                db.session.commit()
+                large = client.get('/movements?per_page=40').headers.get('X-Query-Count')
+            finally:
+                metrics.query_header = False
+            
+            if small is None or small != large:
+                print(f"❌ Ledger query count grows with page size: {small} vs {large}")
+                return False
+            print(f"✅ Ledger page runs {small} queries whatever its size")
+            
+            body = client.get('/metrics').get_data(as_text=True)
+            expected = [
+                'inventory_request_duration_seconds_count{endpoint="inventory.movements"} ',
+                'inventory_request_sql_statements_bucket{endpoint="inventory.movements",le="+Inf"} ',
+                'inventory_request_sql_seconds_total{endpoint="inventory.movements"} ',
+                'inventory_slow_statement_seconds{endpoint=',
+                'inventory_cache_hits_total ',
+            ]
+            missing = [line for line in expected if line not in body]
+            if missing:
+                print(f"❌ /metrics is missing {missing}")
+                return False
+            print("✅ /metrics exposes latency, SQL and cache metrics")
+            
+            with db.engine.connect() as connection:
+                for _ in range(3):
+                    try:
+                        connection.exec_driver_sql('SELECT * FROM no_such_table')
+                    except Exception:
+                        connection.rollback()
+                leftover = connection.info.get('metrics_started')
+            if leftover:
+                print(f"❌ Failed statements left {len(leftover)} timer(s) on the connection")
+                return False
+            print("✅ Failed statements leave no timing state behind")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing request metrics: {e}")
+            return False
+
+def test_synthetic_data():
+    """Test the seeded data generator and the benchmark harness"""
+    print("\nTesting synthetic data and benchmarks...")
+    with app.app_context():
+        try:
+            import random
+            window = (datetime(2023, 1, 1), datetime(2023, 2, 1))
+            first = list(generate_movements(random.Random(7), [1, 2, 3], [1, 2, 3, 4], 500, *window))
+            second = list(generate_movements(random.Random(7), [1, 2, 3], [1, 2, 3, 4], 500, *window))
+            if first != second:
+                print("❌ Same seed produced different movements")
+                return False
+            
+            kinds = {ProductMovement(from_location=state.from_location,
+                                     to_location=state.to_location).get_movement_type()
+                     for state in first}
+            if kinds != {'IN', 'OUT', 'TRANSFER'}:
+                print(f"❌ Generated movement mix is {kinds}")
+                return False
+            print("✅ Generator is deterministic and mixes IN/OUT/TRANSFER")
+            
+            products = Product.query.count()
+            movements = ProductMovement.query.count()
+            counts = generate_dataset(products=20, locations=5, movements=2000, seed=11, days=30)
+            if (Product.query.count() != products + 20
+                    or ProductMovement.query.count() != movements + counts['movements']
+                    or rebuild_stock_balances(check_only=True)):
+                print("❌ Generated dataset was not loaded consistently")
+                return False
+            generated = select(Product.product_id).where(Product.name.like('Product 11-%'))
+            negative = StockBalance.query.filter(StockBalance.product_id.in_(generated),
+                                                 StockBalance.qty < 0).count()
+            if negative:
+                print(f"❌ Generated data left {negative} negative balances")
+                return False
+            print(f"✅ Generated {counts['movements']} movements with no negative stock")
+            
+            results = run_benchmarks(app, requests=3, names=['movements', 'reports', 'add_movement',
+                                                        'delete_movement'])
+            if set(results) != {'movements', 'reports', 'add_movement', 'delete_movement'} or \
+                    results['movements']['queries'] < 1:
+                print(f"❌ Unexpected benchmark results: {results}")
+                return False
+            slower = {name: dict(stats, p95_ms=stats['p95_ms'] * 3 + 10, queries=stats['queries'] + 1)
+                      for name, stats in results.items()}
+            if compare(results, results) or len(compare(slower, results)) != 2 * len(results):
+                print("❌ Baseline comparison did not flag regressions correctly")
+                return False
+            print(f"✅ Benchmarked {len(results)} scenarios; /movements p95 "
+                  f"{results['movements']['p95_ms']}ms, {results['movements']['queries']} queries")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing synthetic data: {e}")
+            return False
+
+def test_engine_profile():
+    """Test the production SQLite pragmas and read-only routing of GET requests"""
+    print("\nTesting engine profile...")
+    with app.app_context():
+        try:
+            with db.engine.connect() as connection:
+                settings = {name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+                            for name in ('journal_mode', 'synchronous', 'busy_timeout')}
+            if settings != {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000}:
+                print(f"❌ Unexpected connection settings: {settings}")
+                return False
+            print("✅ Connections use WAL, synchronous=NORMAL and a busy timeout")
+            
+            reader = db.engines['readonly']
+            try:
+                with reader.begin() as connection:
+                    connection.exec_driver_sql('DELETE FROM stock_balance')
+                print("❌ Read-only engine accepted a write")
+                return False
+            except Exception as e:
+                if 'readonly' not in str(e):
+                    raise
+            
+            app.config['DB_READ_ONLY_GETS'] = True
+            try:
+                db.session.commit()
+                binds = []
+                listener = lambda conn, *args: binds.append(conn.engine)
+                event.listen(reader, 'before_cursor_execute', listener)
+                response = app.test_client().get('/movements')
+                event.remove(reader, 'before_cursor_execute', listener)
+            finally:
+                app.config['DB_READ_ONLY_GETS'] = False
+                db.session.commit()
+            
+            if response.status_code != 200 or not binds:
+                print("❌ GET request was not served from the read-only engine")
+                return False
+            print("✅ GET requests can be routed to a read-only engine")
+            
+            def other_writer_blocked():
+                connection = sqlite3.connect(db.engine.url.database, timeout=0)
+                try:
+                    connection.execute('BEGIN IMMEDIATE')
+                    connection.rollback()
+                    return False
+                except sqlite3.OperationalError:
+                    return True
+                finally:
+                    connection.close()
+            
+            # A deferred read lets another writer commit, after which this
+            # transaction could not write any more
+            db.session.scalar(select(func.count(ProductMovement.movement_id)))
+            deferred = other_writer_blocked()
+            db.session.rollback()
+            with immediate_transactions():
+                db.session.scalar(select(func.count(ProductMovement.movement_id)))
+                immediate = other_writer_blocked()
+            db.session.rollback()
+            if deferred or not immediate or 'archive-movements' not in jobs.writing_tasks:
+                print("❌ Writers outside requests do not take the write lock up front")
+                return False
+            print("✅ Writers outside requests begin with BEGIN IMMEDIATE")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing engine profile: {e}")
+            return False
+
+def test_negative_stock():
+    """Test that writes cannot take a stock balance below zero"""
+    print("\nTesting negative stock prevention...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            product = Product(name='Scarce Part')
+            db.session.add(product)
+            db.session.commit()
+            product_id = product.product_id
+            
+            def balance():
+                db.session.expire_all()
+                return db.session.get(StockBalance, (product_id, 1)).qty
+            
+            client.post('/movements/add', data={'product_id': product_id, 'to_location': 1, 'qty': 5})
+            incoming = ProductMovement.query.filter_by(product_id=product_id).one()
+            movements = ProductMovement.query.count()
+            
+            client.post('/movements/add', data={'product_id': product_id, 'from_location': 1, 'qty': 6})
+            response = client.get('/movements')
+            if ProductMovement.query.count() != movements or balance() != 5 \
+                    or b'Not enough stock' not in response.data:
+                print("❌ Oversized OUT movement was accepted")
+                return False
+            print("✅ OUT movement larger than the balance rejected")
+            
+            client.post('/movements/add', data={'product_id': product_id, 'from_location': 1,
+                                                'to_location': 2, 'qty': 3})
+            client.post(f'/movements/delete/{incoming.movement_id}')
+            client.get('/movements')
+            if db.session.get(ProductMovement, incoming.movement_id) is None or balance() != 2:
+                print("❌ Deleting stock that was moved on was accepted")
+                return False
+            print("✅ Deleting an IN movement whose stock was used rejected")
+            
+            result = import_movements([
+                (2, (product_id, 1, None, 3, None)),
+                (3, (product_id, None, 1, 4, None)),
+                (4, (product_id, 1, None, 5, None)),
+                (5, (product_id, 1, None, 2, None)),
+            ])
+            if result.inserted != 2 or [line for line, _ in result.errors] != [2, 5] or balance() != 1:
+                print(f"❌ Import stock check wrong: {result.as_dict()}, balance {balance()}")
+                return False
+            print("✅ Import rejects rows against a running balance")
+            
+            import_movements([(6, (product_id, None, 1, 9, None))])
+            
+            def racing_records():
+                yield 7, (product_id, 1, None, 6, None)
+                yield 8, None
+                # Another writer takes stock after line 7 was checked
+                taken = ProductMovement(product_id=product_id, from_location=1, qty=8,
+                                        timestamp=datetime.utcnow())
+                db.session.add(taken)
+                record_change(new=movement_state(taken), movement=taken)
+                yield 9, (product_id, None, 2, 1, None)
+                yield 10, (product_id, 2, None, 1, None)
+            
+            result = import_movements(racing_records(), batch_size=2)
+            if result.inserted != 2 or sorted(line for line, _ in result.errors) != [7, 8] \
+                    or balance() != 2 or compute_balances(product_id) \
+                    != db.session.execute(stored_balance_query(product_id)).all():
+                print(f"❌ Import did not recover from a refused batch: {result.as_dict()}")
+                return False
+            print("✅ Import rechecks a batch refused by the stock balances and continues")
+            
+            stats = run_stock_stress(app, threads=4, seconds=1, hot_stock=20)
+            if stats['lowest_balance'] < 0 or stats['drift'] or stats['hot_taken'] > 20 \
+                    or stats['hot_balance'] != 20 - stats['hot_taken']:
+                print(f"❌ Concurrent withdrawals broke the balance: {stats}")
+                return False
+            print(f"✅ {stats['hot_taken']} of 20 units taken by 4 threads "
+                  f"({stats['hot_rejected']} rejected), no negative balance")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing negative stock prevention: {e}")
+            return False
+
+def test_movement_batch():
+    """Test posting many movements in one request"""
+    print("\nTesting batch movement API...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            product = Product(name='Batch Part')
+            db.session.add(product)
+            db.session.commit()
+            product_id = product.product_id
+            
+            def balance(location_id):
+                db.session.expire_all()
+                row = db.session.get(StockBalance, (product_id, location_id))
+                return row.qty if row else 0
+            
+            movements = ProductMovement.query.count()
+            response = client.post('/api/v1/movements/batch', json=[
+                {'product_id': product_id, 'to_location': 1, 'qty': 10},
+                {'product_id': product_id, 'from_location': 1, 'to_location': 2, 'qty': 4},
+                {'product_id': product_id, 'from_location': 1, 'qty': 20},
+                {'product_id': 999999, 'to_location': 1, 'qty': 1},
+                {'product_id': product_id, 'qty': 1},
+            ])
+            statuses = [line['status'] for line in response.get_json()['results']]
+            if response.status_code != 422 \
+                    or statuses != ['not_applied', 'not_applied', 'not_applied', 'rejected', 'rejected'] \
+                    or ProductMovement.query.count() != movements:
+                print(f"❌ Invalid batch not rejected as a whole: {response.status_code} {statuses}")
+                return False
+            print("✅ Batch with invalid lines rejected as a whole")
+            
+            response = client.post('/api/v1/movements/batch', json=[
+                {'product_id': product_id, 'to_location': 1, 'qty': 10},
+                {'product_id': product_id, 'from_location': 1, 'to_location': 2, 'qty': 4},
+                {'product_id': product_id, 'from_location': 1, 'qty': 20},
+            ])
+            statuses = [line['status'] for line in response.get_json()['results']]
+            if response.status_code != 422 or statuses != ['not_applied', 'not_applied', 'rejected'] \
+                    or ProductMovement.query.count() != movements or balance(1) != 0:
+                print(f"❌ Batch exceeding stock not rolled back: {response.status_code} {statuses}")
+                return False
+            print("✅ Batch exceeding stock rolled back")
+            
+            response = client.post('/api/v1/movements/batch', json={'partial': True, 'movements': [
+                {'product_id': product_id, 'to_location': 1, 'qty': 10},
+                {'product_id': product_id, 'from_location': 1, 'to_location': 2, 'qty': 4},
+                {'product_id': product_id, 'from_location': 1, 'qty': 20},
+                {'product_id': product_id, 'from_location': 1, 'qty': 6},
+            ]})
+            results = response.get_json()['results']
+            if response.status_code != 207 \
+                    or [line['status'] for line in results] != ['created', 'created', 'rejected', 'created'] \
+                    or ProductMovement.query.count() != movements + 3 \
+                    or balance(1) != 0 or balance(2) != 4:
+                print(f"❌ Partial batch wrong: {response.status_code} {results}")
+                return False
+            print("✅ Partial batch keeps the valid lines")
+            
+            response = client.post('/api/v1/movements/batch', json=[
+                {'product_id': product_id, 'from_location': 2, 'to_location': 1, 'qty': 4},
+                {'product_id': product_id, 'from_location': 1, 'qty': 4},
+            ])
+            ids = [line['movement_id'] for line in response.get_json()['results']]
+            if response.status_code != 201 or len(ids) != 2 \
+                    or any(db.session.get(ProductMovement, id_) is None for id_ in ids) \
+                    or balance(1) != 0 or balance(2) != 0:
+                print(f"❌ Valid batch not created: {response.status_code} {response.get_json()}")
+                return False
+            print("✅ Valid batch created in one transaction")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing batch movement API: {e}")
+            return False
+
+def test_json_api():
+    """Test the JSON API collections"""
+    print("\nTesting JSON API...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            
+            response = client.get('/api/v1/products?fields=name&limit=2')
+            body = response.get_json()
+            if response.status_code != 200 or len(body['data']) != 2 \
+                    or any(set(row) != {'name'} for row in body['data']):
+                print(f"❌ Sparse fieldset not applied: {body}")
+                return False
+            print("✅ Sparse fieldsets return only the requested fields")
+            
+            seen, cursor = [], None
+            while True:
+                url = '/api/v1/movements?fields=movement_id&limit=7'
+                body = client.get(url + (f'&cursor={cursor}' if cursor else '')).get_json()
+                seen.extend(row['movement_id'] for row in body['data'])
+                cursor = body['next_cursor']
+                if not cursor:
+                    break
+            expected = [movement.movement_id for movement in ProductMovement.query.order_by(
+                ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc())]
+            if seen != expected:
+                print("❌ Cursor pages do not cover the ledger exactly once")
+                return False
+            print(f"✅ Cursor pagination walked {len(seen)} movements in ledger order")
+            
+            body = client.get('/api/v1/balances?fields=product,location,qty&format=rows').get_json()
+            expected = [[row['product'], row['location'], row['quantity']] for row in balance_report()]
+            if body['fields'] != ['product', 'location', 'qty'] or body['rows'][:100] != expected[:100]:
+                print(f"❌ Balances do not match the report: {body['rows'][:3]}")
+                return False
+            print("✅ Balances in row format match the report")
+            
+            response = client.get('/api/v1/movements?limit=1000', headers={'Accept-Encoding': 'gzip'})
+            if response.headers.get('Content-Encoding') != 'gzip' \
+                    or json.loads(gzip.decompress(response.data))['data'] is None:
+                print("❌ Large response not gzip-compressed")
+                return False
+            print("✅ Large responses are gzip-compressed")
+            
+            if client.get('/api/v1/products?fields=bogus').status_code != 400 \
+                    or client.get('/api/v1/products/999999').status_code != 404:
+                print("❌ Bad requests not reported as JSON errors")
+                return False
+            print("✅ Unknown fields and missing items reported as errors")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing JSON API: {e}")
+            return False
+
+def test_search():
+    """Test full-text product and location search"""
+    print("\nTesting product and location search...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            client.post('/products/add', data={'name': 'Quokka Pallet Jack', 'description': 'Manual lifter'})
+            client.post('/products/add', data={'name': 'Lifter Strap', 'description': 'For quokka crates'})
+            jack = Product.query.filter_by(name='Quokka Pallet Jack').one()
+            
+            names = [name for _, name in search('products', 'quok')]
+            if names[:2] != ['Quokka Pallet Jack', 'Lifter Strap']:
+                print(f"❌ Prefix search wrong or name matches not ranked first: {names}")
+                return False
+            print("✅ Prefix search ranks name matches above description matches")
+            
+            client.post(f'/products/edit/{jack.product_id}', data={'name': 'Wombat Pallet Jack',
+                                                                   'description': 'Manual lifter'})
+            if [name for _, name in search('products', 'womb pal')] != ['Wombat Pallet Jack'] \
+                    or 'Wombat Pallet Jack' in [name for _, name in search('products', 'quokka')]:
+                print("❌ Search index not updated after an edit")
+                return False
+            print("✅ Triggers keep the index in sync with edits")
+            
+            original = search_module.has_search_index
+            search_module.has_search_index = lambda kind: False
+            try:
+                fallback = [name for _, name in search('products', 'womb jack')]
+            finally:
+                search_module.has_search_index = original
+            if fallback != ['Wombat Pallet Jack']:
+                print(f"❌ LIKE fallback wrong: {fallback}")
+                return False
+            print("✅ LIKE fallback finds the same product")
+            
+            body = client.get('/api/v1/search?type=locations&q=ware').get_json()
+            if 'Main Warehouse' not in [row['name'] for row in body['data']]:
+                print(f"❌ Search endpoint wrong: {body}")
+                return False
+            print("✅ Search endpoint returns ranked matches")
+            
+            app.config['MOVEMENT_FORM_TYPEAHEAD'] = 1
+            try:
+                page = client.get('/movements/add').data
+                filtered = [client.get(f'{path}?product_id={jack.product_id}').data
+                            for path in ('/movements', '/reports', '/reports/analytics')]
+            finally:
+                app.config['MOVEMENT_FORM_TYPEAHEAD'] = 200
+            if b'typeahead' not in page or b'<option value="' in page:
+                print("❌ Movement form still ships every product")
+                return False
+            print("✅ Movement form switches to typeahead for large catalogs")
+
+            selected = f'value="Wombat Pallet Jack [#{jack.product_id}]"'.encode()
+            if any(b'<select class="form-select form-select-sm" id="filter_product"' in filters
+                   or selected not in filters for filters in filtered):
+                print("❌ Filters still list every product")
+                return False
+            print("✅ Ledger, balance and analytics filters search instead of listing the catalog")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing search: {e}")
+            return False
+
+def test_background_jobs():
+    """Test background jobs: submit, progress, artifacts, timeouts and resume"""
+    print("\nTesting background jobs...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            app.config['JOB_ARTIFACT_DIR'] = tempfile.mkdtemp()
+            app.config['JOB_EVENTS_INTERVAL'] = 0.05
+            
+            response = client.get('/movements/export?format=csv&background=1')
+            if response.status_code != 202 or 'Location' not in response.headers:
+                print(f"❌ Background export not queued: {response.status_code}")
+                return False
+            job_id = response.get_json()['data']['job_id']
+            
+            events = client.get(f'/api/v1/jobs/{job_id}/events').data.decode()
+            last = json.loads(events.strip().split('\n')[-1][len('data: '):])
+            if not events.startswith('event: ') or last['status'] != 'succeeded' \
+                    or last['done'] != last['total']:
+                print(f"❌ Progress stream did not end in success: {last}")
+                return False
+            print(f"✅ Export job streamed progress to {last['done']}/{last['total']} rows")
+            
+            artifact = client.get(f'/api/v1/jobs/{job_id}/artifact')
+            direct = client.get('/movements/export?format=csv')
+            if artifact.status_code != 200 or artifact.data != direct.data:
+                print("❌ Job artifact differs from the direct export")
+                return False
+            artifact.close()
+            print("✅ Artifact matches the direct export")
+            
+            @jobs.task('test-slow')
+            def slow_job(job, steps=50):
+                for step in range(steps):
+                    time.sleep(0.02)
+                    job.progress(step, steps)
+            
+            job_id = client.post('/api/v1/jobs', json={'kind': 'test-slow', 'timeout': 1,
+                                                       'params': {'steps': 200}}).get_json()['data']['job_id']
+            if jobs.wait(job_id).status != 'timed_out':
+                print("❌ Job ran past its timeout")
+                return False
+            print("✅ Job stopped at its timeout")
+            
+            app.config['JOB_MAX_PENDING'] = 0
+            try:
+                status = client.post('/api/v1/jobs', json={'kind': 'test-slow'}).status_code
+                export = client.get('/reports/export?background=1')
+            finally:
+                app.config['JOB_MAX_PENDING'] = 20
+            if status != 429 or export.status_code != 429 or 'error' not in export.get_json():
+                print(f"❌ Full job queue accepted a job: {status}, {export.status_code}")
+                return False
+            print("✅ Full job queue rejects new jobs")
+            
+            app.config['JOBS_ENABLED'] = False
+            try:
+                export = client.get('/movements/export?background=1')
+            finally:
+                app.config['JOBS_ENABLED'] = True
+            if export.status_code != 400:
+                print(f"❌ Background export with jobs disabled: {export.status_code}")
+                return False
+            print("✅ Background exports report disabled jobs as a client error")
+            
+            # A job left running by a process that died
+            db.session.commit()
+            interrupted = Job(kind='test-slow', params='{"steps": 2}', status='running', attempts=1)
+            db.session.add(interrupted)
+            db.session.commit()
+            if interrupted.job_id not in jobs.resume() \
+                    or jobs.wait(interrupted.job_id).status != 'succeeded':
+                print("❌ Interrupted job not resumed")
+                return False
+            print("✅ Interrupted job resumed after restart")
+            
+            # A job another live process runs keeps its lease
+            db.session.commit()
+            live = Job(kind='test-slow', params='{"steps": 2}', status='running', attempts=1,
+                       owner='elsewhere:1', lease_expires=datetime.utcnow() + timedelta(minutes=1))
+            db.session.add(live)
+            db.session.commit()
+            live_id = live.job_id
+            db.session.commit()
+            if live_id in jobs.resume():
+                print("❌ Job with a live lease was taken over")
+                return False
+            db.session.execute(update(Job).where(Job.job_id == live_id)
+                               .values(lease_expires=datetime.utcnow() - timedelta(seconds=1)))
+            db.session.commit()
+            if live_id not in jobs.resume() or jobs.wait(live_id).status != 'succeeded':
+                print("❌ Job with an expired lease not taken over")
+                return False
+            print("✅ Only jobs whose lease expired are taken over")
+            
+            started, taken, finished = threading.Event(), threading.Event(), threading.Event()
+            
+            @jobs.task('test-lease')
+            def lease_job(job):
+                started.set()
+                taken.wait(5)
+                job.progress(1, 1, force=True)
+                finished.set()
+            
+            job_id = jobs.submit('test-lease')
+            started.wait(5)
+            db.session.execute(update(Job).where(Job.job_id == job_id).values(owner='elsewhere:1'))
+            db.session.commit()
+            taken.set()
+            row = jobs.wait(job_id)
+            if row.status != 'running' or row.done or finished.is_set():
+                print(f"❌ Job kept running after it was taken over: {row.status}")
+                return False
+            print("✅ A job taken over elsewhere stops at its next progress report")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing background jobs: {e}")
+            return False
+
+def test_stock_analytics():
+    """Test vectorized velocity, cover and reorder analytics"""
+    print("\nTesting stock analytics...")
+    with app.app_context():
+        try:
+            product = Product(name='Analytics Widget')
+            db.session.add(product)
+            db.session.commit()
+            product_id = product.product_id
+            end = datetime(2031, 1, 31)
+            
+            # 100 in, then 10/day out on days 19-28 of a 30-day window, 6 of them in the last 7
+            movements = [ProductMovement(product_id=product_id, to_location=1, qty=100,
+                                         timestamp=end - timedelta(days=30))]
+            movements += [ProductMovement(product_id=product_id, from_location=1, qty=10,
+                                          timestamp=end - timedelta(days=10 - day, hours=1))
+                          for day in range(10)]
+            db.session.add_all(movements)
+            for movement in movements:
+                record_change(new=movement_state(movement))
+            db.session.commit()
+            
+            analytics = stock_analytics(end=end, window_days=30, lead_time_days=5,
+                                        target_cover_days=10, product_id=product_id)
+            row = analytics.rows()[0]
+            expected_std = (10 * 10 * 10 / 30 - (100 / 30) ** 2) ** 0.5
+            if (row['location_id'], row['velocity'], row['velocity_7d'], row['daily_std']) \
+                    != (1, round(100 / 30, 2), round(60 / 7, 2), round(expected_std, 2)):
+                print(f"❌ Velocity wrong: {row}")
+                return False
+            print(f"✅ Velocity {row['velocity']}/day over 30 days, {row['velocity_7d']}/day over 7")
+            
+            reorder_point = 100 / 30 * 5 + 1.65 * expected_std * 5 ** 0.5
+            if row['on_hand'] != 0 or row['days_of_cover'] != 0 \
+                    or row['reorder_point'] != round(reorder_point, 2) \
+                    or row['reorder_qty'] != math.ceil(reorder_point + 100 / 30 * 10):
+                print(f"❌ Cover or reorder suggestion wrong: {row}")
+                return False
+            print(f"✅ Empty location suggests reordering {row['reorder_qty']}")
+            
+            # Six of the ten outflows happened before the window ending 5 days earlier
+            past = stock_analytics(end=end - timedelta(days=5), window_days=30,
+                                   product_id=product_id).rows()[0]
+            if past['on_hand'] != 40:
+                print(f"❌ On-hand not read as of the end of the window: {past}")
+                return False
+            print("✅ On-hand is the balance as of the end of the window")
+            
+            large = Product(product_id=100_000_000, name='Analytics Large Id')
+            db.session.add(large)
+            movements = [ProductMovement(product_id=large.product_id, to_location=1, qty=10,
+                                         timestamp=end - timedelta(days=20)),
+                         ProductMovement(product_id=large.product_id, from_location=1, qty=3,
+                                         timestamp=end - timedelta(days=2))]
+            db.session.add_all(movements)
+            for movement in movements:
+                record_change(new=movement_state(movement))
+            db.session.commit()
+            large_row = stock_analytics(end=end, window_days=30, product_id=large.product_id).rows()[0]
+            if (large_row['product_id'], large_row['on_hand'], large_row['velocity']) \
+                    != (100_000_000, 7, round(3 / 30, 2)):
+                print(f"❌ Large product ids grouped wrongly: {large_row}")
+                return False
+            print("✅ Large product ids are grouped without overflow")
+
+            # A window ending mid-day reads that day's outflow from the movements
+            movements = [ProductMovement(product_id=product_id, to_location=1, qty=30,
+                                         timestamp=end + timedelta(hours=1)),
+                         ProductMovement(product_id=product_id, from_location=1, qty=30,
+                                         timestamp=end + timedelta(hours=6))]
+            db.session.add_all(movements)
+            for movement in movements:
+                record_change(new=movement_state(movement))
+            db.session.commit()
+            midday = stock_analytics(end=end + timedelta(hours=12), window_days=30,
+                                     product_id=product_id).rows()[0]
+            if (midday['velocity'], midday['velocity_7d'], midday['on_hand']) \
+                    != (round(130 / 30, 2), round(80 / 7, 2), 0):
+                print(f"❌ Partial last day counted wrongly: {midday}")
+                return False
+            print("✅ A window ending mid-day counts that day's outflow once")
+
+            client = app.test_client()
+            body = client.get(f'/api/v1/analytics/stock?product_id={product_id}&window=30'
+                              f'&as_of=2031-01-30&names=1').get_json()
+            page = client.get(f'/reports/analytics?product_id={product_id}&window=30&as_of=2031-01-30')
+            if body['data'][0]['product'] != 'Analytics Widget' or body['window_days'] != 30 \
+                    or page.status_code != 200 or b'Analytics Widget' not in page.data:
+                print(f"❌ Analytics endpoint or page wrong: {body}")
+                return False
+            print("✅ Analytics served as JSON and on the reports tab")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing stock analytics: {e}")
+            return False
+
+def test_movement_rollups():
+    """Test hourly and daily movement rollups and their chart series"""
+    print("\nTesting movement rollups...")
+    with app.app_context():
+        try:
+            product = Product(name='Rollup Widget')
+            db.session.add(product)
+            db.session.commit()
+            product_id = product.product_id
+            day = datetime(2032, 3, 1)
+            
+            movements = [
+                ProductMovement(product_id=product_id, to_location=1, qty=50,
+                                timestamp=day + timedelta(hours=10, minutes=15)),
+                ProductMovement(product_id=product_id, from_location=1, to_location=2, qty=20,
+                                timestamp=day + timedelta(hours=10, minutes=45)),
+                ProductMovement(product_id=product_id, from_location=1, qty=5,
+                                timestamp=day + timedelta(days=1, hours=9)),
+            ]
+            db.session.add_all(movements)
+            for movement in movements:
+                record_change(new=movement_state(movement))
+            db.session.commit()
+            
+            series = rollup_series('hour', day + timedelta(hours=9), day + timedelta(hours=11),
+                                   location_id=1, product_id=product_id)
+            if series['in'] != [0, 50, 0] or series['transfer_out'] != [0, 20, 0]:
+                print(f"❌ Hourly series wrong: {series}")
+                return False
+            print("✅ Hourly series counts IN and TRANSFER out in their bucket, zero elsewhere")
+            
+            # Edit moves the OUT to another day; delete removes the transfer
+            old_state = movement_state(movements[2])
+            movements[2].qty = 7
+            movements[2].timestamp = day + timedelta(days=2)
+            record_change(old=old_state, new=movement_state(movements[2]))
+            old_state = movement_state(movements[1])
+            db.session.delete(movements[1])
+            record_change(old=old_state)
+            db.session.commit()
+            
+            body = app.test_client().get(f'/api/v1/rollups?granularity=day&product_id={product_id}'
+                                         f'&start=2032-03-01&end=2032-03-03').get_json()
+            if body['buckets'][0] != '2032-03-01T00:00:00' or body['in'] != [50, 0, 0] \
+                    or body['out'] != [0, 0, 7] or body['transfer_in'] != [0, 0, 0]:
+                print(f"❌ Daily series after edit and delete wrong: {body}")
+                return False
+            print("✅ Edits and deletes move quantities between daily buckets")
+            
+            week = rollup_series('week', day, day + timedelta(days=6), product_id=product_id)
+            if week['buckets'] != ['2032-03-01T00:00:00'] or (week['in'], week['out']) != ([50], [7]):
+                print(f"❌ Weekly series wrong: {week}")
+                return False
+            
+            def rollup_rows():
+                return set(db.session.execute(
+                    select(HourlyMovementRollup.__table__)
+                    .where(HourlyMovementRollup.product_id == product_id,
+                           or_(HourlyMovementRollup.in_qty != 0, HourlyMovementRollup.out_qty != 0,
+                               HourlyMovementRollup.transfer_in_qty != 0,
+                               HourlyMovementRollup.transfer_out_qty != 0))
+                ).all())
+            
+            maintained = rollup_rows()
+            rebuild_rollups()
+            if rollup_rows() != maintained:
+                print(f"❌ Maintained rollups differ from a rebuild: {maintained} vs {rollup_rows()}")
+                return False
+            print("✅ Maintained rollups match a rebuild from the ledger")
+            
+            response = app.test_client().get('/api/v1/rollups?granularity=hour&start=2000-01-01&end=2032-01-01')
+            if response.status_code != 400:
+                print(f"❌ Oversized range not rejected: {response.status_code}")
+                return False
+            print("✅ Ranges over ROLLUP_MAX_BUCKETS are rejected")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing movement rollups: {e}")
+            return False
+
+def test_delete_guards():
+    """Test delete guards use EXISTS probes and never load movement collections"""
+    print("\nTesting delete guards...")
+    with app.app_context():
+        try:
+            used = Product(name='Guarded Widget')
+            unused = Product(name='Unused Widget')
+            spare = Location(name='Spare Shelf')
+            db.session.add_all([used, unused, spare])
+            db.session.commit()
+            movement = ProductMovement(product_id=used.product_id, to_location=1, qty=5)
+            db.session.add(movement)
+            record_change(new=movement_state(movement))
+            db.session.commit()
+            used_id, unused_id, spare_id = used.product_id, unused.product_id, spare.location_id
+            
+            if not has_movements(product_id=used_id) or has_movements(product_id=unused_id) \
+                    or not has_movements(location_id=1) or has_movements(location_id=spare_id):
+                print("❌ has_movements() answers wrong")
+                return False
+            if referenced_ids(Product, [used_id, unused_id]) != {used_id}:
+                print("❌ referenced_ids() wrong")
+                return False
+            print("✅ Existence checks find live movements")
+            
+            try:
+                list(used.movements)
+                print("❌ Movement collection loaded in full")
+                return False
+            except TypeError:
+                print("✅ Movement collections cannot be loaded by accident")
+            
+            client = app.test_client()
+            page = client.get('/products?q=Widget').get_data(as_text=True)
+            if page.count('disabled title="This product has movement records"') < 1:
+                print("❌ Products page does not mark products in use")
+                return False
+            client.post(f'/products/delete/{used_id}')
+            client.post(f'/products/delete/{unused_id}')
+            client.post(f'/locations/delete/{spare_id}')
+            db.session.expire_all()
+            if db.session.get(Product, used_id) is None or db.session.get(Product, unused_id) is not None \
+                    or db.session.get(Location, spare_id) is not None:
+                print("❌ Delete guards blocked or allowed the wrong rows")
+                return False
+            print("✅ Products and locations with movements cannot be deleted; others can")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing delete guards: {e}")
+            return False
+
 def test_routes():
     """Test application routes"""
     print("\nTesting application routes...")
@@ -170,6 +1506,271 @@ def test_movement_types():
             print(f"❌ Error testing movement types: {e}")
             return False
 
+def test_parallel_balances():
+    """Test the parallel balance computation matches the single-process one"""
+    print("\nTesting parallel balances...")
+    with app.app_context():
+        try:
+            serial = compute_balances()
+            
+            ranges = movement_ranges(3)
+            bounds = [bound for movement_range in ranges for bound in movement_range]
+            if bounds[0] is not None or bounds[-1] is not None or bounds[1:-1:2] != bounds[2:-1:2]:
+                print(f"❌ Movement ranges do not cover the ledger: {ranges}")
+                return False
+            print(f"✅ {len(ranges)} movement ranges cover the ledger")
+            
+            for workers, partitions in ((2, None), (3, 7), (2, 10000)):
+                parallel = parallel_compute_balances(workers, partitions)
+                if parallel != serial:
+                    print(f"❌ {workers} workers computed different balances")
+                    return False
+            print(f"✅ Parallel balances match the single-process query ({len(serial)} cells)")
+            
+            report = balance_report()
+            drift = rebuild_stock_balances(workers=2)
+            if drift or rebuild_stock_balances(check_only=True, workers=2) or balance_report() != report:
+                print(f"❌ Parallel rebuild changed the balance report: {drift}")
+                return False
+            print("✅ Parallel rebuild leaves the balance report unchanged")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing parallel balances: {e}")
+            return False
+
+def test_change_feed():
+    """Test the change feed: events per write, pull and stream, slow readers and pruning"""
+    print("\nTesting change feed...")
+    with app.app_context():
+        try:
+            client = app.test_client()
+            app.config['CHANGES_POLL_INTERVAL'] = 0.01
+            app.config['CHANGES_STREAM_SECONDS'] = 0
+            
+            def balances():
+                page = client.get('/api/v1/balances?limit=1000').get_json()
+                return page['seq'], {(row['product_id'], row['location_id']): row['qty']
+                                     for row in page['data']}
+            
+            # Drift a client has already read, which the rebuild below corrects
+            cell = StockBalance.query.filter(StockBalance.qty > 0).first()
+            cell.qty += 1
+            db.session.commit()
+            
+            seq, view = balances()
+            product_id = Product.query.first().product_id
+            source, target = [location.location_id for location in
+                              Location.query.order_by(Location.location_id).limit(2)]
+            client.post('/movements/add', data={'product_id': product_id, 'from_location': '',
+                                                'to_location': source, 'qty': 7})
+            movement_id = ProductMovement.query.order_by(ProductMovement.movement_id.desc()).first().movement_id
+            client.post(f'/movements/edit/{movement_id}', data={
+                'product_id': product_id, 'from_location': '',
+                'to_location': target, 'qty': 9})
+            client.post(f'/movements/delete/{movement_id}')
+            client.post('/api/v1/movements/batch', json=[
+                {'product_id': product_id, 'to_location': source, 'qty': 2}])
+            
+            db.session.remove()
+            rebuild_stock_balances()
+            
+            events = client.get(f'/api/v1/changes?since={seq}').get_json()['data']
+            kinds = [event['kind'] for event in events]
+            if kinds != ['create', 'edit', 'delete', 'batch', 'rebuild'] \
+                    or {event['movement_id'] for event in events[:3]} != {movement_id}:
+                print(f"❌ Writes logged the wrong events: {kinds}")
+                return False
+            print("✅ Create, edit, delete, batch and rebuild each logged one event")
+            
+            for event in events:
+                for delta in event['deltas']:
+                    key = (delta['product_id'], delta['location_id'])
+                    view[key] = view.get(key, 0) + delta['delta']
+            latest, current = balances()
+            if {key: qty for key, qty in view.items() if qty} != current or latest != events[-1]['seq']:
+                print("❌ Balances plus event deltas differ from the current balances")
+                return False
+            print(f"✅ Applying {len(events)} events' deltas reproduces the current balances")
+            
+            body = client.get(f'/api/v1/changes/stream?since={seq}').data.decode()
+            streamed = [int(line[len('id: '):]) for line in body.split('\n') if line.startswith('id: ')]
+            resumed = client.get('/api/v1/changes/stream', headers={'Last-Event-ID': str(streamed[1])})
+            resumed = [int(line[len('id: '):]) for line in resumed.data.decode().split('\n')
+                       if line.startswith('id: ')]
+            if streamed != [event['seq'] for event in events] or resumed != streamed[2:]:
+                print(f"❌ Stream sent {streamed}, resumed with {resumed}")
+                return False
+            print("✅ Stream sends the same events and resumes from Last-Event-ID")
+            
+            # A reader that stops reading mid-stream must not hold up a write
+            app.config['CHANGES_STREAM_SECONDS'] = 60
+            db.session.remove()
+            stalled = client.get(f'/api/v1/changes/stream?since={seq}', buffered=False)
+            chunks = iter(stalled.response)
+            next(chunks), next(chunks)
+            held = sum(engine.pool.checkedout() for engine in db.engines.values())
+            started = time.perf_counter()
+            status = client.post('/movements/add', data={'product_id': product_id,
+                                                         'to_location': target,
+                                                         'qty': 1}).status_code
+            elapsed = time.perf_counter() - started
+            stalled.close()
+            app.config['CHANGES_STREAM_SECONDS'] = 0
+            if held or status != 302 or elapsed > 1:
+                print(f"❌ Stalled stream held {held} connection(s); write {status} after {elapsed:.2f}s")
+                return False
+            print(f"✅ Write went through in {elapsed * 1000:.0f}ms while a stream sat unread")
+            
+            db.session.remove()
+            newest = MovementEvent.query.order_by(MovementEvent.seq.desc()).first().seq
+            pruned = prune_events(datetime.utcnow() + timedelta(seconds=1))
+            behind = client.get(f'/api/v1/changes?since={seq}')
+            caught_up = client.get(f'/api/v1/changes?since={newest}')
+            reset = client.get(f'/api/v1/changes/stream?since={seq}').data.decode()
+            if (not pruned or behind.status_code != 410 or caught_up.status_code != 200
+                    or caught_up.get_json()['data'] or 'event: reset' not in reset):
+                print(f"❌ Pruned feed not reported: {behind.status_code} {caught_up.status_code}")
+                return False
+            print(f"✅ Pruned {pruned} events; clients further behind get 410 or a reset event")
+            
+            return True
+        except Exception as e:
+            print(f"❌ Error testing change feed: {e}")
+            return False
+
+def test_read_replicas():
+    """Test GET routing to a replica with read-your-writes and lag fallback"""
+    print("\nTesting read replicas...")
+    workdir = tempfile.mkdtemp()
+    replica_app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{workdir}/primary.db',
+        'DB_REPLICA_URI': f'sqlite:///{workdir}/replica.db',
+        'DB_REPLICA_CHECK_INTERVAL': 0,
+        'DB_REPLICA_MAX_LAG': 60,
+        'CACHE_ENABLED': False,
+        'JOBS_ENABLED': False,
+    })
+    with replica_app.app_context():
+        try:
+            create_schema()
+            seed_sample_data()
+            replicate_sqlite()
+            replica = db.engines['replica']
+            reads = []
+            listener = lambda conn, *args: reads.append(conn.engine)
+            event.listen(replica, 'before_cursor_execute', listener)
+            
+            def page(client):
+                # A fresh session per request, as when serving
+                db.session.remove()
+                return client.get('/products').get_data(as_text=True)
+            
+            writer, reader = replica_app.test_client(), replica_app.test_client()
+            page(reader)
+            if not reads:
+                print("❌ GET request was not served from the replica")
+                return False
+            print("✅ GET requests read from the replica")
+            
+            writer.post('/products/add', data={'name': 'Replicated Widget'})
+            if 'Replicated Widget' not in page(writer) or 'Replicated Widget' in page(reader):
+                print("❌ Writer did not read its write, or the replica was not behind")
+                return False
+            print("✅ A writer reads from the primary until the replica has its write")
+            
+            replica_app.config['DB_REPLICA_MAX_LAG'] = 0
+            if 'Replicated Widget' not in page(reader) or replicas.lagging_reads != 1:
+                print("❌ Lagging replica did not fall back to the primary")
+                return False
+            replica_app.config['DB_REPLICA_MAX_LAG'] = 60
+            print("✅ Reads fall back to the primary when the replica lags")
+            
+            replicate_sqlite()
+            reads.clear()
+            if 'Replicated Widget' not in page(writer) or not reads:
+                print("❌ Writer not routed back to the caught-up replica")
+                return False
+            print("✅ Reads return to the replica once it catches up")
+            
+            try:
+                with replica.begin() as connection:
+                    connection.exec_driver_sql('DELETE FROM product')
+                print("❌ Replica engine accepted a write")
+                return False
+            except Exception as e:
+                if 'readonly' not in str(e):
+                    raise
+            if 'inventory_db_lagging_reads_total 1' not in writer.get('/metrics').get_data(as_text=True):
+                print("❌ Replica routing missing from /metrics")
+                return False
+            print("✅ The replica is read-only and routing is reported in /metrics")
+            
+            event.remove(replica, 'before_cursor_execute', listener)
+            return True
+        except Exception as e:
+            print(f"❌ Error testing read replicas: {e}")
+            return False
+
+def test_app_factory():
+    """Test create_app() layers config, creates nothing and defers optional imports"""
+    print("\nTesting application factory...")
+    try:
+        path = os.path.join(tempfile.mkdtemp(), 'factory.db')
+        os.environ['INVENTORY_MOVEMENTS_PER_PAGE'] = '7'
+        try:
+            with mock.patch('os.register_at_fork') as register_at_fork:
+                factory_app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}',
+                                          'API_ENABLED': False})
+        finally:
+            del os.environ['INVENTORY_MOVEMENTS_PER_PAGE']
+        if factory_app.config['MOVEMENTS_PER_PAGE'] != 7 or 'api' in factory_app.blueprints \
+                or not {'inventory', 'reports'} <= set(factory_app.blueprints):
+            print("❌ Config layers or blueprints wrong")
+            return False
+        if register_at_fork.called:
+            print("❌ create_app() registered another fork handler")
+            return False
+        # The first request resumes background jobs; that must not create the job table
+        jobs._resumed = False
+        factory_app.test_client().get('/')
+        with factory_app.app_context():
+            if db.inspect(db.engine).get_table_names():
+                print("❌ create_app() or the first request created tables")
+                return False
+        print("✅ Config comes from Config, INVENTORY_* variables and overrides; no tables or fork handlers added")
+        
+        result = factory_app.test_cli_runner().invoke(args=['init-db', '--seed'])
+        with factory_app.app_context():
+            if result.exit_code != 0 or db.session.scalar(select(func.count(Product.product_id))) != 4:
+                print(f"❌ init-db --seed failed: {result.output}")
+                return False
+        print("✅ flask init-db --seed creates and seeds the database")
+        
+        factory_app.config['MOVEMENT_FORM_TYPEAHEAD'] = 1
+        client = factory_app.test_client()
+        pages = [client.get('/movements/add'), client.get('/movements/edit/1')]
+        export = client.get('/movements/export?background=1')
+        if any(page.status_code != 200 or b'typeahead' in page.data for page in pages) \
+                or export.status_code != 400:
+            print(f"❌ Pages need the JSON API: {[page.status_code for page in pages + [export]]}")
+            return False
+        print("✅ Movement form and exports work without the JSON API")
+        
+        probe = subprocess.run(
+            [sys.executable, '-c', 'import sys, app; app.create_app(); '
+             'print(sorted(m for m in ("numpy", "analytics", "api") if m in sys.modules))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if probe.stdout.strip() != "['api']":
+            print(f"❌ Unexpected modules imported at startup: {probe.stdout or probe.stderr}")
+            return False
+        print("✅ NumPy and analytics load on first use, not at startup")
+        
+        return True
+    except Exception as e:
+        print(f"❌ Error testing application factory: {e}")
+        return False
+
 def run_all_tests():
     """Run all tests"""
     print("=" * 60)
@@ -181,8 +1782,33 @@ def run_all_tests():
         test_sample_data,
         test_models,
         test_balance_calculation,
+        test_balance_engine,
+        test_stock_balance_maintenance,
+        test_movement_pagination,
+        test_query_plans,
+        test_bulk_import,
+        test_streaming_export,
+        test_report_cache,
+        test_fragment_cache,
+        test_as_of_balances,
+        test_archive,
+        test_request_metrics,
+        test_synthetic_data,
+        test_engine_profile,
+        test_negative_stock,
+        test_movement_batch,
+        test_json_api,
+        test_search,
+        test_background_jobs,
+        test_stock_analytics,
+        test_movement_rollups,
+        test_delete_guards,
         test_routes,
         test_movement_types,
+        test_parallel_balances,
+        test_change_feed,
+        test_read_replicas,
+        test_app_factory,
     ]
     
     passed = 0
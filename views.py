@@ -0,0 +1,420 @@
+"""
+Inventory pages: products, locations and the movement ledger.
+
+The ``inventory`` blueprint holds the HTML pages and forms for the
+catalogue and the ledger, the ledger import and export endpoints, and the
+cache and metrics endpoints. Balance reports are in reports.py and the JSON
+API in api.py.
+"""
+
+from datetime import datetime
+from flask import (Blueprint, Response, current_app, flash, jsonify, redirect, render_template,
+                   request, stream_with_context, url_for)
+from sqlalchemy import select
+from models import db, Product, Location, ProductMovement
+import exporter
+from cache import cache, cached_view
+from importer import FORMATS, detect_format, import_movements, iter_rows
+from jobs import JobError, JobQueueFull, jobs
+from ledger import (MovementError, has_movements, movement_page, movement_state, parse_movement,
+                    parse_movement_filters, record_change, referenced_ids)
+from metrics import metrics
+from search import search
+
+
+inventory = Blueprint('inventory', __name__)
+
+
+def search_results(model, kind, query):
+    """Load the ``model`` rows matching a search, best match first."""
+    ids = [id_ for id_, _ in search(kind, query, current_app.config['SEARCH_MAX_RESULTS'])]
+    key = model.__mapper__.primary_key[0]
+    found = {getattr(row, key.name): row for row in model.query.filter(key.in_(ids))}
+    return [found[id_] for id_ in ids if id_ in found]
+
+
+def lookup_options():
+    """(id, name) rows for the product and location dropdowns of forms and filters.
+
+    A list longer than MOVEMENT_FORM_TYPEAHEAD is replaced by None, and the
+    page looks entries up through /api/v1/search as the user types instead
+    (see templates/lookup.html). Without the JSON API the lists are always
+    complete.
+    """
+    limit = current_app.config['MOVEMENT_FORM_TYPEAHEAD'] if 'api' in current_app.blueprints else None
+    options = {}
+    for kind, key, name in (('products', Product.product_id, Product.name),
+                            ('locations', Location.location_id, Location.name)):
+        query = select(key, name).order_by(name, key)
+        if limit is None:
+            options[kind] = db.session.execute(query).all()
+            continue
+        rows = db.session.execute(query.limit(limit + 1)).all()
+        options[kind] = rows if len(rows) <= limit else None
+    return options
+
+
+def filter_options(product_id=None, location_id=None):
+    """lookup_options() plus the names of the filtered product and location.
+
+    A search box only shows the selected entry, so its name is looked up on
+    its own rather than from the full list.
+    """
+    options = lookup_options()
+    for field, model, id_ in (('product_name', Product, product_id),
+                              ('location_name', Location, location_id)):
+        entry = db.session.get(model, id_) if id_ is not None else None
+        options[field] = entry.name if entry is not None else None
+    return options
+
+
+# Home Route
+@inventory.route('/')
+def index():
+    return render_template('index.html')
+
+
+# ==================== PRODUCT ROUTES ====================
+@inventory.route('/products')
+@cached_view
+def products():
+    query = request.args.get('q', '').strip()
+    
+    def render_list():
+        if query:
+            rows = search_results(Product, 'products', query)
+            in_use = referenced_ids(Product, [product.product_id for product in rows])
+        else:
+            rows = db.session.execute(select(Product.product_id, Product.name, Product.description)
+                                      .order_by(Product.product_id)).all()
+            in_use = referenced_ids(Product)
+        return render_template('products_list.html', products=rows, query=query, in_use=in_use)
+    
+    # The "In use" markers depend on the movements
+    results = cache.fragment('products', ('products', 'movements'), query, render_list)
+    return render_template('products.html', query=query, results=results)
+
+
+@inventory.route('/products/add', methods=['GET', 'POST'])
+def add_product():
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        description = request.form.get('description', '').strip()
+        
+        if not name:
+            flash('Product name is required!', 'danger')
+            return render_template('product_form.html')
+        
+        new_product = Product(name=name, description=description)
+        db.session.add(new_product)
+        db.session.commit()
+        cache.bump_version('products')
+        
+        flash(f'Product "{name}" added successfully!', 'success')
+        return redirect(url_for('inventory.products'))
+    
+    return render_template('product_form.html')
+
+
+@inventory.route('/products/edit/<int:product_id>', methods=['GET', 'POST'])
+def edit_product(product_id):
+    product = Product.query.get_or_404(product_id)
+    
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        description = request.form.get('description', '').strip()
+        
+        if not name:
+            flash('Product name is required!', 'danger')
+            return render_template('product_form.html', product=product)
+        
+        product.name = name
+        product.description = description
+        db.session.commit()
+        cache.bump_version('products')
+        
+        flash(f'Product "{name}" updated successfully!', 'success')
+        return redirect(url_for('inventory.products'))
+    
+    return render_template('product_form.html', product=product)
+
+
+@inventory.route('/products/delete/<int:product_id>', methods=['POST'])
+def delete_product(product_id):
+    product = Product.query.get_or_404(product_id)
+    
+    # Check if product has movements, live or archived
+    if has_movements(product_id=product_id):
+        flash(f'Cannot delete product "{product.name}" because it has movement records!', 'danger')
+        return redirect(url_for('inventory.products'))
+    
+    name = product.name
+    db.session.delete(product)
+    db.session.commit()
+    cache.bump_version('products')
+    
+    flash(f'Product "{name}" deleted successfully!', 'success')
+    return redirect(url_for('inventory.products'))
+
+
+# ==================== LOCATION ROUTES ====================
+@inventory.route('/locations')
+@cached_view
+def locations():
+    query = request.args.get('q', '').strip()
+    
+    def render_list():
+        if query:
+            rows = search_results(Location, 'locations', query)
+            in_use = referenced_ids(Location, [location.location_id for location in rows])
+        else:
+            rows = db.session.execute(select(Location.location_id, Location.name, Location.address)
+                                      .order_by(Location.location_id)).all()
+            in_use = referenced_ids(Location)
+        return render_template('locations_list.html', locations=rows, query=query, in_use=in_use)
+    
+    results = cache.fragment('locations', ('locations', 'movements'), query, render_list)
+    return render_template('locations.html', query=query, results=results)
+
+
+@inventory.route('/locations/add', methods=['GET', 'POST'])
+def add_location():
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        address = request.form.get('address', '').strip()
+        
+        if not name:
+            flash('Location name is required!', 'danger')
+            return render_template('location_form.html')
+        
+        new_location = Location(name=name, address=address)
+        db.session.add(new_location)
+        db.session.commit()
+        cache.bump_version('locations')
+        
+        flash(f'Location "{name}" added successfully!', 'success')
+        return redirect(url_for('inventory.locations'))
+    
+    return render_template('location_form.html')
+
+
+@inventory.route('/locations/edit/<int:location_id>', methods=['GET', 'POST'])
+def edit_location(location_id):
+    location = Location.query.get_or_404(location_id)
+    
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        address = request.form.get('address', '').strip()
+        
+        if not name:
+            flash('Location name is required!', 'danger')
+            return render_template('location_form.html', location=location)
+        
+        location.name = name
+        location.address = address
+        db.session.commit()
+        cache.bump_version('locations')
+        
+        flash(f'Location "{name}" updated successfully!', 'success')
+        return redirect(url_for('inventory.locations'))
+    
+    return render_template('location_form.html', location=location)
+
+
+@inventory.route('/locations/delete/<int:location_id>', methods=['POST'])
+def delete_location(location_id):
+    location = Location.query.get_or_404(location_id)
+    
+    # Check if location has movements, live or archived
+    if has_movements(location_id=location_id):
+        flash(f'Cannot delete location "{location.name}" because it has movement records!', 'danger')
+        return redirect(url_for('inventory.locations'))
+    
+    name = location.name
+    db.session.delete(location)
+    db.session.commit()
+    cache.bump_version('locations')
+    
+    flash(f'Location "{name}" deleted successfully!', 'success')
+    return redirect(url_for('inventory.locations'))
+
+
+# ==================== PRODUCT MOVEMENT ROUTES ====================
+@inventory.route('/movements')
+def movements():
+    filters = parse_movement_filters(request.args)
+    per_page = request.args.get('per_page', current_app.config['MOVEMENTS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MOVEMENTS_MAX_PER_PAGE']))
+    
+    def render_list():
+        page, next_cursor = movement_page(filters, request.args.get('cursor'), per_page)
+        
+        next_url = None
+        if next_cursor:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            next_url = url_for('inventory.movements', **args)
+        
+        return render_template('movements_list.html', movements=page, next_url=next_url,
+                               filters=filters, paginated='cursor' in request.args,
+                               **filter_options(filters['product_id'], filters['location_id']))
+    
+    # Rows show product and location names, and the filters list them
+    results = cache.fragment('movements', ('movements', 'products', 'locations'),
+                             sorted(request.args.items(multi=True)), render_list)
+    return render_template('movements.html', results=results)
+
+
+@inventory.route('/movements/add', methods=['GET', 'POST'])
+def add_movement():
+    if request.method == 'POST':
+        try:
+            values = parse_movement(
+                request.form.get('product_id'),
+                request.form.get('from_location'),
+                request.form.get('to_location'),
+                request.form.get('qty'),
+            )
+            # Stamped here rather than at flush, so the rollups see the same time
+            new_movement = ProductMovement(timestamp=datetime.utcnow(), **values)
+            
+            db.session.add(new_movement)
+            record_change(new=movement_state(new_movement), movement=new_movement)
+        except MovementError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('inventory.add_movement'))
+        
+        db.session.commit()
+        cache.bump_version('movements')
+        
+        flash('Product movement added successfully!', 'success')
+        return redirect(url_for('inventory.movements'))
+    
+    return render_template('movement_form.html', **lookup_options())
+
+
+@inventory.route('/movements/edit/<int:movement_id>', methods=['GET', 'POST'])
+def edit_movement(movement_id):
+    movement = ProductMovement.query.get_or_404(movement_id)
+    
+    if request.method == 'POST':
+        try:
+            values = parse_movement(
+                request.form.get('product_id'),
+                request.form.get('from_location'),
+                request.form.get('to_location'),
+                request.form.get('qty'),
+            )
+            old_state = movement_state(movement)
+            for field, value in values.items():
+                setattr(movement, field, value)
+            
+            record_change(old=old_state, new=movement_state(movement), movement=movement)
+        except MovementError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('inventory.edit_movement', movement_id=movement_id))
+        
+        db.session.commit()
+        cache.bump_version('movements')
+        
+        flash('Product movement updated successfully!', 'success')
+        return redirect(url_for('inventory.movements'))
+    
+    return render_template('movement_form.html', movement=movement, **lookup_options())
+
+
+@inventory.route('/movements/delete/<int:movement_id>', methods=['POST'])
+def delete_movement(movement_id):
+    movement = ProductMovement.query.get_or_404(movement_id)
+    
+    try:
+        db.session.delete(movement)
+        record_change(old=movement_state(movement), movement=movement)
+    except MovementError as e:
+        # Deleting an incoming movement can leave too little stock behind
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('inventory.movements'))
+    
+    db.session.commit()
+    cache.bump_version('movements')
+    
+    flash('Product movement deleted successfully!', 'success')
+    return redirect(url_for('inventory.movements'))
+
+
+@inventory.route('/movements/import', methods=['POST'])
+def import_movements_upload():
+    # Accept either a multipart file field or the raw (possibly chunked) request body
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        fmt = detect_format(upload.filename, upload.mimetype)
+    else:
+        stream = request.stream
+        fmt = detect_format(content_type=request.mimetype)
+    
+    fmt = request.args.get('format') or fmt
+    if fmt not in FORMATS:
+        return jsonify(error='Unknown import format, expected csv or ndjson.'), 400
+    
+    result = import_movements(
+        iter_rows(stream, fmt),
+        batch_size=current_app.config['IMPORT_BATCH_SIZE'],
+        max_errors=current_app.config['IMPORT_MAX_REPORTED_ERRORS'],
+    )
+    cache.bump_version('movements')
+    return jsonify(result.as_dict())
+
+
+def export_response(fmt, columns, rows, filename):
+    """Stream rows to the client as a CSV or NDJSON download."""
+    body = stream_with_context(exporter.encode(fmt, columns, rows))
+    return Response(body, mimetype=exporter.MIMETYPES[fmt], headers={
+        'Content-Disposition': f'attachment; filename={filename}.{fmt}',
+    })
+
+
+def export_job(kind, params):
+    """Queue an export job and describe it like ``POST /api/v1/jobs`` does."""
+    # The job's status and artifact are only served by the JSON API
+    if 'api' not in current_app.blueprints:
+        return jsonify(error='Background exports need the JSON API (API_ENABLED).'), 400
+    
+    try:
+        job_id = jobs.submit(kind, params)
+    except JobQueueFull as e:
+        return jsonify(error=str(e)), 429
+    except JobError as e:
+        return jsonify(error=str(e)), 400
+    
+    from api import job_submitted
+    return job_submitted(job_id)
+
+
+@inventory.route('/movements/export')
+def export_movements():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exporter.FORMATS:
+        return jsonify(error='Unknown export format, expected csv or ndjson.'), 400
+    
+    if request.args.get('background') == '1':
+        params = {key: value for key, value in request.args.items() if key != 'background'}
+        return export_job('export-movements', dict(params, format=fmt))
+    
+    filters = parse_movement_filters(request.args)
+    return export_response(fmt, exporter.MOVEMENT_COLUMNS,
+                           exporter.iter_movement_rows(filters), 'movements')
+
+
+# ==================== CACHE STATS ====================
+@inventory.route('/cache/stats')
+def cache_stats():
+    return jsonify(cache.stats())
+
+
+@inventory.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')